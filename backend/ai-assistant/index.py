@@ -1,15 +1,79 @@
+import hmac
 import json
 import os
 import psycopg2
-import calendar
+import re
+import time
 from datetime import datetime, timedelta
 
 try:
+    import httpx
     import openai
     OPENAI_AVAILABLE = True
+    # Сбои, после которых раунд повторяется на запасной модели: до начала потока — openai, во время чтения — httpx
+    LLM_TRANSIENT_ERRORS = (
+        openai.APITimeoutError, openai.APIConnectionError, httpx.TimeoutException, httpx.TransportError
+    )
 except ImportError:
     OPENAI_AVAILABLE = False
 
+from tools import CHAT_TOOLS, execute_tool
+
+# Снимки контекста владельцев на тёплом инстансе: owner_id -> {version, context, cached_at}
+OWNER_CONTEXT_CACHE = {}
+OWNER_CONTEXT_CACHE_MAX_OWNERS = 200
+OWNER_CONTEXT_TTL_SECONDS = 600
+
+# Потоковые ответы: stream_id генерирует клиент, частичный текст сбрасывается в БД не чаще раза в интервал
+STREAM_ID_PATTERN = re.compile(r'^[A-Za-z0-9-]{8,64}$')
+STREAM_FLUSH_SECONDS = 0.4
+
+# Бюджеты промпта в токенах: данные владельца в системном промпте и окно истории разговора
+CONTEXT_TOKEN_BUDGET = 2500
+HISTORY_TOKEN_BUDGET = 2000
+HISTORY_MAX_MESSAGES = 30
+SUMMARY_FOLD_MIN_MESSAGES = 10
+SUMMARY_FOLD_MAX_MESSAGES = 40
+SUMMARY_MODEL = 'openai/gpt-4o-mini'
+SUMMARY_FOLD_BATCH_CONVERSATIONS = 20
+
+# Клиент модели: один на тёплый инстанс, с таймаутами и переходом на быструю модель при нарушении SLO
+LLM_CLIENT = None
+LLM_PRIMARY_MODEL = 'openai/gpt-4o'
+LLM_FALLBACK_MODEL = 'openai/gpt-4o-mini'
+LLM_CONNECT_TIMEOUT_SECONDS = 3
+LLM_READ_TIMEOUT_SECONDS = 20
+LLM_MAX_RETRIES = 1
+LLM_KEEPALIVE_SECONDS = 120
+LLM_LATENCY_SLO_SECONDS = 12
+LLM_FALLBACK_COOLDOWN_SECONDS = 120
+LLM_HEALTH = {'degraded_until': 0.0}
+
+# История чата: размер страницы и перенос неактивных разговоров в архив
+CHAT_PAGE_SIZE = 50
+CHAT_PAGE_MAX_SIZE = 100
+CHAT_ARCHIVE_AFTER_DAYS = 90
+CHAT_ARCHIVE_BATCH_SIZE = 200
+CHAT_ARCHIVE_MAX_BATCHES = 10
+
+# Действия, которые вызывает только планировщик (заголовок X-Scheduler-Secret = SCHEDULER_SECRET)
+SCHEDULER_ACTIONS = {'archive-conversations', 'summarize-conversations'}
+
+# Максимальная глубина выборки помесячных KPI (action=kpi)
+KPI_MAX_MONTHS = 36
+
+# Максимум обращений к модели за один ответ (раунды вызова инструментов + финальный ответ)
+TOOL_MAX_ROUNDS = 4
+
+# Кэш ответов на повторяющиеся вопросы владельца
+RESPONSE_CACHE_MAX_ENTRIES = 200
+QUESTION_STOP_WORDS = {
+    'а', 'и', 'в', 'во', 'на', 'по', 'с', 'со', 'у', 'к', 'о', 'об', 'за', 'из', 'до', 'для',
+    'ну', 'же', 'ли', 'бы', 'мне', 'мой', 'мои', 'моя', 'моих', 'меня', 'нас', 'это',
+    'как', 'какая', 'какой', 'какие', 'что', 'сейчас', 'пожалуйста', 'скажи', 'подскажи', 'покажи',
+    'расскажи', 'привет', 'там', 'вообще', 'еще'
+}
+
 def handler(event: dict, context) -> dict:
     '''
     AI-ассистент для владельцев турбаз с изоляцией по owner_id.
@@ -21,6 +85,32 @@ def handler(event: dict, context) -> dict:
     if method == 'OPTIONS':
         return cors_response()
     
+    # Служебные действия планировщика общие для всех владельцев — только с секретом планировщика
+    if (event.get('queryStringParameters') or {}).get('action') in SCHEDULER_ACTIONS and not is_scheduler_request(event):
+        return error_response('Scheduler secret required in X-Scheduler-Secret header', 403)
+    
+    # Перенос неактивных разговоров в архив — общий для всех владельцев, вызывается планировщиком
+    if (event.get('queryStringParameters') or {}).get('action') == 'archive-conversations':
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            return success_response({'archived': archive_stale_conversations(conn.cursor(), conn)})
+        except Exception as e:
+            conn.rollback()
+            return error_response(str(e), 500)
+        finally:
+            conn.close()
+    
+    # Сворачивание истории отмеченных разговоров в сводку — вне ответа владельцу, вызывается планировщиком
+    if (event.get('queryStringParameters') or {}).get('action') == 'summarize-conversations':
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            return success_response({'folded': fold_pending_summaries(conn.cursor(), conn)})
+        except Exception as e:
+            conn.rollback()
+            return error_response(str(e), 500)
+        finally:
+            conn.close()
+    
     headers = event.get('headers', {})
     owner_id = headers.get('X-Owner-Id') or headers.get('x-owner-id')
     
@@ -36,39 +126,103 @@ def handler(event: dict, context) -> dict:
         query_params = event.get('queryStringParameters') or {}
         action = query_params.get('action', '')
         
-        # GET /chat - получить историю чата владельца
+        # GET /chat - страница истории разговора, от новых к старым по курсору before (id сообщения)
         if method == 'GET' and action == 'chat':
-            conversation_id = query_params.get('conversation_id')
+            conversation_id = query_params.get('conversation_id') or ''
+            before = query_params.get('before') or ''
+            limit = query_params.get('limit') or ''
+            
+            if (conversation_id and not conversation_id.isdigit()) or (before and not before.isdigit()):
+                return error_response('Invalid conversation_id or before', 400)
+            
+            limit = min(int(limit), CHAT_PAGE_MAX_SIZE) if limit.isdigit() and int(limit) > 0 else CHAT_PAGE_SIZE
             
             if conversation_id:
-                cur.execute(f"""
-                    SELECT id, role, content, created_at
-                    FROM ai_messages
-                    WHERE conversation_id = {conversation_id}
-                    ORDER BY created_at ASC
-                    LIMIT 100
-                """)
+                cur.execute(
+                    "SELECT id FROM ai_conversations WHERE id = %s AND owner_id = %s",
+                    (int(conversation_id), owner_id)
+                )
             else:
                 # Последний разговор владельца
-                cur.execute(f"""
-                    SELECT m.id, m.role, m.content, m.created_at
-                    FROM ai_conversations c
-                    JOIN ai_messages m ON m.conversation_id = c.id
-                    WHERE c.owner_id = {owner_id} AND c.context_type = 'owner_chat'
-                    ORDER BY m.created_at ASC
-                    LIMIT 100
-                """)
-            
-            messages = []
-            for row in cur.fetchall():
-                messages.append({
-                    'id': row[0] if not conversation_id else None,
-                    'role': row[1],
-                    'content': row[2],
-                    'created_at': row[3].isoformat()
-                })
+                cur.execute("""
+                    SELECT id FROM ai_conversations
+                    WHERE owner_id = %s AND context_type = 'owner_chat'
+                    ORDER BY id DESC
+                    LIMIT 1
+                """, (owner_id,))
             
-            return success_response({'messages': messages})
+            row = cur.fetchone()
+            if not row and conversation_id:
+                # Старые разговоры переносятся в архив целиком и отдаются одной страницей
+                cur.execute("""
+                    SELECT messages FROM ai_conversations_archive
+                    WHERE id = %s AND owner_id = %s
+                """, (int(conversation_id), owner_id))
+                archived = cur.fetchone()
+                if archived:
+                    return success_response({
+                        'messages': archived[0],
+                        'conversation_id': int(conversation_id),
+                        'next_cursor': None,
+                        'archived': True
+                    })
+            
+            if not row:
+                return success_response({'messages': [], 'conversation_id': None, 'next_cursor': None})
+            
+            conversation_id = row[0]
+            cur.execute("""
+                SELECT id, role, content, created_at
+                FROM ai_messages
+                WHERE conversation_id = %(conversation_id)s
+                AND (%(before)s::int IS NULL OR (created_at, id) < (
+                    SELECT created_at, id FROM ai_messages
+                    WHERE id = %(before)s::int AND conversation_id = %(conversation_id)s
+                ))
+                ORDER BY created_at DESC, id DESC
+                LIMIT %(limit)s
+            """, {'conversation_id': conversation_id, 'before': int(before) if before else None, 'limit': limit + 1})
+            rows = cur.fetchall()
+            
+            has_more = len(rows) > limit
+            rows = list(reversed(rows[:limit]))
+            
+            return success_response({
+                'messages': [
+                    {
+                        'id': message_id,
+                        'role': role,
+                        'content': content,
+                        'created_at': created_at.isoformat()
+                    }
+                    for message_id, role, content, created_at in rows
+                ],
+                'conversation_id': conversation_id,
+                'next_cursor': rows[0][0] if has_more else None
+            })
+        
+        # GET /chat-stream - частичный ответ AI, пока идёт генерация (для поллинга клиентом)
+        if method == 'GET' and action == 'chat-stream':
+            stream_id = query_params.get('stream_id', '')
+            
+            if not STREAM_ID_PATTERN.match(stream_id):
+                return error_response('Invalid stream_id', 400)
+            
+            cur.execute("""
+                SELECT content, status, conversation_id
+                FROM ai_message_streams
+                WHERE id = %s AND owner_id = %s
+            """, (stream_id, owner_id))
+            
+            row = cur.fetchone()
+            if not row:
+                return success_response({'content': '', 'status': 'pending', 'conversation_id': None})
+            
+            return success_response({
+                'content': row[0],
+                'status': row[1],
+                'conversation_id': row[2]
+            })
         
         # POST /chat - отправить сообщение AI
         if method == 'POST' and action == 'chat':
@@ -78,65 +232,102 @@ def handler(event: dict, context) -> dict:
             body = json.loads(event.get('body', '{}'))
             user_message = body.get('message', '').strip()
             conversation_id = body.get('conversation_id')
+            stream_id = body.get('stream_id')
             
             if not user_message:
                 return error_response('Message is required', 400)
             
-            # Создаём или получаем разговор
-            if not conversation_id:
-                cur.execute(f"""
-                    INSERT INTO ai_conversations (owner_id, context_type, status)
-                    VALUES ({owner_id}, 'owner_chat', 'active')
-                    RETURNING id
-                """)
-                conversation_id = cur.fetchone()[0]
-                conn.commit()
+            if stream_id and not STREAM_ID_PATTERN.match(str(stream_id)):
+                return error_response('Invalid stream_id', 400)
             
-            # Сохраняем сообщение пользователя
-            cur.execute(f"""
-                INSERT INTO ai_messages (conversation_id, role, content)
-                VALUES ({conversation_id}, 'user', $${user_message}$$)
-            """)
-            conn.commit()
+            if conversation_id is not None and not str(conversation_id).isdigit():
+                return error_response('Invalid conversation_id', 400)
             
-            # Получаем контекст владельца
-            context = get_owner_context(cur, owner_id)
+            # Разговор и реплики сохраняются одной транзакцией после ответа (persist_turn)
+            conversation_id = int(conversation_id) if conversation_id else None
             
-            # Получаем историю разговора (последние 30 сообщений для контекста AI)
-            cur.execute(f"""
-                SELECT role, content FROM ai_messages
-                WHERE conversation_id = {conversation_id}
-                ORDER BY created_at DESC
-                LIMIT 30
-            """)
+            if conversation_id:
+                cur.execute(
+                    "SELECT 1 FROM ai_conversations WHERE id = %s AND owner_id = %s",
+                    (conversation_id, owner_id)
+                )
+                if not cur.fetchone():
+                    cur.execute(
+                        "SELECT 1 FROM ai_conversations_archive WHERE id = %s AND owner_id = %s",
+                        (conversation_id, owner_id)
+                    )
+                    if not cur.fetchone():
+                        return error_response('Conversation not found', 404)
+                    # Архивный разговор только для чтения: реплика начинает новый разговор
+                    conversation_id = None
             
-            # Переворачиваем в хронологическом порядке
-            messages = [{'role': row[0], 'content': row[1]} for row in reversed(cur.fetchall())]
+            # Получаем контекст владельца (из снимка, если данные не менялись)
+            context, context_version = get_owner_context_cached(cur, owner_id)
+            
+            # История разговора: свежие сообщения в пределах бюджета, более ранние — в сводке
+            summary, messages, fold_due = load_history_window(cur, conversation_id, user_message)
             
             # Системный промпт
-            system_prompt = build_system_prompt(context)
+            system_prompt = build_system_prompt(context, summary)
             
-            # Вызываем Polza.ai API (OpenAI-совместимый)
-            client = openai.OpenAI(
-                base_url='https://api.polza.ai/api/v1',
-                api_key=os.environ.get('POLZA_AI_API_KEY')
-            )
+            # Повторный вопрос при неизменных данных отвечаем из кэша без обращения к модели.
+            # Кэшируется только первая реплика разговора: уточнения вроде «а на выходные?» зависят от контекста
+            broadcast_requested = is_broadcast_request(user_message)
+            starts_conversation = len(messages) == 1 and not summary
+            question_key = normalize_question(user_message) if starts_conversation and not broadcast_requested else None
+            cached_answer = None
+            # Итог обращения к кэшу для hit rate: None — вопрос не кэшируется, True — попадание, False — промах
+            cache_lookup = None
+            if question_key:
+                cached_answer = lookup_cached_response(
+                    cur, owner_id, question_key, context_version, context['today']
+                )
+                cache_lookup = cached_answer is not None
             
-            response = client.chat.completions.create(
-                model='openai/gpt-4o',
-                messages=[
-                    {'role': 'system', 'content': system_prompt},
-                    *messages
-                ],
-                temperature=0.7,
-                max_tokens=800
-            )
+            if cached_answer is not None:
+                conversation_id = persist_turn(
+                    cur, conn, owner_id, conversation_id, user_message, cached_answer, {'cached': True},
+                    cache_lookup=cache_lookup
+                )
+                return success_response({
+                    'message': cached_answer,
+                    'conversation_id': conversation_id,
+                    'cached': True
+                })
+            
+            # Polza.ai API (OpenAI-совместимый), клиент общий для тёплого инстанса
+            client = get_llm_client()
+            llm_calls = []
             
-            assistant_message = response.choices[0].message.content
+            llm_messages = [
+                {'role': 'system', 'content': system_prompt},
+                *messages
+            ]
+            
+            # Данные о бронях, выручке и гостях модель запрашивает сама через инструменты
+            try:
+                if stream_id:
+                    assistant_message = stream_chat_completion(
+                        client, llm_messages, cur, conn, owner_id, conversation_id, stream_id, llm_calls
+                    )
+                else:
+                    assistant_message = complete_with_tools(client, llm_messages, cur, owner_id, llm_calls)
+            except Exception:
+                # Ход не сохраняется, но его таймауты и ошибки должны попасть в llm-stats
+                conn.rollback()
+                try:
+                    record_llm_calls(cur, owner_id, llm_calls)
+                    if cache_lookup is not None:
+                        record_cache_lookup(cur, owner_id, cache_lookup)
+                    conn.commit()
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    print(f'Ошибка сохранения метрик модели владельца {owner_id}: {e}')
+                raise
             
             # Проверяем, есть ли intent для массовой рассылки
             intent_data = None
-            if user_message.lower().find('отправ') != -1 and (user_message.lower().find('клиент') != -1 or user_message.lower().find('всем') != -1 or user_message.lower().find('рассыл') != -1):
+            if broadcast_requested:
                 # Запрос на рассылку — формируем intent
                 intent_data = {
                     'intent': 'broadcast_message',
@@ -145,12 +336,17 @@ def handler(event: dict, context) -> dict:
                     'audience': 'all'  # all | with_bookings | past_guests
                 }
             
-            # Сохраняем ответ
-            cur.execute(f"""
-                INSERT INTO ai_messages (conversation_id, role, content)
-                VALUES ({conversation_id}, 'assistant', $${assistant_message}$$)
-            """)
-            conn.commit()
+            # Сохраняем метрики модели, реплику владельца и ответ одной транзакцией
+            record_llm_calls(cur, owner_id, llm_calls)
+            conversation_id = persist_turn(
+                cur, conn, owner_id, conversation_id, user_message, assistant_message or '',
+                fold_due=fold_due, cache_lookup=cache_lookup
+            )
+            
+            if question_key and assistant_message:
+                store_cached_response(
+                    cur, conn, owner_id, question_key, context_version, context['today'], assistant_message
+                )
             
             result = {
                 'message': assistant_message,
@@ -162,36 +358,138 @@ def handler(event: dict, context) -> dict:
             
             return success_response(result)
         
-        # DELETE /chat - очистить историю чата владельца
+        # GET /response-cache-stats - эффективность кэша ответов владельца
+        if method == 'GET' and action == 'response-cache-stats':
+            cur.execute("""
+                SELECT
+                    COALESCE((SELECT hits FROM ai_response_cache_stats WHERE owner_id = %(owner_id)s), 0),
+                    COALESCE((SELECT misses FROM ai_response_cache_stats WHERE owner_id = %(owner_id)s), 0),
+                    (SELECT COUNT(*) FROM ai_response_cache WHERE owner_id = %(owner_id)s)
+            """, {'owner_id': owner_id})
+            hits, misses, entries = cur.fetchone()
+            total = hits + misses
+            
+            return success_response({
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / total, 3) if total else 0,
+                'entries': entries
+            })
+        
+        # GET /llm-stats - задержка и расход токенов модели за последние дни
+        if method == 'GET' and action == 'llm-stats':
+            days = query_params.get('days', '7')
+            days = min(int(days), 90) if str(days).isdigit() and int(days) > 0 else 7
+            
+            cur.execute("""
+                SELECT model, purpose, COUNT(*),
+                       COUNT(*) FILTER (WHERE status <> 'ok'),
+                       COALESCE(percentile_cont(0.5) WITHIN GROUP (ORDER BY latency_ms), 0)::int,
+                       COALESCE(percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms), 0)::int,
+                       COALESCE(AVG(first_token_ms), 0)::int,
+                       COALESCE(SUM(prompt_tokens), 0),
+                       COALESCE(SUM(completion_tokens), 0)
+                FROM ai_llm_calls
+                WHERE owner_id = %s AND created_at >= NOW() - make_interval(days => %s)
+                GROUP BY model, purpose
+                ORDER BY 3 DESC
+            """, (owner_id, days))
+            
+            return success_response({
+                'days': days,
+                'models': [
+                    {
+                        'model': model,
+                        'purpose': purpose,
+                        'calls': calls,
+                        'failed': failed,
+                        'latency_p50_ms': p50,
+                        'latency_p95_ms': p95,
+                        'first_token_avg_ms': first_token,
+                        'prompt_tokens': prompt_tokens,
+                        'completion_tokens': completion_tokens
+                    }
+                    for model, purpose, calls, failed, p50, p95, first_token, prompt_tokens, completion_tokens
+                    in cur.fetchall()
+                ]
+            })
+        
+        # GET /kpi - помесячные показатели владельца и объектов из предрасчитанных таблиц
+        if method == 'GET' and action == 'kpi':
+            months = query_params.get('months', '12')
+            months = min(int(months), KPI_MAX_MONTHS) if str(months).isdigit() and int(months) > 0 else 12
+            
+            cur.execute("""
+                SELECT to_char(month, 'YYYY-MM'), bookings, booked_nights, available_nights,
+                       revenue::float8, occupancy_rate::float8
+                FROM owner_monthly_stats
+                WHERE owner_id = %s
+                AND month > DATE_TRUNC('month', CURRENT_DATE) - make_interval(months => %s)
+                ORDER BY month
+            """, (owner_id, months))
+            owner_rows = cur.fetchall()
+            
+            cur.execute("""
+                SELECT ms.unit_id, u.name, to_char(ms.month, 'YYYY-MM'), ms.bookings, ms.booked_nights,
+                       ms.available_nights, ms.revenue::float8, ms.occupancy_rate::float8
+                FROM unit_monthly_stats ms
+                JOIN units u ON u.id = ms.unit_id
+                WHERE ms.owner_id = %s
+                AND ms.month > DATE_TRUNC('month', CURRENT_DATE) - make_interval(months => %s)
+                ORDER BY ms.unit_id, ms.month
+            """, (owner_id, months))
+            unit_rows = cur.fetchall()
+            
+            return success_response({
+                'months': [
+                    {
+                        'month': month,
+                        'bookings': bookings,
+                        'booked_nights': booked_nights,
+                        'available_nights': available_nights,
+                        'revenue': revenue,
+                        'occupancy_rate': occupancy_rate
+                    }
+                    for month, bookings, booked_nights, available_nights, revenue, occupancy_rate in owner_rows
+                ],
+                'units': [
+                    {
+                        'unit_id': unit_id,
+                        'unit_name': unit_name,
+                        'month': month,
+                        'bookings': bookings,
+                        'booked_nights': booked_nights,
+                        'available_nights': available_nights,
+                        'revenue': revenue,
+                        'occupancy_rate': occupancy_rate
+                    }
+                    for unit_id, unit_name, month, bookings, booked_nights, available_nights, revenue, occupancy_rate
+                    in unit_rows
+                ]
+            })
+        
+        # DELETE /chat - очистить историю чата владельца (один разговор или все) одним запросом
         if method == 'DELETE' and action == 'chat':
-            conversation_id = query_params.get('conversation_id')
+            conversation_id = query_params.get('conversation_id') or ''
             
-            if conversation_id:
-                # Удаляем сообщения конкретного разговора
-                cur.execute(f"""
-                    DELETE FROM ai_messages
-                    WHERE conversation_id = {conversation_id}
-                """)
-                
-                # Удаляем сам разговор
-                cur.execute(f"""
-                    DELETE FROM ai_conversations
-                    WHERE id = {conversation_id} AND owner_id = {owner_id}
-                """)
-            else:
-                # Удаляем ВСЕ разговоры владельца с типом owner_chat
-                cur.execute(f"""
-                    DELETE FROM ai_messages
-                    WHERE conversation_id IN (
-                        SELECT id FROM ai_conversations
-                        WHERE owner_id = {owner_id} AND context_type = 'owner_chat'
-                    )
-                """)
-                
-                cur.execute(f"""
+            if conversation_id and not conversation_id.isdigit():
+                return error_response('Invalid conversation_id', 400)
+            
+            cur.execute("""
+                WITH removed_conversations AS (
                     DELETE FROM ai_conversations
-                    WHERE owner_id = {owner_id} AND context_type = 'owner_chat'
-                """)
+                    WHERE owner_id = %(owner_id)s AND context_type = 'owner_chat'
+                    AND (%(conversation_id)s::int IS NULL OR id = %(conversation_id)s::int)
+                    RETURNING id
+                ),
+                removed_archive AS (
+                    DELETE FROM ai_conversations_archive
+                    WHERE owner_id = %(owner_id)s AND context_type = 'owner_chat'
+                    AND (%(conversation_id)s::int IS NULL OR id = %(conversation_id)s::int)
+                )
+                DELETE FROM ai_messages
+                WHERE conversation_id IN (SELECT id FROM removed_conversations)
+            """, {'owner_id': owner_id, 'conversation_id': int(conversation_id) if conversation_id else None})
             
             conn.commit()
             return success_response({'message': 'Chat history cleared'})
@@ -449,351 +747,832 @@ def handler(event: dict, context) -> dict:
         conn.close()
 
 
-def get_owner_context(cur, owner_id: int) -> dict:
-    '''Получает полный контекст владельца для AI. Всегда возвращает валидный dict, даже если данных нет.'''
-    
-    # Инициализация дефолтных значений
-    units = []
-    services = []
-    bookings = []
-    pending_bookings = []
-    past_bookings = []
-    stats = {
-        'bookings_this_month': 0,
-        'avg_price': 0,
-        'revenue_this_month': 0,
-        'occupancy_rate': 0
+# Весь контекст владельца собирается в Postgres одним запросом в виде JSON-документа
+OWNER_CONTEXT_SQL = """
+WITH owner_units AS (
+    SELECT id, name, type, base_price, max_guests, dynamic_pricing_enabled
+    FROM units
+    WHERE owner_id = %(owner_id)s
+)
+SELECT json_build_object(
+    'units', COALESCE((
+        SELECT json_agg(json_build_object(
+            'id', u.id,
+            'name', COALESCE(u.name, 'Без названия'),
+            'type', COALESCE(u.type, 'Объект'),
+            'price', COALESCE(u.base_price, 0)::float8,
+            'max_guests', COALESCE(u.max_guests, 1),
+            'dynamic_pricing', COALESCE(u.dynamic_pricing_enabled, false)
+        ) ORDER BY u.id)
+        FROM (SELECT * FROM owner_units ORDER BY id LIMIT 20) u
+    ), '[]'::json),
+    'services', COALESCE((
+        SELECT json_agg(json_build_object(
+            'name', COALESCE(s.name, 'Услуга'),
+            'price', COALESCE(s.price, 0)::float8,
+            'category', COALESCE(s.category, 'Прочее')
+        ))
+        FROM additional_services s
+        WHERE s.owner_id = %(owner_id)s AND s.enabled = true
+    ), '[]'::json),
+    'stats', (
+        SELECT json_build_object(
+            'bookings_this_month', ms.bookings,
+            'avg_price', CASE WHEN ms.bookings > 0 THEN ms.revenue / ms.bookings ELSE 0 END::float8,
+            'revenue_this_month', ms.revenue::float8,
+            'occupancy_rate', ms.occupancy_rate::float8
+        )
+        FROM owner_monthly_stats ms
+        WHERE ms.owner_id = %(owner_id)s
+        AND ms.month = DATE_TRUNC('month', CURRENT_DATE)::date
+    ),
+    'bot_settings', (
+        SELECT json_build_object(
+            'name', COALESCE(bs.bot_name, 'Ассистент'),
+            'style', COALESCE(bs.communication_style, 'Дружелюбный'),
+            'reminders', COALESCE(bs.reminder_enabled, true),
+            'reminder_days', COALESCE(bs.reminder_days, 30)
+        )
+        FROM bot_settings bs
+        WHERE bs.owner_id = %(owner_id)s
+    ),
+    'holidays', COALESCE((
+        SELECT json_agg(json_build_object('date', to_char(h.date, 'YYYY-MM-DD'), 'name', h.holiday_name) ORDER BY h.date)
+        FROM (
+            SELECT date, holiday_name
+            FROM production_calendar
+            WHERE date >= CURRENT_DATE AND is_holiday = true AND holiday_name IS NOT NULL
+            ORDER BY date
+            LIMIT 5
+        ) h
+    ), '[]'::json)
+)
+"""
+
+
+def default_owner_context() -> dict:
+    return {
+        'units': [],
+        'services': [],
+        'stats': {
+            'bookings_this_month': 0,
+            'avg_price': 0,
+            'revenue_this_month': 0,
+            'occupancy_rate': 0
+        },
+        'bot_settings': {'name': 'Ассистент', 'style': 'Дружелюбный'},
+        'holidays': [],
+        'today': datetime.now().strftime('%Y-%m-%d')
     }
-    bot_settings = {'name': 'Ассистент', 'style': 'Дружелюбный'}
-    holidays = []
+
+
+def get_owner_context(cur, owner_id: int) -> dict:
+    '''
+    Получает полный контекст владельца для AI за один запрос к БД.
+    Всегда возвращает валидный dict, даже если данных нет или запрос не удался.
+    '''
+    context = default_owner_context()
     
     try:
-        # Объекты размещения
-        cur.execute(f"""
-            SELECT id, name, type, base_price, max_guests, dynamic_pricing_enabled
-            FROM units
-            WHERE owner_id = {owner_id}
-            LIMIT 20
-        """)
-        
-        for row in cur.fetchall():
-            try:
-                units.append({
-                    'id': row[0],
-                    'name': row[1] or 'Без названия',
-                    'type': row[2] or 'Объект',
-                    'price': float(row[3]) if row[3] else 0,
-                    'max_guests': row[4] or 1,
-                    'dynamic_pricing': row[5] or False
-                })
-            except:
-                continue
-    except:
-        pass
+        cur.execute(OWNER_CONTEXT_SQL, {'owner_id': owner_id})
+        row = cur.fetchone()
+    except psycopg2.Error as e:
+        print(f'Ошибка загрузки контекста владельца {owner_id}: {e}')
+        cur.connection.rollback()
+        return context
     
-    try:
-        # Допродажи
-        cur.execute(f"""
-            SELECT name, price, category, enabled
-            FROM additional_services
-            WHERE owner_id = {owner_id} AND enabled = true
-        """)
-        
-        for row in cur.fetchall():
-            try:
-                services.append({
-                    'name': row[0] or 'Услуга',
-                    'price': float(row[1]) if row[1] else 0,
-                    'category': row[2] or 'Прочее'
-                })
-            except:
-                continue
-    except:
-        pass
+    document = row[0] if row else None
+    if isinstance(document, str):
+        document = json.loads(document)
     
-    try:
-        # КРИТИЧНО: Актуальный календарь ПОДТВЕРЖДЁННЫХ бронирований (±30 дней)
-        cur.execute(f"""
-            SELECT 
-                b.check_in,
-                b.check_out,
-                b.total_price,
-                b.guest_name,
-                b.guest_phone,
-                u.name as unit_name
-            FROM bookings b
-            JOIN units u ON b.unit_id = u.id
-            WHERE u.owner_id = {owner_id}
-            AND b.check_in >= CURRENT_DATE - INTERVAL '7 days'
-            AND b.check_in <= CURRENT_DATE + INTERVAL '30 days'
-            AND b.status = 'confirmed'
-            ORDER BY b.check_in
-        """)
-        
-        for row in cur.fetchall():
-            try:
-                bookings.append({
-                    'check_in': row[0].isoformat() if row[0] else 'н/д',
-                    'check_out': row[1].isoformat() if row[1] else 'н/д',
-                    'price': float(row[2]) if row[2] else 0,
-                    'guest_name': row[3] or 'не указано',
-                    'guest_phone': row[4] or '',
-                    'unit_name': row[5] or 'объект не найден'
-                })
-            except:
-                continue
-    except:
-        pass
+    for key, value in (document or {}).items():
+        if value is not None:
+            context[key] = value
     
-    try:
-        # КРИТИЧНО: ЗАЯВКИ БЕЗ ОПЛАТЫ (pending_bookings)
-        cur.execute(f"""
-            SELECT 
-                pb.id,
-                pb.check_in,
-                pb.check_out,
-                pb.guest_name,
-                pb.guest_contact,
-                pb.amount,
-                pb.verification_status,
-                pb.expires_at,
-                pb.created_at,
-                u.name as unit_name
-            FROM pending_bookings pb
-            JOIN units u ON pb.unit_id = u.id
-            WHERE u.owner_id = {owner_id}
-            AND pb.verification_status = 'pending'
-            AND pb.expires_at > CURRENT_TIMESTAMP
-            ORDER BY pb.created_at DESC
-        """)
-        
-        for row in cur.fetchall():
-            try:
-                pending_bookings.append({
-                    'id': row[0],
-                    'check_in': row[1].isoformat() if row[1] else 'н/д',
-                    'check_out': row[2].isoformat() if row[2] else 'н/д',
-                    'guest_name': row[3] or 'не указано',
-                    'guest_phone': row[4] or '',
-                    'amount': float(row[5]) if row[5] else 0,
-                    'verification_status': row[6] or 'pending',
-                    'expires_at': row[7].isoformat() if row[7] else 'н/д',
-                    'created_at': row[8].isoformat() if row[8] else 'н/д',
-                    'unit_name': row[9] or 'объект не найден'
-                })
-            except:
-                continue
-    except:
-        pass
+    return context
+
+
+def is_broadcast_request(user_message: str) -> bool:
+    text = user_message.lower()
+    return 'отправ' in text and ('клиент' in text or 'всем' in text or 'рассыл' in text)
+
+
+def normalize_question(user_message: str):
+    '''
+    Приводит вопрос к ключу кэша: регистр, ё/е, пунктуация, служебные слова и порядок слов не важны.
+    Возвращает None, если вопрос слишком короткий, чтобы кэшировать его без контекста разговора.
+    '''
+    words = re.findall(r'\w+', user_message.lower().replace('ё', 'е'))
+    meaningful = sorted({word for word in words if word not in QUESTION_STOP_WORDS})
+    if len(meaningful) < 2:
+        return None
+    return ' '.join(meaningful)[:500]
+
+
+def lookup_cached_response(cur, owner_id: int, question_key: str, context_version: int, today: str):
+    '''
+    Ищет готовый ответ на тот же нормализованный вопрос при той же версии данных и дате.
+    Отметка попадания фиксируется вместе с сохранением реплик (persist_turn), отдельного коммита нет.
+    '''
+    cur.execute("""
+        UPDATE ai_response_cache
+        SET hits = hits + 1, last_hit_at = NOW()
+        WHERE owner_id = %s AND question_key = %s AND context_version = %s AND context_date = %s
+        RETURNING response
+    """, (owner_id, question_key, context_version, today))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def record_cache_lookup(cur, owner_id: int, hit: bool):
+    '''Добавляет попадание или промах в ai_response_cache_stats в текущей транзакции, без коммита'''
+    cur.execute("""
+        INSERT INTO ai_response_cache_stats (owner_id, hits, misses)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (owner_id) DO UPDATE SET
+            hits = ai_response_cache_stats.hits + EXCLUDED.hits,
+            misses = ai_response_cache_stats.misses + EXCLUDED.misses
+    """, (owner_id, 1 if hit else 0, 0 if hit else 1))
+
+
+def store_cached_response(cur, conn, owner_id: int, question_key: str, context_version: int,
+                          today: str, response: str):
+    '''
+    Сохраняет ответ в кэш и вытесняет записи по устаревшим данным и сверх лимита на владельца
+    '''
+    cur.execute("""
+        INSERT INTO ai_response_cache (owner_id, question_key, context_version, context_date, response)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (owner_id, question_key) DO UPDATE SET
+            context_version = EXCLUDED.context_version,
+            context_date = EXCLUDED.context_date,
+            response = EXCLUDED.response,
+            hits = 0,
+            created_at = NOW(),
+            last_hit_at = NOW()
+    """, (owner_id, question_key, context_version, today, response))
     
-    try:
-        # Статистика текущего месяца
-        cur.execute(f"""
-            SELECT COUNT(*), AVG(total_price), SUM(total_price)
-            FROM bookings b
-            JOIN units u ON b.unit_id = u.id
-            WHERE u.owner_id = {owner_id}
-            AND b.check_in >= DATE_TRUNC('month', CURRENT_DATE)
-            AND b.check_in < DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'
-            AND b.status = 'confirmed'
-        """)
-        
-        stats_row = cur.fetchone()
-        if stats_row:
-            confirmed_count = stats_row[0] or 0
-            
-            # Процент загрузки текущего месяца
-            try:
-                cur.execute(f"""
-                    SELECT COUNT(DISTINCT b.check_in)
-                    FROM bookings b
-                    JOIN units u ON b.unit_id = u.id
-                    WHERE u.owner_id = {owner_id}
-                    AND b.check_in >= DATE_TRUNC('month', CURRENT_DATE)
-                    AND b.check_in < DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '1 month'
-                    AND b.status = 'confirmed'
-                """)
-                
-                occupied_days = cur.fetchone()[0] or 0
-                now = datetime.now()
-                days_in_month = calendar.monthrange(now.year, now.month)[1]
-                occupancy_rate = (occupied_days / days_in_month * 100) if days_in_month > 0 else 0
-            except:
-                occupancy_rate = 0
-            
-            stats = {
-                'bookings_this_month': confirmed_count,
-                'avg_price': float(stats_row[1]) if stats_row[1] else 0,
-                'revenue_this_month': float(stats_row[2]) if stats_row[2] else 0,
-                'occupancy_rate': round(occupancy_rate, 1)
-            }
-    except:
-        pass
+    cur.execute("""
+        DELETE FROM ai_response_cache
+        WHERE owner_id = %(owner_id)s
+        AND (
+            context_version < %(version)s
+            OR context_date < %(today)s
+            OR question_key IN (
+                SELECT question_key FROM ai_response_cache
+                WHERE owner_id = %(owner_id)s
+                ORDER BY last_hit_at DESC
+                OFFSET %(limit)s
+            )
+        )
+    """, {'owner_id': owner_id, 'version': context_version, 'today': today, 'limit': RESPONSE_CACHE_MAX_ENTRIES})
+    conn.commit()
+
+
+def load_history_window(cur, conversation_id: int, user_message: str) -> tuple:
+    '''
+    Возвращает (сводка, окно сообщений для модели, пора ли сворачивать историю).
+    Окно заканчивается текущей репликой владельца (она ещё не сохранена), перед ней идут
+    последние сообщения после уже свёрнутой части — не больше HISTORY_MAX_MESSAGES
+    и в пределах HISTORY_TOKEN_BUDGET. Когда за окном накопилось SUMMARY_FOLD_MIN_MESSAGES
+    несвёрнутых сообщений, их сворачивает в сводку планировщик (fold_pending_summaries).
+    '''
+    window = [{'role': 'user', 'content': user_message}]
     
-    try:
-        # Настройки бота
-        cur.execute(f"""
-            SELECT bot_name, communication_style, reminder_enabled, reminder_days
-            FROM bot_settings
-            WHERE owner_id = {owner_id}
-        """)
-        
-        settings_row = cur.fetchone()
-        if settings_row:
-            bot_settings = {
-                'name': settings_row[0] or 'Ассистент',
-                'style': settings_row[1] or 'Дружелюбный',
-                'reminders': settings_row[2] if settings_row[2] is not None else True,
-                'reminder_days': settings_row[3] or 30
-            }
-    except:
-        pass
+    if not conversation_id:
+        return None, window, False
     
-    try:
-        # Ближайшие праздники
-        cur.execute(f"""
-            SELECT date, holiday_name
-            FROM production_calendar
-            WHERE date >= CURRENT_DATE AND is_holiday = true
-            ORDER BY date
-            LIMIT 5
-        """)
-        
-        for row in cur.fetchall():
-            try:
-                if row[0] and row[1]:
-                    holidays.append({'date': row[0].isoformat(), 'name': row[1]})
-            except:
-                continue
-    except:
-        pass
+    cur.execute(
+        "SELECT summary, summary_message_id FROM ai_conversations WHERE id = %s",
+        (conversation_id,)
+    )
+    row = cur.fetchone()
+    summary, summary_message_id = row if row else (None, None)
     
-    try:
-        # ИСТОРИЯ БРОНИРОВАНИЙ (последние 60 дней)
-        cur.execute(f"""
-            SELECT 
-                b.check_in,
-                b.check_out,
-                u.name as unit_name,
-                b.guest_name,
-                b.status,
-                b.total_price
-            FROM bookings b
-            JOIN units u ON b.unit_id = u.id
-            WHERE u.owner_id = {owner_id}
-            AND b.check_in >= CURRENT_DATE - INTERVAL '60 days'
-            AND b.check_in < CURRENT_DATE
-            AND b.status IN ('confirmed', 'completed', 'cancelled')
-            ORDER BY b.check_in DESC
-            LIMIT 50
-        """)
+    cur.execute("""
+        SELECT id, role, content FROM ai_messages
+        WHERE conversation_id = %s AND id > %s
+        ORDER BY id DESC
+        LIMIT %s
+    """, (conversation_id, summary_message_id or 0, HISTORY_MAX_MESSAGES + SUMMARY_FOLD_MIN_MESSAGES))
+    rows = cur.fetchall()
+    
+    window_rows = select_history_window(rows, estimate_tokens(user_message))
+    window.extend({'role': role, 'content': content} for _, role, content in window_rows)
+    window.reverse()
+    
+    return summary, window, len(rows) - len(window_rows) >= SUMMARY_FOLD_MIN_MESSAGES
+
+
+def select_history_window(rows: list, used_tokens: int) -> list:
+    '''
+    Из сообщений [(id, роль, текст)] от новых к старым берёт те, что войдут в окно истории
+    вместе с одной репликой владельца стоимостью used_tokens
+    '''
+    window_rows = []
+    for message_id, role, content in rows:
+        cost = estimate_tokens(content)
+        if len(window_rows) + 1 >= HISTORY_MAX_MESSAGES or used_tokens + cost > HISTORY_TOKEN_BUDGET:
+            break
+        window_rows.append((message_id, role, content))
+        used_tokens += cost
+    return window_rows
+
+
+def is_scheduler_request(event: dict) -> bool:
+    '''Проверяет секрет планировщика; без SCHEDULER_SECRET в окружении служебные действия закрыты'''
+    secret = os.environ.get('SCHEDULER_SECRET')
+    headers = event.get('headers') or {}
+    provided = headers.get('X-Scheduler-Secret') or headers.get('x-scheduler-secret') or ''
+    return bool(secret) and hmac.compare_digest(provided.encode('utf-8'), secret.encode('utf-8'))
+
+
+def archive_stale_conversations(cur, conn) -> int:
+    '''
+    Переносит разговоры без сообщений за последние CHAT_ARCHIVE_AFTER_DAYS дней в ai_conversations_archive:
+    вся переписка разговора ложится одним JSONB-значением (его сжимает TOAST), строки ai_messages удаляются.
+    Работает пачками, чтобы горячие таблицы не блокировались надолго.
+    '''
+    archived = 0
+    
+    for _ in range(CHAT_ARCHIVE_MAX_BATCHES):
+        cur.execute("""
+            WITH stale AS (
+                SELECT c.id
+                FROM ai_conversations c
+                WHERE c.created_at < NOW() - make_interval(days => %(days)s)
+                AND NOT EXISTS (
+                    SELECT 1 FROM ai_messages m
+                    WHERE m.conversation_id = c.id
+                    AND m.created_at >= NOW() - make_interval(days => %(days)s)
+                )
+                ORDER BY c.id
+                LIMIT %(batch)s
+                FOR UPDATE SKIP LOCKED
+            ),
+            archived AS (
+                INSERT INTO ai_conversations_archive (
+                    id, owner_id, context_type, summary, messages, message_count, created_at, last_message_at
+                )
+                SELECT
+                    c.id, c.owner_id, c.context_type, c.summary,
+                    COALESCE(h.messages, '[]'::jsonb), COALESCE(h.message_count, 0),
+                    c.created_at, h.last_message_at
+                FROM ai_conversations c
+                JOIN stale s ON s.id = c.id
+                LEFT JOIN LATERAL (
+                    SELECT
+                        jsonb_agg(jsonb_build_object(
+                            'id', m.id,
+                            'role', m.role,
+                            'content', m.content,
+                            'created_at', to_char(m.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+                        ) ORDER BY m.created_at, m.id) AS messages,
+                        COUNT(*) AS message_count,
+                        MAX(m.created_at) AS last_message_at
+                    FROM ai_messages m
+                    WHERE m.conversation_id = c.id
+                ) h ON true
+                ON CONFLICT (id) DO NOTHING
+                RETURNING id
+            ),
+            removed_messages AS (
+                DELETE FROM ai_messages WHERE conversation_id IN (SELECT id FROM archived)
+            )
+            DELETE FROM ai_conversations WHERE id IN (SELECT id FROM archived)
+        """, {'days': CHAT_ARCHIVE_AFTER_DAYS, 'batch': CHAT_ARCHIVE_BATCH_SIZE})
+        moved = cur.rowcount
+        conn.commit()
         
-        for row in cur.fetchall():
-            try:
-                past_bookings.append({
-                    'check_in': row[0].isoformat() if row[0] else 'н/д',
-                    'check_out': row[1].isoformat() if row[1] else 'н/д',
-                    'unit_name': row[2] or 'объект не найден',
-                    'guest_name': row[3] or 'не указано',
-                    'status': row[4] or 'unknown',
-                    'price': float(row[5]) if row[5] else 0
-                })
-            except:
-                continue
-    except:
-        pass
+        archived += moved
+        if moved < CHAT_ARCHIVE_BATCH_SIZE:
+            break
     
-    return {
-        'units': units,
-        'services': services,
-        'bookings': bookings,
-        'pending_bookings': pending_bookings,
-        'past_bookings': past_bookings,
-        'stats': stats,
-        'bot_settings': bot_settings,
-        'holidays': holidays,
-        'today': datetime.now().strftime('%Y-%m-%d')
-    }
+    return archived
 
 
-def build_system_prompt(context: dict) -> str:
-    '''Строит системный промпт с контекстом владельца. Безопасно обрабатывает пустые данные.'''
+def persist_turn(cur, conn, owner_id: int, conversation_id, user_message: str,
+                 assistant_message: str, metadata: dict = None, fold_due: bool = False,
+                 cache_lookup: bool = None) -> int:
+    '''
+    Сохраняет реплику владельца и ответ ассистента одной транзакцией, создавая разговор при необходимости.
+    С fold_due разговор отмечается для сворачивания истории планировщиком, cache_lookup (True/False)
+    в той же транзакции пишется в статистику кэша. Возвращает id разговора.
+    '''
+    if not conversation_id:
+        cur.execute("""
+            INSERT INTO ai_conversations (owner_id, context_type, status)
+            VALUES (%s, 'owner_chat', 'active')
+            RETURNING id
+        """, (owner_id,))
+        conversation_id = cur.fetchone()[0]
     
-    try:
-        units_text = '\n'.join([
-            f"- {u.get('name', 'Без названия')} ({u.get('type', 'Объект')}): {u.get('price', 0)}₽/ночь, до {u.get('max_guests', 1)} гостей"
-            for u in context.get('units', [])
-        ]) if context.get('units') else 'Объекты пока не добавлены'
-    except:
-        units_text = 'Объекты пока не добавлены'
+    # clock_timestamp() вычисляется для каждой строки, поэтому ответ всегда позже вопроса
+    cur.execute("""
+        INSERT INTO ai_messages (conversation_id, role, content, metadata, created_at)
+        VALUES (%s, 'user', %s, NULL, clock_timestamp()),
+               (%s, 'assistant', %s, %s, clock_timestamp())
+    """, (
+        conversation_id, user_message,
+        conversation_id, assistant_message, json.dumps(metadata) if metadata else None
+    ))
+    if fold_due:
+        cur.execute("""
+            UPDATE ai_conversations
+            SET summary_fold_requested_at = COALESCE(summary_fold_requested_at, NOW())
+            WHERE id = %s
+        """, (conversation_id,))
+    if cache_lookup is not None:
+        record_cache_lookup(cur, owner_id, cache_lookup)
+    conn.commit()
     
+    return conversation_id
+
+
+def fold_pending_summaries(cur, conn) -> int:
+    '''
+    Сворачивает историю отмеченных разговоров (summary_fold_requested_at) в накопительные сводки.
+    Вызов модели идёт здесь, а не в ответе владельцу. Возвращает число выполненных сворачиваний.
+    '''
+    cur.execute("""
+        SELECT id, owner_id FROM ai_conversations
+        WHERE summary_fold_requested_at IS NOT NULL
+        ORDER BY summary_fold_requested_at
+        LIMIT %s
+    """, (SUMMARY_FOLD_BATCH_CONVERSATIONS,))
+    due = cur.fetchall()
+    conn.commit()
+    
+    client = get_llm_client()
+    folded = 0
+    for conversation_id, owner_id in due:
+        try:
+            while fold_conversation_history(client, cur, conn, owner_id, conversation_id):
+                folded += 1
+        except Exception as e:
+            conn.rollback()
+            print(f'Ошибка сворачивания истории разговора {conversation_id}: {e}')
+    
+    return folded
+
+
+def fold_conversation_history(client, cur, conn, owner_id: int, conversation_id: int) -> bool:
+    '''
+    Сворачивает следующую пачку сообщений разговора: по порядку от уже свёрнутой части вверх,
+    не больше SUMMARY_FOLD_MAX_MESSAGES и не затрагивая окно свежих сообщений.
+    Когда сворачивать больше нечего, снимает отметку; возвращает True, если сводка обновлена.
+    '''
+    cur.execute(
+        "SELECT summary, summary_message_id FROM ai_conversations WHERE id = %s",
+        (conversation_id,)
+    )
+    row = cur.fetchone()
+    if not row:
+        conn.commit()
+        return False
+    summary, summary_message_id = row
+    
+    cur.execute("""
+        SELECT id, role, content FROM ai_messages
+        WHERE conversation_id = %s AND id > %s
+        ORDER BY id DESC
+        LIMIT %s
+    """, (conversation_id, summary_message_id or 0, HISTORY_MAX_MESSAGES))
+    recent = cur.fetchall()
+    window_rows = select_history_window(recent, 0)
+    
+    overflow = []
+    if recent:
+        window_start_id = window_rows[-1][0] if window_rows else recent[0][0]
+        cur.execute("""
+            SELECT id, role, content FROM ai_messages
+            WHERE conversation_id = %s AND id > %s AND id < %s
+            ORDER BY id
+            LIMIT %s
+        """, (conversation_id, summary_message_id or 0, window_start_id, SUMMARY_FOLD_MAX_MESSAGES))
+        overflow = cur.fetchall()
+    
+    if len(overflow) < SUMMARY_FOLD_MIN_MESSAGES:
+        cur.execute(
+            "UPDATE ai_conversations SET summary_fold_requested_at = NULL WHERE id = %s",
+            (conversation_id,)
+        )
+        conn.commit()
+        return False
+    conn.commit()
+    
+    return fold_history_into_summary(
+        client, cur, conn, owner_id, conversation_id, summary, summary_message_id, overflow
+    )
+
+
+def fold_history_into_summary(client, cur, conn, owner_id: int, conversation_id: int,
+                              summary: str, summary_message_id, overflow: list) -> bool:
+    '''
+    Сворачивает сообщения overflow (по порядку, сразу после summary_message_id) в накопительную сводку разговора.
+    Сводка не перезаписывается, если её успел обновить параллельный запуск; возвращает True, если обновлена.
+    '''
+    transcript = '\n'.join(
+        f"{'Владелец' if role == 'user' else 'Ассистент'}: {content}"
+        for _, role, content in overflow
+    )
+    
+    started = time.monotonic()
     try:
-        services_text = '\n'.join([
-            f"- {s.get('name', 'Услуга')} ({s.get('category', 'Прочее')}): {s.get('price', 0)}₽"
-            for s in context.get('services', [])
-        ]) if context.get('services') else 'Допродажи пока не добавлены'
-    except:
-        services_text = 'Допродажи пока не добавлены'
+        response = client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {
+                    'role': 'system',
+                    'content': 'Ты ведёшь краткое содержание разговора владельца турбазы с AI-ассистентом. '
+                               'Обнови сводку с учётом новых реплик. Сохрани факты, договорённости, даты, суммы '
+                               'и открытые вопросы. Не больше 10 предложений, без вступлений.'
+                },
+                {
+                    'role': 'user',
+                    'content': f"Текущая сводка:\n{summary or 'нет'}\n\nНовые реплики:\n{transcript}"
+                }
+            ],
+            temperature=0.2,
+            max_tokens=400
+        )
+        new_summary = response.choices[0].message.content
+    except Exception as e:
+        print(f'Ошибка сворачивания истории разговора {conversation_id}: {e}')
+        return False
+    
+    usage = getattr(response, 'usage', None)
+    record_llm_calls(cur, owner_id, [{
+        'model': SUMMARY_MODEL,
+        'purpose': 'summary',
+        'status': 'ok',
+        'latency_ms': int((time.monotonic() - started) * 1000),
+        'first_token_ms': None,
+        'prompt_tokens': usage.prompt_tokens if usage else None,
+        'completion_tokens': usage.completion_tokens if usage else None
+    }])
+    cur.execute("""
+        UPDATE ai_conversations
+        SET summary = %s, summary_message_id = %s, summary_updated_at = NOW()
+        WHERE id = %s AND summary_message_id IS NOT DISTINCT FROM %s
+    """, (new_summary, overflow[-1][0], conversation_id, summary_message_id))
+    updated = cur.rowcount == 1
+    conn.commit()
+    return updated
+
+
+def stream_chat_completion(client, llm_messages: list, cur, conn, owner_id: int,
+                           conversation_id: int, stream_id: str, llm_calls: list) -> str:
+    '''
+    Получает ответ модели потоково и периодически сохраняет накопленный текст в ai_message_streams,
+    откуда клиент забирает его поллингом chat-stream. Платформа функций отдаёт ответ целиком,
+    поэтому SSE недоступен и частичный результат публикуется через БД.
+    '''
+    cur.execute(
+        "DELETE FROM ai_message_streams WHERE created_at < NOW() - INTERVAL '1 day'"
+    )
+    cur.execute("""
+        INSERT INTO ai_message_streams (id, owner_id, conversation_id, content, status)
+        VALUES (%s, %s, %s, '', 'streaming')
+        ON CONFLICT (id) DO NOTHING
+    """, (stream_id, owner_id, conversation_id))
+    conn.commit()
+    
+    partial = {'content': '', 'flushed_at': time.monotonic()}
+    
+    def flush_partial(content: str):
+        partial['content'] = content
+        if time.monotonic() - partial['flushed_at'] < STREAM_FLUSH_SECONDS:
+            return
+        cur.execute("""
+            UPDATE ai_message_streams SET content = %s, updated_at = NOW()
+            WHERE id = %s AND owner_id = %s
+        """, (content, stream_id, owner_id))
+        conn.commit()
+        partial['flushed_at'] = time.monotonic()
     
-    # КРИТИЧНО: Календарь бронирований с защитой от ошибок
-    bookings_text = 'Ближайших бронирований нет'
     try:
-        parts = []
+        assistant_message = complete_with_tools(
+            client, llm_messages, cur, owner_id, llm_calls, on_delta=flush_partial
+        )
+    except Exception:
+        conn.rollback()
+        cur.execute("""
+            UPDATE ai_message_streams SET content = %s, status = 'error', updated_at = NOW()
+            WHERE id = %s AND owner_id = %s
+        """, (partial['content'], stream_id, owner_id))
+        conn.commit()
+        raise
+    
+    cur.execute("""
+        UPDATE ai_message_streams SET content = %s, status = 'done', updated_at = NOW()
+        WHERE id = %s AND owner_id = %s
+    """, (assistant_message, stream_id, owner_id))
+    conn.commit()
+    
+    return assistant_message
+
+
+def complete_with_tools(client, llm_messages: list, cur, owner_id: int, llm_calls: list, on_delta=None) -> str:
+    '''
+    Получает ответ модели с вызовом инструментов данных владельца (tools.py).
+    Модель сама запрашивает нужные брони, выручку или гостей; инструменты выполняются
+    на курсоре текущего запроса. Ответ читается потоково, on_delta получает накопленный текст.
+    Метрики каждого обращения к модели добавляются в llm_calls.
+    '''
+    messages = list(llm_messages)
+    parts = []
+    
+    for round_number in range(TOOL_MAX_ROUNDS):
+        # В последнем раунде инструменты запрещены, чтобы модель точно дала ответ
+        tool_choice = 'none' if round_number == TOOL_MAX_ROUNDS - 1 else 'auto'
+        round_start = len(parts)
+        model = choose_chat_model()
         
-        if context.get('bookings'):
-            parts.append('✅ ПОДТВЕРЖДЁННЫЕ БРОНИРОВАНИЯ:')
-            for b in context['bookings']:
-                try:
-                    line = f"- {b.get('check_in', 'н/д')} → {b.get('check_out', 'н/д')}: {b.get('unit_name', 'объект')}, {b.get('guest_name', 'не указано')}, {b.get('price', 0):.0f}₽"
-                    parts.append(line)
-                except:
-                    continue
+        try:
+            round_text, tool_calls = stream_completion_round(
+                client, model, messages, tool_choice, parts, on_delta, llm_calls
+            )
+        except LLM_TRANSIENT_ERRORS:
+            if model == LLM_FALLBACK_MODEL:
+                raise
+            # Основная модель не уложилась в таймаут или оборвала поток — раунд повторяется на быстрой модели
+            del parts[round_start:]
+            if on_delta:
+                on_delta(''.join(parts))
+            round_text, tool_calls = stream_completion_round(
+                client, LLM_FALLBACK_MODEL, messages, tool_choice, parts, on_delta, llm_calls
+            )
         
-        if context.get('pending_bookings'):
-            parts.append('\n⏳ ЗАЯВКИ БЕЗ ОПЛАТЫ (ОЖИДАЮТ ПОДТВЕРЖДЕНИЯ):')
-            for pb in context['pending_bookings']:
-                try:
-                    expires = pb.get('expires_at', 'н/д')
-                    line = f"- {pb.get('check_in', 'н/д')} → {pb.get('check_out', 'н/д')}: {pb.get('unit_name', 'объект')}, {pb.get('guest_name', 'не указано')}, {pb.get('amount', 0):.0f}₽, истекает {expires}"
-                    parts.append(line)
-                except:
-                    continue
+        if not tool_calls:
+            break
         
-        if parts:
-            bookings_text = '\n'.join(parts)
-    except:
-        pass
+        messages.append({
+            'role': 'assistant',
+            'content': round_text or None,
+            'tool_calls': [
+                {
+                    'id': call['id'],
+                    'type': 'function',
+                    'function': {'name': call['name'], 'arguments': call['arguments'] or '{}'}
+                }
+                for call in tool_calls
+            ]
+        })
+        for call in tool_calls:
+            messages.append({
+                'role': 'tool',
+                'tool_call_id': call['id'],
+                'content': execute_tool(cur, owner_id, call['name'], call['arguments'])
+            })
+    
+    return ''.join(parts)
+
+
+def stream_completion_round(client, model: str, messages: list, tool_choice: str,
+                            parts: list, on_delta, llm_calls: list) -> tuple:
+    '''
+    Одно потоковое обращение к модели. Текст дописывается в parts, возвращается
+    (текст раунда, вызовы инструментов). Задержка и токены записываются в llm_calls.
+    '''
+    started = time.monotonic()
+    metric = {
+        'model': model,
+        'purpose': 'chat',
+        'latency_ms': None,
+        'first_token_ms': None,
+        'prompt_tokens': None,
+        'completion_tokens': None,
+        'status': 'ok'
+    }
+    llm_calls.append(metric)
     
-    # История бронирований
-    past_bookings_text = 'История за последние 60 дней пуста'
+    round_parts = []
+    tool_calls = {}
     try:
-        if context.get('past_bookings'):
-            past_lines = []
-            for b in context['past_bookings'][:20]:  # Ограничим вывод 20 записями
-                try:
-                    status_emoji = {
-                        'confirmed': '✓',
-                        'completed': '✓',
-                        'cancelled': '✗'
-                    }.get(b.get('status'), '?')
-                    
-                    line = f"{status_emoji} {b.get('check_in', 'н/д')} → {b.get('check_out', 'н/д')}: {b.get('unit_name', 'объект')}, {b.get('guest_name', 'не указано')}, {b.get('price', 0):.0f}₽"
-                    past_lines.append(line)
-                except:
-                    continue
-            
-            if past_lines:
-                past_bookings_text = '\n'.join(past_lines)
-    except:
-        pass
+        # У основной модели есть запасная: вместо повтора с тем же таймаутом сразу переходим на неё
+        retries = LLM_MAX_RETRIES if model == LLM_FALLBACK_MODEL else 0
+        response = client.with_options(max_retries=retries).chat.completions.create(
+            model=model,
+            messages=messages,
+            tools=CHAT_TOOLS,
+            tool_choice=tool_choice,
+            temperature=0.7,
+            max_tokens=800,
+            stream=True,
+            stream_options={'include_usage': True}
+        )
+        
+        for chunk in response:
+            # Usage приходит последним чанком без choices
+            if getattr(chunk, 'usage', None):
+                metric['prompt_tokens'] = chunk.usage.prompt_tokens
+                metric['completion_tokens'] = chunk.usage.completion_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            
+            if metric['first_token_ms'] is None and (delta.content or delta.tool_calls):
+                metric['first_token_ms'] = int((time.monotonic() - started) * 1000)
+            
+            if delta.content:
+                round_parts.append(delta.content)
+                parts.append(delta.content)
+                if on_delta:
+                    on_delta(''.join(parts))
+            
+            # Аргументы вызова приходят кусками, собираем их по индексу вызова
+            for call in delta.tool_calls or []:
+                entry = tool_calls.setdefault(call.index, {'id': '', 'name': '', 'arguments': ''})
+                if call.id:
+                    entry['id'] = call.id
+                if call.function and call.function.name:
+                    entry['name'] += call.function.name
+                if call.function and call.function.arguments:
+                    entry['arguments'] += call.function.arguments
+    except Exception as e:
+        # Обрыв во время чтения потока приходит исключением httpx, а не openai
+        metric['status'] = 'timeout' if isinstance(e, (openai.APITimeoutError, httpx.TimeoutException)) else 'error'
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        metric['latency_ms'] = int(elapsed * 1000)
+        note_model_latency(model, elapsed, failed=metric['status'] != 'ok')
+    
+    return ''.join(round_parts), [tool_calls[index] for index in sorted(tool_calls)]
+
+
+def get_llm_client():
+    '''
+    Клиент Polza.ai (OpenAI-совместимый) на весь тёплый инстанс: HTTP-соединения
+    переиспользуются между запросами, таймауты не дают зависнуть на медленном провайдере.
+    '''
+    global LLM_CLIENT
+    if LLM_CLIENT is None:
+        timeout = httpx.Timeout(LLM_READ_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS)
+        LLM_CLIENT = openai.OpenAI(
+            base_url='https://api.polza.ai/api/v1',
+            api_key=os.environ.get('POLZA_AI_API_KEY'),
+            timeout=timeout,
+            max_retries=LLM_MAX_RETRIES,
+            http_client=httpx.Client(
+                timeout=timeout,
+                limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=LLM_KEEPALIVE_SECONDS)
+            )
+        )
+    return LLM_CLIENT
+
+
+def choose_chat_model() -> str:
+    '''Пока основная модель нарушает SLO по задержке, ответы идут через быструю модель'''
+    if time.monotonic() < LLM_HEALTH['degraded_until']:
+        return LLM_FALLBACK_MODEL
+    return LLM_PRIMARY_MODEL
+
+
+def note_model_latency(model: str, elapsed: float, failed: bool = False):
+    if model == LLM_PRIMARY_MODEL and (failed or elapsed > LLM_LATENCY_SLO_SECONDS):
+        LLM_HEALTH['degraded_until'] = time.monotonic() + LLM_FALLBACK_COOLDOWN_SECONDS
+
+
+def record_llm_calls(cur, owner_id: int, llm_calls: list):
+    '''Записывает метрики обращений к модели; коммит — вместе с сохранением реплик'''
+    if not llm_calls:
+        return
+    
+    cur.executemany("""
+        INSERT INTO ai_llm_calls (
+            owner_id, model, purpose, status, latency_ms, first_token_ms, prompt_tokens, completion_tokens
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, [
+        (
+            owner_id, call['model'], call['purpose'], call['status'], call['latency_ms'],
+            call['first_token_ms'], call['prompt_tokens'], call['completion_tokens']
+        )
+        for call in llm_calls
+    ])
+
+
+def get_owner_data_version(cur, owner_id: int) -> int:
+    cur.execute("SELECT version FROM owner_data_versions WHERE owner_id = %s", (owner_id,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def get_owner_context_cached(cur, owner_id: int) -> tuple:
+    '''
+    Возвращает (контекст, версия данных) владельца из снимка, если данные не менялись.
+    Снимок живёт в памяти тёплого инстанса и в таблице owner_context_snapshots между холодными стартами;
+    тяжёлый запрос контекста выполняется только при смене версии, по TTL или со сменой дня.
+    '''
+    today = datetime.now().strftime('%Y-%m-%d')
+    cached = OWNER_CONTEXT_CACHE.get(owner_id)
+    
+    if cached and time.monotonic() - cached['cached_at'] < OWNER_CONTEXT_TTL_SECONDS:
+        version = get_owner_data_version(cur, owner_id)
+        if cached['version'] == version and cached['context'].get('today') == today:
+            return cached['context'], version
+    
+    cur.execute("""
+        SELECT COALESCE(v.version, 0), s.version, s.context
+        FROM (SELECT %(owner_id)s::integer AS owner_id) o
+        LEFT JOIN owner_data_versions v ON v.owner_id = o.owner_id
+        LEFT JOIN owner_context_snapshots s ON s.owner_id = o.owner_id
+            AND s.built_at > NOW() - make_interval(secs => %(ttl)s)
+    """, {'owner_id': owner_id, 'ttl': OWNER_CONTEXT_TTL_SECONDS})
+    version, snapshot_version, snapshot = cur.fetchone()
+    
+    if snapshot is not None and snapshot_version == version and snapshot.get('today') == today:
+        remember_owner_context(owner_id, version, snapshot)
+        return snapshot, version
+    
+    context = get_owner_context(cur, owner_id)
+    remember_owner_context(owner_id, version, context)
     
     try:
-        holidays_text = '\n'.join([
+        cur.execute("""
+            INSERT INTO owner_context_snapshots (owner_id, version, context, built_at)
+            VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (owner_id) DO UPDATE SET
+                version = EXCLUDED.version,
+                context = EXCLUDED.context,
+                built_at = EXCLUDED.built_at
+        """, (owner_id, version, json.dumps(context, ensure_ascii=False)))
+        cur.connection.commit()
+    except psycopg2.Error as e:
+        print(f'Ошибка сохранения снимка контекста владельца {owner_id}: {e}')
+        cur.connection.rollback()
+    
+    return context, version
+
+
+def remember_owner_context(owner_id: int, version: int, context: dict):
+    if owner_id not in OWNER_CONTEXT_CACHE and len(OWNER_CONTEXT_CACHE) >= OWNER_CONTEXT_CACHE_MAX_OWNERS:
+        OWNER_CONTEXT_CACHE.pop(next(iter(OWNER_CONTEXT_CACHE)))
+    OWNER_CONTEXT_CACHE[owner_id] = {
+        'version': version,
+        'context': context,
+        'cached_at': time.monotonic()
+    }
+
+
+def estimate_tokens(text: str) -> int:
+    '''Грубая оценка числа токенов: для смешанного русского/английского текста ~3 символа на токен'''
+    return len(text) // 3 + 1
+
+
+def fit_lines(lines: list, budget: int) -> tuple:
+    '''
+    Берёт строки раздела, пока они укладываются в бюджет токенов.
+    Возвращает (строки, израсходованные токены); обрезанный раздел помечается строкой-счётчиком.
+    '''
+    kept = []
+    used = 0
+    for index, line in enumerate(lines):
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            kept.append(f'…и ещё {len(lines) - index} (не показаны из-за лимита контекста)')
+            used += estimate_tokens(kept[-1])
+            break
+        kept.append(line)
+        used += cost
+    return kept, used
+
+
+def build_system_prompt(context: dict, summary: str = None) -> str:
+    '''
+    Строит системный промпт с контекстом владельца. Безопасно обрабатывает пустые данные.
+    Разделы с данными заполняются по приоритету в пределах CONTEXT_TOKEN_BUDGET,
+    поэтому размер промпта не растёт вместе с бизнесом владельца.
+    '''
+    section_lines = {
+        'units': [
+            f"- {u.get('name', 'Без названия')} ({u.get('type', 'Объект')}): {u.get('price', 0)}₽/ночь, до {u.get('max_guests', 1)} гостей"
+            for u in context.get('units') or []
+        ],
+        'services': [
+            f"- {s.get('name', 'Услуга')} ({s.get('category', 'Прочее')}): {s.get('price', 0)}₽"
+            for s in context.get('services') or []
+        ],
+        'holidays': [
             f"- {h.get('date', 'н/д')}: {h.get('name', 'Праздник')}"
-            for h in context.get('holidays', [])
-        ]) if context.get('holidays') else 'Праздников в ближайшее время нет'
-    except:
-        holidays_text = 'Праздников в ближайшее время нет'
+            for h in context.get('holidays') or []
+        ]
+    }
+    
+    # Чем выше раздел в списке, тем раньше он получает бюджет
+    remaining = CONTEXT_TOKEN_BUDGET
+    fitted = {}
+    for section in ('units', 'services', 'holidays'):
+        fitted[section], used = fit_lines(section_lines[section], remaining)
+        remaining = max(0, remaining - used)
+    
+    units_text = '\n'.join(fitted['units']) or 'Объекты пока не добавлены'
+    services_text = '\n'.join(fitted['services']) or 'Допродажи пока не добавлены'
+    holidays_text = '\n'.join(fitted['holidays']) or 'Праздников в ближайшее время нет'
+    
+    summary_text = summary or 'Нет — вся переписка приведена в сообщениях ниже'
     
     bot_name = context.get('bot_settings', {}).get('name', 'Ассистент')
     style = context.get('bot_settings', {}).get('style', 'Дружелюбный')
@@ -820,89 +1599,72 @@ def build_system_prompt(context: dict) -> str:
 ДОПРОДАЖИ:
 {services_text}
 
-КАЛЕНДАРЬ БУДУЩИХ БРОНИРОВАНИЙ (от {today}):
-{bookings_text}
-
-ИСТОРИЯ БРОНИРОВАНИЙ (последние 60 дней до {today}):
-{past_bookings_text}
-
 СТАТИСТИКА ТЕКУЩЕГО МЕСЯЦА:
 - Подтверждённых броней: {bookings_count}
-- Загрузка: {occupancy}%
+- Загрузка: {occupancy}% (занятые ночи / доступные ночи всех объектов)
 - Средний чек: {avg_price:.0f}₽
 - Выручка: {revenue:.0f}₽
 
 БЛИЖАЙШИЕ ПРАЗДНИКИ:
 {holidays_text}
 
+КРАТКОЕ СОДЕРЖАНИЕ БОЛЕЕ РАННЕЙ ЧАСТИ РАЗГОВОРА:
+{summary_text}
+
 ═══════════════════════════════════
 ПРАВИЛА РАБОТЫ С ДАННЫМИ
 ═══════════════════════════════════
 
-1. ВРЕМЕННЫЕ РАМКИ:
-   - Ты видишь будущие бронирования (от {today})
-   - Ты видишь историю бронирований за последние 60 дней (до {today})
-   - История используется ТОЛЬКО для ответов владельцу
-
-2. ВОПРОСЫ О ПРОШЛЫХ ДАТАХ:
-   
-   ЕСЛИ дата входит в последние 60 дней:
-   → Ищи в разделе "ИСТОРИЯ БРОНИРОВАНИЙ"
-   → Если найдено — отвечай конкретно: «[дата]: [объект], гость [имя], статус [статус]»
-   → Если не найдено — «В эту дату бронирований не было»
-   
-   ЕСЛИ дата старше 60 дней:
-   → «Эта бронь вне доступной истории. Можно посмотреть в разделе "Заявки".»
+1. ИНСТРУМЕНТЫ — ЕДИНСТВЕННЫЙ ИСТОЧНИК ДАННЫХ О БРОНЯХ:
+   - get_availability(date_from, date_to, unit_name) — занятость и подтверждённые брони за период
+     (в прошлом или будущем): "свободно ли", "кто заезжает", "какие брони на выходные"
+   - get_revenue(date_from, date_to) — выручка, число броней и средний чек за период
+   - find_guest(query) — брони гостя по имени или телефону
+   - get_pending_bookings() — заявки без оплаты, ожидающие подтверждения
+   - Даты передавай в формате YYYY-MM-DD, date_to не включительно
+   - Относительные даты ("завтра", "на выходных", "в прошлом месяце") считай от {today}
+   - Перед ответом о бронях, датах, выручке или гостях ВСЕГДА вызывай инструмент,
+     не отвечай по памяти и не по предыдущим сообщениям
 
-3. ВОПРОСЫ О БУДУЩИХ ДАТАХ (дата >= {today}):
-   - Используй ТОЛЬКО данные из раздела "КАЛЕНДАРЬ БУДУЩИХ БРОНИРОВАНИЙ"
-   - Если даты нет в списке → бронирований на эту дату НЕТ
-   - Отвечай уверенно и конкретно
-
-4. КРИТИЧНО — РАЗЛИЧАЙ СТАТУСЫ БРОНИРОВАНИЙ:
+2. КРИТИЧНО — РАЗЛИЧАЙ СТАТУСЫ БРОНИРОВАНИЙ:
    
-   ✅ ПОДТВЕРЖДЁННЫЕ БРОНИРОВАНИЯ (confirmed):
+   ✅ ПОДТВЕРЖДЁННЫЕ БРОНИРОВАНИЯ (get_availability):
    - Оплачены и подтверждены
    - Занимают даты в календаре
    - При вопросе "Есть ли брони?" — учитывай ТОЛЬКО эти
    
-   ⏳ ЗАЯВКИ БЕЗ ОПЛАТЫ (pending_bookings):
+   ⏳ ЗАЯВКИ БЕЗ ОПЛАТЫ (get_pending_bookings):
    - НЕ оплачены, ждут подтверждения оплаты
    - НЕ занимают даты в календаре
    - Имеют срок действия (expires_at)
    - При вопросе "Есть ли заявки без оплаты?" — показывай ТОЛЬКО эти
-   - При вопросе "Свободны ли даты?" — НЕ учитывай pending (это НЕ брони!)
-   
-   ПРАВИЛО: НИКОГДА не говори "заявок нет", если в разделе "ЗАЯВКИ БЕЗ ОПЛАТЫ" есть записи!
+   - При вопросе "Свободны ли даты?" — НЕ учитывай заявки (это НЕ брони!)
 
-5. ЗАПРЕЩЁННЫЕ ФРАЗЫ:
+3. ЗАПРЕЩЁННЫЕ ФРАЗЫ:
    ❌ "у меня нет доступа к календарю"
    ❌ "возможно", "может быть", "скорее всего"
    ❌ "данные могут быть неточными"
    ❌ "проверьте в системе"
-   ❌ "заявок нет" (если есть pending_bookings)
    
-   ✅ Если данных нет — говори прямо: "Бронирований не было", "Объекты не добавлены"
+   ✅ Если инструмент вернул пустой список — говори прямо: "Бронирований не было", "Заявок нет"
 
-6. ДОСТОВЕРНОСТЬ:
-   - Ты ВСЕГДА видишь актуальный календарь будущих бронирований
-   - Ты ВСЕГДА видишь ВСЕ заявки без оплаты (pending_bookings)
-   - Ты ВСЕГДА видишь историю за последние 60 дней
+4. ДОСТОВЕРНОСТЬ:
    - НЕ выдумывай цифры, даты, имена гостей
    - НЕ используй процент загрузки для ответов о конкретных датах
-   - Называй КОНКРЕТНЫЕ даты, суммы, имена из календаря или истории
+   - Называй КОНКРЕТНЫЕ даты, суммы, имена из результатов инструментов
+   - Если инструмент вернул error — исправь аргументы и вызови его снова
 
-7. СТАТИСТИКА:
+5. СТАТИСТИКА:
    - Процент загрузки — это агрегат, НЕ список конкретных дат
    - НЕ упоминай "загрузка включает прошлые брони"
    - НЕ связывай процент с конкретными прошедшими датами
-   - Для ответов о конкретных датах используй ТОЛЬКО историю бронирований
+   - Для ответов о конкретных датах используй ТОЛЬКО инструменты
 
 ═══════════════════════════════════
 ТВОИ ЗАДАЧИ
 ═══════════════════════════════════
 
-1. Отвечай на вопросы о будущих бронированиях — по данным календаря выше
+1. Отвечай на вопросы о бронированиях, выручке и гостях — через инструменты
 2. Показывай заявки без оплаты при запросе владельца
 3. Анализируй загрузку и давай советы по оптимизации
 4. Напоминай о праздниках и предлагай акции
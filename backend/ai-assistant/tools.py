@@ -0,0 +1,234 @@
+'''Инструменты данных владельца для function calling AI-ассистента: узкие индексируемые запросы по его объектам'''
+import json
+from datetime import datetime, timedelta
+
+import psycopg2
+
+MAX_RANGE_DAYS = 366
+MAX_ROWS = 50
+# Короче трёх символов подстроку не ищет триграммный индекс (V0056)
+GUEST_QUERY_MIN_LENGTH = 3
+
+CHAT_TOOLS = [
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_availability',
+            'description': 'Занятость объектов за период: подтверждённые брони (даты, гость, сумма) по каждому объекту '
+                           'и признак, свободен ли объект весь период. Используй для вопросов о свободных датах, '
+                           'заездах, выездах и бронях на конкретные даты (в прошлом или будущем).',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'date_from': {'type': 'string', 'description': 'Начало периода, YYYY-MM-DD'},
+                    'date_to': {'type': 'string', 'description': 'Конец периода (не включительно), YYYY-MM-DD'},
+                    'unit_name': {'type': 'string', 'description': 'Название объекта, если вопрос про один объект'}
+                },
+                'required': ['date_from', 'date_to']
+            }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_revenue',
+            'description': 'Выручка за период по подтверждённым броням с заездом в периоде: число броней, '
+                           'выручка, средний чек, разбивка по объектам.',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'date_from': {'type': 'string', 'description': 'Начало периода, YYYY-MM-DD'},
+                    'date_to': {'type': 'string', 'description': 'Конец периода (не включительно), YYYY-MM-DD'}
+                },
+                'required': ['date_from', 'date_to']
+            }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'find_guest',
+            'description': 'Поиск броней гостя по имени или телефону (последние 50 броней).',
+            'parameters': {
+                'type': 'object',
+                'properties': {
+                    'query': {'type': 'string', 'description': 'Имя, часть имени или телефон гостя (от 3 символов)'}
+                },
+                'required': ['query']
+            }
+        }
+    },
+    {
+        'type': 'function',
+        'function': {
+            'name': 'get_pending_bookings',
+            'description': 'Заявки без оплаты, ожидающие подтверждения (не занимают даты в календаре).',
+            'parameters': {'type': 'object', 'properties': {}}
+        }
+    }
+]
+
+
+def execute_tool(cur, owner_id: int, name: str, arguments: str) -> str:
+    '''Выполняет инструмент и возвращает JSON-строку для модели; ошибки аргументов и БД уходят модели как {'error': ...}'''
+    try:
+        args = json.loads(arguments or '{}')
+    except json.JSONDecodeError:
+        return json.dumps({'error': 'Аргументы должны быть JSON-объектом'}, ensure_ascii=False)
+
+    executors = {
+        'get_availability': get_availability,
+        'get_revenue': get_revenue,
+        'find_guest': find_guest,
+        'get_pending_bookings': get_pending_bookings
+    }
+    executor = executors.get(name)
+    if not executor:
+        return json.dumps({'error': f'Неизвестный инструмент {name}'}, ensure_ascii=False)
+
+    try:
+        result = executor(cur, owner_id, **args)
+    except (TypeError, ValueError) as e:
+        return json.dumps({'error': str(e)}, ensure_ascii=False)
+    except psycopg2.Error as e:
+        # Транзакция после ошибки запроса сломана: откатываем, чтобы следующие инструменты и сохранение ответа работали
+        print(f'Ошибка инструмента {name} владельца {owner_id}: {e}')
+        cur.connection.rollback()
+        return json.dumps({'error': 'Не удалось получить данные, попробуй другой запрос'}, ensure_ascii=False)
+
+    return json.dumps(result, ensure_ascii=False, default=str)
+
+
+def parse_period(date_from: str, date_to: str) -> tuple:
+    start = datetime.strptime(date_from, '%Y-%m-%d').date()
+    end = datetime.strptime(date_to, '%Y-%m-%d').date()
+    if end <= start:
+        end = start + timedelta(days=1)
+    if (end - start).days > MAX_RANGE_DAYS:
+        raise ValueError(f'Период не может быть длиннее {MAX_RANGE_DAYS} дней')
+    return start, end
+
+
+def get_availability(cur, owner_id: int, date_from: str, date_to: str, unit_name: str = None) -> dict:
+    start, end = parse_period(date_from, date_to)
+
+    cur.execute("""
+        SELECT u.id, u.name, b.check_in, b.check_out, b.guest_name, b.total_price
+        FROM units u
+        LEFT JOIN bookings b ON b.unit_id = u.id
+            AND b.status = 'confirmed'
+            AND b.check_in < %(end)s
+            AND b.check_out > %(start)s
+        WHERE u.owner_id = %(owner_id)s
+        AND (%(unit_name)s::text IS NULL OR LOWER(u.name) = LOWER(%(unit_name)s::text))
+        ORDER BY u.id, b.check_in
+    """, {'owner_id': owner_id, 'start': start, 'end': end, 'unit_name': unit_name})
+
+    units = {}
+    for unit_id, name, check_in, check_out, guest_name, total_price in cur.fetchall():
+        unit = units.setdefault(unit_id, {'unit': name, 'bookings': []})
+        if check_in and len(unit['bookings']) < MAX_ROWS:
+            unit['bookings'].append({
+                'check_in': check_in.isoformat(),
+                'check_out': check_out.isoformat(),
+                'guest_name': guest_name,
+                'price': float(total_price or 0)
+            })
+
+    for unit in units.values():
+        unit['free_whole_period'] = not unit['bookings']
+
+    return {'date_from': start.isoformat(), 'date_to': end.isoformat(), 'units': list(units.values())}
+
+
+def get_revenue(cur, owner_id: int, date_from: str, date_to: str) -> dict:
+    start, end = parse_period(date_from, date_to)
+
+    cur.execute("""
+        SELECT u.name, COUNT(b.id), COALESCE(SUM(b.total_price), 0)
+        FROM bookings b
+        JOIN units u ON b.unit_id = u.id
+        WHERE u.owner_id = %s
+        AND b.status = 'confirmed'
+        AND b.check_in >= %s AND b.check_in < %s
+        GROUP BY u.name
+        ORDER BY 3 DESC
+    """, (owner_id, start, end))
+
+    by_unit = [
+        {'unit': name, 'bookings': count, 'revenue': float(revenue)}
+        for name, count, revenue in cur.fetchall()
+    ]
+    bookings_count = sum(row['bookings'] for row in by_unit)
+    revenue = sum(row['revenue'] for row in by_unit)
+
+    return {
+        'date_from': start.isoformat(),
+        'date_to': end.isoformat(),
+        'bookings': bookings_count,
+        'revenue': revenue,
+        'avg_price': round(revenue / bookings_count, 2) if bookings_count else 0,
+        'by_unit': by_unit
+    }
+
+
+def find_guest(cur, owner_id: int, query: str) -> dict:
+    query = (query or '').strip()
+    if len(query) < GUEST_QUERY_MIN_LENGTH:
+        raise ValueError(f'Запрос должен содержать хотя бы {GUEST_QUERY_MIN_LENGTH} символа')
+
+    cur.execute("""
+        SELECT b.guest_name, b.guest_phone, u.name, b.check_in, b.check_out, b.status, b.total_price
+        FROM bookings b
+        JOIN units u ON b.unit_id = u.id
+        WHERE u.owner_id = %s
+        AND (b.guest_name ILIKE %s OR b.guest_phone LIKE %s)
+        ORDER BY b.check_in DESC
+        LIMIT %s
+    """, (owner_id, f'%{query}%', f'%{query}%', MAX_ROWS))
+
+    return {
+        'bookings': [
+            {
+                'guest_name': guest_name,
+                'guest_phone': guest_phone or '',
+                'unit': unit_name,
+                'check_in': check_in.isoformat(),
+                'check_out': check_out.isoformat(),
+                'status': status,
+                'price': float(total_price or 0)
+            }
+            for guest_name, guest_phone, unit_name, check_in, check_out, status, total_price in cur.fetchall()
+        ]
+    }
+
+
+def get_pending_bookings(cur, owner_id: int) -> dict:
+    cur.execute("""
+        SELECT pb.id, u.name, pb.check_in, pb.check_out, pb.guest_name, pb.guest_contact,
+               pb.amount, pb.expires_at
+        FROM pending_bookings pb
+        JOIN units u ON pb.unit_id = u.id
+        WHERE u.owner_id = %s
+        AND pb.verification_status = 'pending'
+        AND pb.expires_at > CURRENT_TIMESTAMP
+        ORDER BY pb.created_at DESC
+        LIMIT %s
+    """, (owner_id, MAX_ROWS))
+
+    return {
+        'pending_bookings': [
+            {
+                'id': pending_id,
+                'unit': unit_name,
+                'check_in': check_in.isoformat() if check_in else None,
+                'check_out': check_out.isoformat() if check_out else None,
+                'guest_name': guest_name,
+                'guest_contact': guest_contact or '',
+                'amount': float(amount or 0),
+                'expires_at': expires_at.isoformat() if expires_at else None
+            }
+            for pending_id, unit_name, check_in, check_out, guest_name, guest_contact, amount, expires_at
+            in cur.fetchall()
+        ]
+    }
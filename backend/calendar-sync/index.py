@@ -1,15 +1,50 @@
+import hmac
+import html
 import json
 import os
 import psycopg2
 from datetime import datetime, timedelta
 import requests
 import re
+import hashlib
+import random
+import time
+
+# Кэш iCal-экспорта по объектам на тёплом инстансе функции: unit_id -> {etag, ical}
+EXPORT_CACHE = {}
+EXPORT_CACHE_MAX_UNITS = 500
+# Размер пачки строк серверного курсора при выгрузке общего календаря владельца
+OWNER_EXPORT_FETCH_SIZE = 500
+
+PLATFORM_NAMES = {
+    'avito': 'Авито',
+    'yandex': 'Яндекс Путешествия',
+    'booking': 'Booking.com'
+}
+
+# Уведомления владельцам отправляются из outbox после коммита, записи одного чата — одним сообщением
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BATCH_SIZE = 50
+TELEGRAM_MESSAGE_MAX_CHARS = 4096
+DIGEST_MAX_ITEMS = 20
+
+# Адаптивное расписание опроса внешних календарей (минуты)
+SYNC_BASE_INTERVAL_MINUTES = 30
+SYNC_MIN_INTERVAL_MINUTES = 10
+SYNC_MAX_INTERVAL_MINUTES = 24 * 60
+SYNC_JITTER_RATIO = 0.2
+SYNC_LEASE_MINUTES = 10
+SYNC_SCHEDULER_BATCH = 20
+SYNC_RUNS_RETENTION_DAYS = 90
+
+# Служебные действия: вызываются планировщиком и мониторингом с заголовком X-Scheduler-Secret = SCHEDULER_SECRET
+SCHEDULER_ACTIONS = {'calendar-sync-due', 'calendar-sync-metrics'}
 
 def handler(event: dict, context) -> dict:
     '''
     API для синхронизации календарей бронирования с внешними площадками (Авито, Яндекс Путешествия).
     Импортирует занятые даты через iCal, экспортирует наш календарь в iCal формате.
-    Автосинхронизация каждые 30 минут через frontend.
+    Автосинхронизация — серверный планировщик calendar-sync-due с адаптивным интервалом по каждому фиду.
     '''
     method = event.get('httpMethod', 'GET')
     
@@ -36,35 +71,24 @@ def handler(event: dict, context) -> dict:
         if method == 'GET' and action == 'calendar-export':
             unit_id = query_params.get('unit_id')
             
-            if not unit_id:
+            if not unit_id or not str(unit_id).isdigit():
                 return error_response('unit_id обязателен', 400)
             
-            cur.execute(f"""
-                SELECT check_in, check_out, guest_name, id
-                FROM bookings
-                WHERE unit_id = {unit_id} 
-                AND status IN ('confirmed', 'pending')
-                AND check_out >= CURRENT_DATE
-                ORDER BY check_in
-            """)
+            unit_id = int(unit_id)
+            return calendar_export_response(cur, unit_id, event.get('headers') or {})
+        
+        if method == 'GET' and action == 'calendar-export-owner':
+            owner_id = query_params.get('owner_id')
             
-            bookings = cur.fetchall()
-            ical = generate_ical(bookings, unit_id)
+            if not owner_id or not str(owner_id).isdigit():
+                return error_response('owner_id обязателен', 400)
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'text/calendar; charset=utf-8',
-                    'Content-Disposition': f'inline; filename="calendar_{unit_id}.ics"',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': ical,
-                'isBase64Encoded': False
-            }
+            return calendar_export_owner_response(conn, cur, int(owner_id), event.get('headers') or {})
         
         if method == 'GET' and action == 'calendar-sync-list':
             cur.execute("""
-                SELECT id, unit_id, platform, calendar_url, is_active, last_sync_at
+                SELECT id, unit_id, platform, calendar_url, is_active, last_sync_at,
+                       next_sync_at, sync_interval_minutes, error_streak, last_error
                 FROM calendar_syncs
                 ORDER BY unit_id, platform
             """)
@@ -77,7 +101,11 @@ def handler(event: dict, context) -> dict:
                     'platform': row[2],
                     'calendar_url': row[3] or '',
                     'is_active': row[4],
-                    'last_sync_at': row[5].isoformat() if row[5] else None
+                    'last_sync_at': row[5].isoformat() if row[5] else None,
+                    'next_sync_at': row[6].isoformat() if row[6] else None,
+                    'sync_interval_minutes': row[7],
+                    'error_streak': row[8] or 0,
+                    'last_error': row[9]
                 })
             
             return {
@@ -123,7 +151,8 @@ def handler(event: dict, context) -> dict:
             
             updates = []
             if calendar_url is not None:
-                updates.append(f"calendar_url = '{calendar_url.replace(\"'\", \"''\")}'"  )
+                escaped_url = calendar_url.replace("'", "''")
+                updates.append(f"calendar_url = '{escaped_url}'")
             if is_active is not None:
                 updates.append(f"is_active = {str(is_active).lower()}")
             
@@ -181,14 +210,10 @@ def handler(event: dict, context) -> dict:
             if not is_active or not calendar_url:
                 return error_response('Синхронизация отключена или URL не указан', 400)
             
-            imported_count = import_from_ical(cur, conn, unit_id, platform, calendar_url)
-            
-            cur.execute(f"""
-                UPDATE calendar_syncs
-                SET last_sync_at = NOW()
-                WHERE id = {sync_id}
-            """)
-            conn.commit()
+            sync_result = run_feed_sync(cur, conn, int(sync_id), unit_id, platform, calendar_url)
+            imported_count = sync_result['imported']
+            if sync_result['outbox_ids']:
+                deliver_outbox(cur, conn, sync_result['outbox_ids'])
             
             return {
                 'statusCode': 200,
@@ -197,6 +222,31 @@ def handler(event: dict, context) -> dict:
                 'isBase64Encoded': False
             }
         
+        if action in SCHEDULER_ACTIONS and not is_scheduler_request(event):
+            return error_response('Доступ только для планировщика', 403)
+        
+        if method == 'GET' and action == 'calendar-sync-metrics':
+            days = query_params.get('days', '7')
+            days = int(days) if str(days).isdigit() else 7
+            report = sync_metrics_report(cur, max(1, min(days, SYNC_RUNS_RETENTION_DAYS)))
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(report),
+                'isBase64Encoded': False
+            }
+        
+        if action == 'calendar-sync-due':
+            summary = run_due_syncs(cur, conn)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(summary),
+                'isBase64Encoded': False
+            }
+        
         return error_response('Unknown action', 400)
         
     except Exception as e:
@@ -207,115 +257,489 @@ def handler(event: dict, context) -> dict:
         conn.close()
 
 
-def import_from_ical(cur, conn, unit_id: int, platform: str, calendar_url: str) -> int:
+def is_scheduler_request(event: dict) -> bool:
+    '''
+    Проверяет секрет планировщика; без SCHEDULER_SECRET в окружении служебные действия закрыты
+    '''
+    secret = os.environ.get('SCHEDULER_SECRET')
+    headers = event.get('headers') or {}
+    provided = headers.get('X-Scheduler-Secret') or headers.get('x-scheduler-secret') or ''
+    return bool(secret) and hmac.compare_digest(provided.encode('utf-8'), secret.encode('utf-8'))
+
+
+def next_sync_interval(current_minutes: int, changed: bool, error_streak: int) -> int:
+    '''
+    Подбирает интервал опроса фида: часто меняющиеся опрашиваются чаще,
+    тихие и падающие — реже, с экспоненциальным откатом
+    '''
+    current = current_minutes or SYNC_BASE_INTERVAL_MINUTES
+    
+    if error_streak:
+        interval = SYNC_BASE_INTERVAL_MINUTES * (2 ** min(error_streak, 10))
+    elif changed:
+        interval = current // 2
+    else:
+        interval = current * 2
+    
+    return max(SYNC_MIN_INTERVAL_MINUTES, min(SYNC_MAX_INTERVAL_MINUTES, interval))
+
+
+def jittered_minutes(interval_minutes: int) -> float:
+    '''
+    Размазывает следующий запуск по интервалу, чтобы фиды не опрашивались одной волной
+    '''
+    spread = interval_minutes * SYNC_JITTER_RATIO
+    return interval_minutes + random.uniform(-spread, spread)
+
+
+def run_feed_sync(cur, conn, sync_id: int, unit_id: int, platform: str, calendar_url: str) -> dict:
+    '''
+    Выполняет импорт одного фида, обновляет его статистику и время следующего опроса
+    и пишет прогон в историю calendar_sync_runs.
+    Ошибка фиксируется в error_streak и пробрасывается дальше.
+    '''
+    cur.execute(
+        "SELECT sync_interval_minutes, error_streak FROM calendar_syncs WHERE id = %s",
+        (sync_id,)
+    )
+    stats_row = cur.fetchone()
+    current_interval, error_streak = stats_row if stats_row else (None, 0)
+    
+    metrics = new_sync_metrics()
+    try:
+        sync_result = import_from_ical(cur, conn, unit_id, platform, calendar_url, metrics)
+    except Exception as e:
+        conn.rollback()
+        error_streak = (error_streak or 0) + 1
+        interval = next_sync_interval(current_interval, False, error_streak)
+        cur.execute("""
+            UPDATE calendar_syncs
+            SET last_sync_at = NOW(),
+                error_streak = %s,
+                last_error = %s,
+                sync_interval_minutes = %s,
+                next_sync_at = NOW() + make_interval(secs => %s)
+            WHERE id = %s
+        """, (error_streak, str(e)[:1000], interval, jittered_minutes(interval) * 60, sync_id))
+        record_sync_run(cur, sync_id, unit_id, platform, metrics, str(e))
+        conn.commit()
+        raise
+    
+    changed = (metrics['inserts'] + metrics['updates']) > 0
+    interval = next_sync_interval(current_interval, changed, 0)
+    cur.execute("""
+        UPDATE calendar_syncs
+        SET last_sync_at = NOW(),
+            last_change_at = CASE WHEN %s THEN NOW() ELSE last_change_at END,
+            last_fetch_ms = %s,
+            error_streak = 0,
+            last_error = NULL,
+            sync_interval_minutes = %s,
+            next_sync_at = NOW() + make_interval(secs => %s)
+        WHERE id = %s
+    """, (changed, metrics['fetch_ms'], interval, jittered_minutes(interval) * 60, sync_id))
+    record_sync_run(cur, sync_id, unit_id, platform, metrics, None)
+    conn.commit()
+    
+    return sync_result
+
+
+def new_sync_metrics() -> dict:
+    return {
+        'fetch_ms': None,
+        'bytes_downloaded': 0,
+        'http_status': None,
+        'events_parsed': 0,
+        'inserts': 0,
+        'updates': 0,
+        'cancellations': 0,
+        'parse_ms': None,
+        'db_ms': None
+    }
+
+
+def record_sync_run(cur, sync_id: int, unit_id: int, platform: str, metrics: dict, error):
+    cur.execute("""
+        INSERT INTO calendar_sync_runs
+        (sync_id, unit_id, platform, status, fetch_ms, bytes_downloaded, http_status,
+         events_parsed, inserts, updates, cancellations, parse_ms, db_ms, error)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, (
+        sync_id, unit_id, platform, 'error' if error else 'ok',
+        metrics['fetch_ms'], metrics['bytes_downloaded'], metrics['http_status'],
+        metrics['events_parsed'], metrics['inserts'], metrics['updates'],
+        metrics['cancellations'], metrics['parse_ms'], metrics['db_ms'],
+        error[:1000] if error else None
+    ))
+
+
+def run_due_syncs(cur, conn) -> dict:
+    '''
+    Серверный планировщик: забирает фиды, у которых подошло время опроса, и синхронизирует их.
+    Вызывается по таймеру; выбранные фиды арендуются, чтобы параллельный запуск их не взял.
+    После прогона outbox дожимается целиком: сводки по нескольким фидам владельца уходят одним сообщением,
+    а недоставленные ранее повторяются, даже если новых броней не было.
+    '''
+    cur.execute("""
+        UPDATE calendar_syncs
+        SET next_sync_at = NOW() + make_interval(mins => %s)
+        WHERE id IN (
+            SELECT id FROM calendar_syncs
+            WHERE is_active = true
+            AND calendar_url IS NOT NULL AND calendar_url <> ''
+            AND (next_sync_at IS NULL OR next_sync_at <= NOW())
+            ORDER BY next_sync_at NULLS FIRST
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, unit_id, platform, calendar_url
+    """, (SYNC_LEASE_MINUTES, SYNC_SCHEDULER_BATCH))
+    due_feeds = cur.fetchall()
+    conn.commit()
+    
+    synced, failed, imported = 0, 0, 0
+    for sync_id, unit_id, platform, calendar_url in due_feeds:
+        try:
+            sync_result = run_feed_sync(cur, conn, sync_id, unit_id, platform, calendar_url)
+        except Exception as e:
+            print(f'Ошибка синхронизации фида {sync_id}: {e}')
+            failed += 1
+            continue
+        synced += 1
+        imported += sync_result['imported']
+    
+    notifications_sent = deliver_outbox(cur, conn)
+    
+    cur.execute(
+        "DELETE FROM calendar_sync_runs WHERE started_at < NOW() - make_interval(days => %s)",
+        (SYNC_RUNS_RETENTION_DAYS,)
+    )
+    conn.commit()
+    
+    return {
+        'due': len(due_feeds),
+        'synced': synced,
+        'failed': failed,
+        'imported_events': imported,
+        'notifications_sent': notifications_sent
+    }
+
+
+def sync_metrics_report(cur, days: int) -> dict:
+    '''
+    Агрегирует историю прогонов по фидам и площадкам: какие фиды дороже всего
+    и не растёт ли объём фида (последние сутки против среднего за период)
+    '''
+    cur.execute("""
+        SELECT r.sync_id, r.unit_id, r.platform,
+               COUNT(*) AS runs,
+               COUNT(*) FILTER (WHERE r.status = 'error') AS errors,
+               ROUND(AVG(r.fetch_ms)) AS avg_fetch_ms,
+               PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY r.fetch_ms) AS p95_fetch_ms,
+               ROUND(AVG(r.bytes_downloaded)) AS avg_bytes,
+               ROUND(AVG(r.bytes_downloaded) FILTER (WHERE r.started_at >= NOW() - INTERVAL '1 day')) AS avg_bytes_last_day,
+               ROUND(AVG(r.events_parsed)) AS avg_events,
+               SUM(r.inserts) AS inserts,
+               SUM(r.updates) AS updates,
+               SUM(r.cancellations) AS cancellations,
+               ROUND(AVG(r.parse_ms)) AS avg_parse_ms,
+               ROUND(AVG(r.db_ms)) AS avg_db_ms,
+               SUM(COALESCE(r.fetch_ms, 0) + COALESCE(r.parse_ms, 0) + COALESCE(r.db_ms, 0)) AS total_ms
+        FROM calendar_sync_runs r
+        WHERE r.started_at >= NOW() - make_interval(days => %s)
+        GROUP BY r.sync_id, r.unit_id, r.platform
+        ORDER BY total_ms DESC
+    """, (days,))
+    
+    feeds = []
+    for row in cur.fetchall():
+        avg_bytes = float(row[7]) if row[7] is not None else None
+        avg_bytes_last_day = float(row[8]) if row[8] is not None else None
+        feeds.append({
+            'sync_id': row[0],
+            'unit_id': row[1],
+            'platform': row[2],
+            'runs': row[3],
+            'errors': row[4],
+            'avg_fetch_ms': float(row[5]) if row[5] is not None else None,
+            'p95_fetch_ms': float(row[6]) if row[6] is not None else None,
+            'avg_bytes': avg_bytes,
+            'avg_bytes_last_day': avg_bytes_last_day,
+            'bytes_growth_ratio': round(avg_bytes_last_day / avg_bytes, 2) if avg_bytes and avg_bytes_last_day else None,
+            'avg_events': float(row[9]) if row[9] is not None else None,
+            'inserts': row[10] or 0,
+            'updates': row[11] or 0,
+            'cancellations': row[12] or 0,
+            'avg_parse_ms': float(row[13]) if row[13] is not None else None,
+            'avg_db_ms': float(row[14]) if row[14] is not None else None,
+            'total_ms': row[15] or 0
+        })
+    
+    platforms = {}
+    for feed in feeds:
+        platform = platforms.setdefault(feed['platform'], {
+            'platform': feed['platform'], 'feeds': 0, 'runs': 0, 'errors': 0, 'total_ms': 0
+        })
+        platform['feeds'] += 1
+        platform['runs'] += feed['runs']
+        platform['errors'] += feed['errors']
+        platform['total_ms'] += feed['total_ms']
+    
+    return {
+        'days': days,
+        'feeds': feeds,
+        'platforms': sorted(platforms.values(), key=lambda p: p['total_ms'], reverse=True)
+    }
+
+
+def import_from_ical(cur, conn, unit_id: int, platform: str, calendar_url: str, metrics: dict = None) -> dict:
     '''
     Загружает iCal по ссылке, парсит занятые даты, создаёт блокировки в календаре.
-    Отправляет уведомление владельцу о каждой новой брони.
+    Новые брони собираются в одну сводку владельцу, которая ставится в outbox
+    в той же транзакции и отправляется уже после коммита.
+    Замеры прогона (загрузка, парсинг, работа с БД, счётчики изменений) пишутся в metrics.
     '''
+    if metrics is None:
+        metrics = new_sync_metrics()
+    
+    fetch_started = time.monotonic()
     try:
         response = requests.get(calendar_url, timeout=30)
+        metrics['http_status'] = response.status_code
+        metrics['bytes_downloaded'] = len(response.content)
         response.raise_for_status()
         ical_data = response.text
     except Exception as e:
         raise Exception(f'Ошибка загрузки iCal: {str(e)}')
+    finally:
+        metrics['fetch_ms'] = int((time.monotonic() - fetch_started) * 1000)
+    
+    parse_started = time.monotonic()
+    events = parse_ical(ical_data)
+    metrics['events_parsed'] = len(events)
+    metrics['parse_ms'] = int((time.monotonic() - parse_started) * 1000)
+    
+    db_started = time.monotonic()
+    source = f'{platform}_sync'
     
-    cur.execute(f"SELECT name FROM units WHERE id = {unit_id}")
+    cur.execute("SELECT name, owner_id FROM units WHERE id = %s", (unit_id,))
     unit_result = cur.fetchone()
     unit_name = unit_result[0] if unit_result else f"Объект #{unit_id}"
+    owner_id = unit_result[1] if unit_result else None
     
-    cur.execute(f"SELECT user_id FROM units WHERE id = {unit_id}")
-    owner_result = cur.fetchone()
-    owner_id = owner_result[0] if owner_result else None
+    # Все ранее импортированные с площадки брони объекта одним запросом вместо SELECT на каждое событие
+    cur.execute("""
+        SELECT id, check_in, check_out, guest_name, status
+        FROM bookings
+        WHERE unit_id = %s AND source = %s
+    """, (unit_id, source))
+    existing = {
+        (format_iso_date(check_in), format_iso_date(check_out)): (booking_id, guest_name, status)
+        for booking_id, check_in, check_out, guest_name, status in cur.fetchall()
+    }
     
-    events = parse_ical(ical_data)
-    imported = 0
+    imported_bookings = []
+    seen_keys = set()
     
-    platform_names = {
-        'avito': 'Авито',
-        'yandex': 'Яндекс Путешествия',
-        'booking': 'Booking.com'
-    }
-    platform_display = platform_names.get(platform, platform)
+    platform_display = PLATFORM_NAMES.get(platform, platform)
     
     for event in events:
         start_date = event['start']
         end_date = event['end']
         summary = event.get('summary', f'Бронь с {platform_display}')
+        key = (start_date, end_date)
         
-        cur.execute(f"""
-            SELECT id FROM bookings
-            WHERE unit_id = {unit_id}
-            AND check_in = '{start_date}'
-            AND check_out = '{end_date}'
-            AND source = '{platform}_sync'
-        """)
+        if key in seen_keys:
+            continue
+        seen_keys.add(key)
         
-        if cur.fetchone():
+        if key in existing:
+            booking_id, guest_name, _ = existing[key]
+            if guest_name != summary:
+                cur.execute(
+                    "UPDATE bookings SET guest_name = %s, updated_at = NOW() WHERE id = %s",
+                    (summary, booking_id)
+                )
+                metrics['updates'] += 1
             continue
         
-        cur.execute(f"""
+        cur.execute("""
             INSERT INTO bookings 
             (unit_id, guest_name, guest_phone, check_in, check_out, 
              guests_count, total_price, status, source, created_at)
-            VALUES ({unit_id}, '{summary.replace("'", "''")}', '', 
-                    '{start_date}', '{end_date}', 
-                    1, 0, 'confirmed', '{platform}_sync', NOW())
+            VALUES (%s, %s, '', %s, %s, 1, 0, 'confirmed', %s, NOW())
             RETURNING id
-        """)
+        """, (unit_id, summary, start_date, end_date, source))
         booking_id = cur.fetchone()[0]
-        imported += 1
-        
-        if owner_id:
-            notify_owner_about_sync(
-                owner_id,
-                f'🔔 <b>Новая бронь импортирована!</b>\n\n'
-                f'📍 Площадка: {platform_display}\n'
-                f'🏠 Объект: {unit_name}\n'
-                f'📅 Даты: {start_date} — {end_date}\n'
-                f'📝 {summary}\n\n'
-                f'Бронь №{booking_id} автоматически добавлена в календарь.'
-            )
+        imported_bookings.append({
+            'id': booking_id,
+            'start': start_date,
+            'end': end_date,
+            'summary': summary
+        })
+    
+    metrics['inserts'] = len(imported_bookings)
+    
+    # Будущие импортированные брони, пропавшие из фида: считаем их, но не снимаем автоматически
+    today = datetime.utcnow().date().isoformat()
+    metrics['cancellations'] = sum(
+        1 for (start_date, end_date), (_, _, status) in existing.items()
+        if (start_date, end_date) not in seen_keys and end_date >= today and status != 'cancelled'
+    )
+    
+    outbox_ids = []
+    if owner_id and imported_bookings:
+        outbox_id = queue_owner_sync_digest(
+            cur, owner_id, unit_id, unit_name, platform, imported_bookings
+        )
+        if outbox_id:
+            outbox_ids.append(outbox_id)
     
     conn.commit()
-    return imported
+    metrics['db_ms'] = int((time.monotonic() - db_started) * 1000)
+    return {'imported': len(imported_bookings), 'outbox_ids': outbox_ids}
+
+
+def queue_owner_sync_digest(cur, owner_id: int, unit_id: int, unit_name: str,
+                            platform: str, imported_bookings: list):
+    '''
+    Ставит в outbox одну сводку владельцу обо всех броней, импортированных за прогон синхронизации.
+    Чат владельца ищется на соединении синхронизации; повтор той же сводки отсекается по dedup_key.
+    '''
+    cur.execute("""
+        SELECT channel_user_id FROM conversations
+        WHERE owner_id = %s
+        AND channel = 'telegram'
+        AND channel_user_id LIKE 'owner_%%'
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, (owner_id,))
+    
+    result = cur.fetchone()
+    if not result:
+        return None
+    
+    owner_chat_id = result[0].replace('owner_', '')
+    platform_display = PLATFORM_NAMES.get(platform, platform)
+    
+    lines = [
+        f'🔔 <b>Импортировано новых броней: {len(imported_bookings)}</b>',
+        '',
+        f'📍 Площадка: {html.escape(platform_display)}',
+        f'🏠 Объект: {html.escape(unit_name)}',
+        ''
+    ]
+    for booking in imported_bookings[:DIGEST_MAX_ITEMS]:
+        # Сообщение уходит с parse_mode=HTML: «<» или «&» из внешнего календаря иначе дают 400 от Telegram
+        lines.append(f'📅 {booking["start"]} — {booking["end"]}: {html.escape(booking["summary"])} (№{booking["id"]})')
+    if len(imported_bookings) > DIGEST_MAX_ITEMS:
+        lines.append(f'…и ещё {len(imported_bookings) - DIGEST_MAX_ITEMS}')
+    lines.extend(['', 'Брони автоматически добавлены в календарь.'])
+    
+    booking_ids = ','.join(str(booking['id']) for booking in imported_bookings)
+    dedup_key = 'calendar-sync:' + hashlib.sha1(
+        f'{unit_id}:{platform}:{booking_ids}'.encode('utf-8')
+    ).hexdigest()
+    
+    cur.execute("""
+        INSERT INTO notification_outbox (owner_id, chat_id, message, dedup_key)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (dedup_key) DO NOTHING
+        RETURNING id
+    """, (owner_id, owner_chat_id, '\n'.join(lines), dedup_key))
+    
+    row = cur.fetchone()
+    return row[0] if row else None
 
 
-def notify_owner_about_sync(owner_id: int, message: str):
+def deliver_outbox(cur, conn, outbox_ids: list = None) -> int:
     '''
-    Отправляет уведомление владельцу в Telegram о новой импортированной брони
+    Доставляет pending-уведомления из outbox в Telegram и отмечает результат; возвращает число отправленных сообщений.
+    Записи одного чата склеиваются в одно сообщение, каждое сообщение фиксируется своим коммитом,
+    так что блокировка держится только на записях, которые отправляются сейчас.
+    outbox_ids ограничивает доставку чатами этих записей, без него outbox дожимается целиком.
     '''
+    sent = 0
+    # Чат, которому отправка не удалась, в этом прогоне больше не пробуем, чтобы не сжечь все попытки разом
+    attempted_chat_ids = []
     try:
-        import psycopg2
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
-        cur = conn.cursor()
-        
-        cur.execute(f"""
-            SELECT channel_user_id FROM conversations
-            WHERE user_id = {owner_id}
-            AND channel = 'telegram'
-            AND channel_user_id LIKE 'owner_%'
-            ORDER BY created_at DESC
-            LIMIT 1
-        """)
-        
-        result = cur.fetchone()
-        if result:
-            owner_chat_id = result[0].replace('owner_', '')
-            send_telegram_message(owner_chat_id, message)
-        
-        cur.close()
-        conn.close()
+        for _ in range(OUTBOX_BATCH_SIZE):
+            cur.execute("""
+                SELECT chat_id FROM notification_outbox
+                WHERE status = 'pending'
+                AND (%s::int[] IS NULL OR id = ANY(%s::int[]))
+                AND NOT chat_id = ANY(%s::varchar[])
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            """, (outbox_ids, outbox_ids, attempted_chat_ids))
+            row = cur.fetchone()
+            if not row:
+                break
+            chat_id = row[0]
+            attempted_chat_ids.append(chat_id)
+            
+            cur.execute("""
+                SELECT id, message FROM notification_outbox
+                WHERE status = 'pending' AND chat_id = %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (chat_id, OUTBOX_BATCH_SIZE))
+            
+            batch = []
+            length = 0
+            for outbox_id, message in cur.fetchall():
+                if batch and length + len(message) + 2 > TELEGRAM_MESSAGE_MAX_CHARS:
+                    break
+                batch.append((outbox_id, message))
+                length += len(message) + 2
+            
+            if send_telegram_message(chat_id, '\n\n'.join(message for _, message in batch)):
+                mark_outbox_sent(cur, [outbox_id for outbox_id, _ in batch])
+                sent += 1
+            elif len(batch) == 1:
+                mark_outbox_failed_attempt(cur, [batch[0][0]])
+            else:
+                # Telegram мог отклонить склейку из-за одной записи — пробуем записи по одной,
+                # чтобы попытки тратила только сама недоставляемая запись
+                for outbox_id, message in batch:
+                    if send_telegram_message(chat_id, message):
+                        mark_outbox_sent(cur, [outbox_id])
+                        sent += 1
+                    else:
+                        mark_outbox_failed_attempt(cur, [outbox_id])
+            conn.commit()
     except Exception as e:
-        print(f'Ошибка отправки уведомления владельцу: {e}')
+        conn.rollback()
+        print(f'Ошибка отправки уведомлений из outbox: {e}')
+    return sent
 
 
-def send_telegram_message(chat_id: str, text: str):
+def mark_outbox_sent(cur, outbox_ids: list):
+    cur.execute("""
+        UPDATE notification_outbox
+        SET status = 'sent', sent_at = NOW(), attempts = attempts + 1
+        WHERE id = ANY(%s)
+    """, (outbox_ids,))
+
+
+def mark_outbox_failed_attempt(cur, outbox_ids: list):
+    cur.execute("""
+        UPDATE notification_outbox
+        SET attempts = attempts + 1,
+            status = CASE WHEN attempts + 1 >= %s THEN 'failed' ELSE 'pending' END
+        WHERE id = ANY(%s)
+    """, (OUTBOX_MAX_ATTEMPTS, outbox_ids))
+
+
+def send_telegram_message(chat_id: str, text: str) -> bool:
     '''
     Отправляет сообщение в Telegram
     '''
     bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
     if not bot_token:
-        return
+        return False
     
     try:
         url = f'https://api.telegram.org/bot{bot_token}/sendMessage'
@@ -324,9 +748,11 @@ def send_telegram_message(chat_id: str, text: str):
             'text': text,
             'parse_mode': 'HTML'
         }
-        requests.post(url, json=data, timeout=10)
+        response = requests.post(url, json=data, timeout=10)
+        return response.status_code == 200
     except Exception as e:
         print(f'Ошибка отправки в Telegram: {e}')
+        return False
 
 
 def parse_ical(ical_text: str) -> list:
@@ -366,40 +792,240 @@ def parse_ical(ical_text: str) -> list:
     return events
 
 
-def generate_ical(bookings: list, unit_id: int) -> str:
+def calendar_validators(key: str, version, changed_at) -> tuple:
+    '''
+    Вычисляет ETag и момент последнего изменения iCal-документа по версии календаря
+    '''
+    # Экспорт отсекает прошедшие брони, поэтому документ меняется и со сменой дня
+    today = datetime.utcnow().date()
+    etag = f'"{key}-v{version}-{today.strftime("%Y%m%d")}"'
+    day_start = datetime.combine(today, datetime.min.time())
+    last_modified_at = max(changed_at, day_start) if changed_at else day_start
+    return etag, last_modified_at
+
+
+def ical_response_headers(filename: str, etag: str, last_modified_at: datetime) -> dict:
+    return {
+        'Content-Type': 'text/calendar; charset=utf-8',
+        'Content-Disposition': f'inline; filename="{filename}"',
+        'ETag': etag,
+        'Last-Modified': last_modified_at.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        'Cache-Control': 'public, max-age=300',
+        'Access-Control-Allow-Origin': '*'
+    }
+
+
+def is_not_modified(request_headers: dict, etag: str, last_modified_at: datetime) -> bool:
+    '''
+    Проверяет условный запрос площадки (If-None-Match / If-Modified-Since)
+    '''
+    if_none_match = request_headers.get('If-None-Match') or request_headers.get('if-none-match')
+    if_modified_since = request_headers.get('If-Modified-Since') or request_headers.get('if-modified-since')
+    
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    
+    if if_modified_since:
+        try:
+            since = datetime.strptime(if_modified_since, '%a, %d %b %Y %H:%M:%S GMT')
+        except ValueError:
+            return False
+        return last_modified_at.replace(microsecond=0) <= since
+    
+    return False
+
+
+def calendar_export_response(cur, unit_id: int, request_headers: dict) -> dict:
+    '''
+    Отдаёт iCal-экспорт объекта из кэша, если версия календаря не изменилась.
+    Поддерживает условные запросы площадок (If-None-Match / If-Modified-Since → 304).
+    '''
+    cur.execute(
+        "SELECT version, changed_at FROM unit_calendar_versions WHERE unit_id = %s",
+        (unit_id,)
+    )
+    version_row = cur.fetchone()
+    version, changed_at = version_row if version_row else (0, None)
+    
+    etag, last_modified_at = calendar_validators(f'unit-{unit_id}', version, changed_at)
+    response_headers = ical_response_headers(f'calendar_{unit_id}.ics', etag, last_modified_at)
+    
+    if is_not_modified(request_headers, etag, last_modified_at):
+        return {
+            'statusCode': 304,
+            'headers': response_headers,
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    cached = EXPORT_CACHE.get(unit_id)
+    if cached and cached['etag'] == etag:
+        ical = cached['ical']
+    else:
+        cur.execute("""
+            SELECT check_in, check_out, guest_name, id
+            FROM bookings
+            WHERE unit_id = %s
+            AND status IN ('confirmed', 'pending')
+            AND check_out >= CURRENT_DATE
+            ORDER BY check_in
+        """, (unit_id,))
+        
+        ical = generate_ical(cur.fetchall(), unit_id, last_modified_at)
+        
+        if len(EXPORT_CACHE) >= EXPORT_CACHE_MAX_UNITS:
+            EXPORT_CACHE.pop(next(iter(EXPORT_CACHE)))
+        EXPORT_CACHE[unit_id] = {'etag': etag, 'ical': ical}
+    
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': ical,
+        'isBase64Encoded': False
+    }
+
+
+def calendar_export_owner_response(conn, cur, owner_id: int, request_headers: dict) -> dict:
+    '''
+    Отдаёт единый iCal-календарь по всем объектам владельца.
+    Брони читаются одним упорядоченным запросом через серверный курсор, VEVENT формируются по мере чтения.
+    '''
+    # Версия общего календаря — хэш упорядоченного списка (объект, версия, время изменения):
+    # сумма версий совпала бы после удаления одного объекта и правок другого
+    cur.execute("""
+        SELECT
+            COUNT(u.id),
+            md5(string_agg(
+                u.id || ':' || COALESCE(v.version, 0) || ':' || COALESCE(v.changed_at::text, ''),
+                ',' ORDER BY u.id
+            )),
+            MAX(v.changed_at)
+        FROM units u
+        LEFT JOIN unit_calendar_versions v ON v.unit_id = u.id
+        WHERE u.owner_id = %s
+    """, (owner_id,))
+    units_count, versions_digest, changed_at = cur.fetchone()
+    
+    if not units_count:
+        return error_response('Объекты владельца не найдены', 404)
+    
+    etag, last_modified_at = calendar_validators(f'owner-{owner_id}', versions_digest[:16], changed_at)
+    response_headers = ical_response_headers(f'calendar_owner_{owner_id}.ics', etag, last_modified_at)
+    
+    if is_not_modified(request_headers, etag, last_modified_at):
+        return {
+            'statusCode': 304,
+            'headers': response_headers,
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    stream = conn.cursor(name=f'owner_export_{owner_id}')
+    stream.itersize = OWNER_EXPORT_FETCH_SIZE
+    try:
+        stream.execute("""
+            SELECT b.check_in, b.check_out, b.guest_name, b.id, u.id, u.name
+            FROM bookings b
+            JOIN units u ON u.id = b.unit_id
+            WHERE u.owner_id = %s
+            AND b.status IN ('confirmed', 'pending')
+            AND b.check_out >= CURRENT_DATE
+            ORDER BY u.id, b.check_in
+        """, (owner_id,))
+        
+        ical = '\n'.join(iter_owner_ical_lines(stream, owner_id, last_modified_at))
+    finally:
+        stream.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': ical,
+        'isBase64Encoded': False
+    }
+
+
+def iter_owner_ical_lines(rows, owner_id: int, stamp: datetime):
+    '''
+    Построчно выдаёт iCalendar владельца, формируя VEVENT сразу по прочитанной строке курсора
+    '''
+    now = stamp.strftime('%Y%m%dT%H%M%SZ')
+    
+    yield 'BEGIN:VCALENDAR'
+    yield 'VERSION:2.0'
+    yield 'PRODID:-//TOURCONNECT//Booking Calendar//RU'
+    yield 'CALSCALE:GREGORIAN'
+    yield 'METHOD:PUBLISH'
+    yield f'X-WR-CALNAME:Календарь бронирований (Владелец {owner_id})'
+    yield 'X-WR-TIMEZONE:Europe/Moscow'
+    
+    for check_in, check_out, guest_name, booking_id, unit_id, unit_name in rows:
+        yield 'BEGIN:VEVENT'
+        yield f'UID:booking-{booking_id}@tourconnect.ru'
+        yield f'DTSTAMP:{now}'
+        yield f'DTSTART;VALUE=DATE:{format_ical_date(check_in)}'
+        yield f'DTEND;VALUE=DATE:{format_ical_date(check_out)}'
+        yield f'SUMMARY:Занято - {unit_name} - {guest_name}'
+        yield f'X-TOURCONNECT-UNIT-ID:{unit_id}'
+        yield 'STATUS:CONFIRMED'
+        yield 'TRANSP:OPAQUE'
+        yield 'END:VEVENT'
+    
+    yield 'END:VCALENDAR'
+
+
+def format_iso_date(value) -> str:
+    '''
+    Приводит дату брони (date, datetime или строку) к виду YYYY-MM-DD, как в parse_ical
+    '''
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d')
+    return str(value)[:10]
+
+
+def format_ical_date(value) -> str:
     '''
-    Генерирует iCalendar формат из списка бронирований
+    Приводит дату брони (date, datetime или строку YYYY-MM-DD) к формату iCal YYYYMMDD
     '''
-    now = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y%m%d')
+    return str(value).replace('-', '')
+
+
+def generate_ical(bookings: list, unit_id: int, stamp: datetime = None) -> str:
+    '''
+    Генерирует iCalendar формат из списка бронирований.
+    DTSTAMP берётся из времени изменения календаря, чтобы документ был стабилен между запросами.
+    '''
+    now = (stamp or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
     
-    ical = f"""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:-//TOURCONNECT//Booking Calendar//RU
-CALSCALE:GREGORIAN
-METHOD:PUBLISH
-X-WR-CALNAME:Календарь бронирований (Объект {unit_id})
-X-WR-TIMEZONE:Europe/Moscow
-"""
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//TOURCONNECT//Booking Calendar//RU',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:Календарь бронирований (Объект {unit_id})',
+        'X-WR-TIMEZONE:Europe/Moscow'
+    ]
     
     for booking in bookings:
         check_in, check_out, guest_name, booking_id = booking
         
-        start_str = check_in.strftime('%Y%m%d') if isinstance(check_in, datetime) else check_in.replace('-', '')
-        end_str = check_out.strftime('%Y%m%d') if isinstance(check_out, datetime) else check_out.replace('-', '')
-        
-        ical += f"""BEGIN:VEVENT
-UID:booking-{booking_id}@tourconnect.ru
-DTSTAMP:{now}
-DTSTART;VALUE=DATE:{start_str}
-DTEND;VALUE=DATE:{end_str}
-SUMMARY:Занято - {guest_name}
-STATUS:CONFIRMED
-TRANSP:OPAQUE
-END:VEVENT
-"""
-    
-    ical += "END:VCALENDAR"
-    return ical
+        lines.extend([
+            'BEGIN:VEVENT',
+            f'UID:booking-{booking_id}@tourconnect.ru',
+            f'DTSTAMP:{now}',
+            f'DTSTART;VALUE=DATE:{format_ical_date(check_in)}',
+            f'DTEND;VALUE=DATE:{format_ical_date(check_out)}',
+            f'SUMMARY:Занято - {guest_name}',
+            'STATUS:CONFIRMED',
+            'TRANSP:OPAQUE',
+            'END:VEVENT'
+        ])
+    
+    lines.append('END:VCALENDAR')
+    return '\n'.join(lines)
 
 
 def error_response(message: str, code: int) -> dict:
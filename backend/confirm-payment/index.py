@@ -3,6 +3,9 @@ import os
 import psycopg2
 from urllib import request
 
+from tenant_schema import resolve_schema
+
+
 def handler(event: dict, context) -> dict:
     '''Подтверждение оплаты владельцем и создание бронирования'''
     
@@ -39,18 +42,10 @@ def handler(event: dict, context) -> dict:
             }
         
         dsn = os.environ.get('DATABASE_URL')
-        schema = os.environ.get('MAIN_DB_SCHEMA')
-        if not schema:
-            temp_conn = psycopg2.connect(dsn)
-            temp_cur = temp_conn.cursor()
-            temp_cur.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE 't_%' ORDER BY nspname LIMIT 1")
-            schema_row = temp_cur.fetchone()
-            schema = schema_row[0] if schema_row else 'public'
-            temp_cur.close()
-            temp_conn.close()
-        
+        headers = event.get('headers', {})
         conn = psycopg2.connect(dsn)
         cur = conn.cursor()
+        schema = resolve_schema(cur, owner_id=headers.get('X-Owner-Id') or headers.get('x-owner-id'))
         
         cur.execute(f'''
             SELECT id, unit_id, check_in, check_out, guest_name, guest_contact, 
@@ -0,0 +1,52 @@
+'''Определение схемы тенанта в основной БД'''
+import json
+import os
+import re
+
+SCHEMA_NAME_PATTERN = re.compile(r'^[a-z_][a-z0-9_]{0,62}$')
+
+# Схемы, найденные на тёплом инстансе: ключ тенанта ('bot:<id>', 'owner:<id>' или '') -> схема
+SCHEMA_CACHE = {}
+
+
+def tenant_key(bot_token: str = None, owner_id=None) -> str:
+    '''Ключ тенанта для сопоставления со схемой; для бота — только числовой id из токена, без самого токена'''
+    if bot_token:
+        return f"bot:{bot_token.split(':', 1)[0]}"
+    if owner_id:
+        return f'owner:{owner_id}'
+    return ''
+
+
+def load_schema_map() -> dict:
+    '''Явное сопоставление тенантов и схем из TENANT_SCHEMA_MAP, например {"bot:123456": "t_p1", "owner:7": "t_p1"}'''
+    raw = os.environ.get('TENANT_SCHEMA_MAP')
+    if not raw:
+        return {}
+    try:
+        schema_map = json.loads(raw)
+    except json.JSONDecodeError:
+        print('TENANT_SCHEMA_MAP is not valid JSON, ignored')
+        return {}
+    return schema_map if isinstance(schema_map, dict) else {}
+
+
+def resolve_schema(cur, bot_token: str = None, owner_id=None) -> str:
+    '''
+    Схема тенанта: MAIN_DB_SCHEMA, TENANT_SCHEMA_MAP, кэш тёплого инстанса или первая схема t_* в pg_namespace.
+    Ищется на курсоре запроса без отдельного соединения; недопустимое имя схемы — ValueError.
+    '''
+    key = tenant_key(bot_token, owner_id)
+
+    schema = os.environ.get('MAIN_DB_SCHEMA') or load_schema_map().get(key) or SCHEMA_CACHE.get(key)
+    if schema:
+        if not SCHEMA_NAME_PATTERN.match(schema):
+            raise ValueError(f'Invalid schema name: {schema}')
+        return schema
+
+    cur.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE 't_%' ORDER BY nspname LIMIT 1")
+    schema_row = cur.fetchone()
+    schema = schema_row[0] if schema_row else 'public'
+
+    SCHEMA_CACHE[key] = schema
+    return schema
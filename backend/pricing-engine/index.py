@@ -430,16 +430,16 @@ def toggle_dynamic_pricing(conn, data: dict) -> dict:
 def get_occupancy_rate(conn, unit_id: str, date) -> float:
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
     with conn.cursor() as cur:
+        # Занятые ночи объекта предрасчитаны в unit_daily_stats (день только с заездом однодневной брони — occupied = false)
         cur.execute(f"""
-            SELECT COUNT(*) FROM {schema}.bookings
-            WHERE unit_id = %s 
-            AND status = 'confirmed'
-            AND check_in <= %s 
-            AND check_out > %s
-        """, (unit_id, date, date))
+            SELECT EXISTS(
+                SELECT 1 FROM {schema}.unit_daily_stats
+                WHERE unit_id = %s AND day = %s AND occupied
+            )
+        """, (unit_id, date))
         
         booked = cur.fetchone()[0]
-        return min(100.0, booked * 100.0)
+        return 100.0 if booked else 0.0
 
 
 def check_rule_condition(rule: dict, occupancy: float, days_before: int, day_of_week: int) -> bool:
@@ -1,9 +1,92 @@
+import hmac
 import json
 import os
+import time
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from urllib import request
+from datetime import datetime, timedelta
+
+from telegram_client import telegram_call, get_file_url, send_concurrently
+from tenant_schema import resolve_schema
+from unit_names import build_unit_index, resolve_unit, pick_best_match
+
+# Очередь обновлений Telegram: webhook telegram-receive только сохраняет, обработка — здесь
+TELEGRAM_PROCESS_CONCURRENCY = 4
+TELEGRAM_PROCESS_BATCH_SIZE = 20
+TELEGRAM_PROCESS_TIME_BUDGET_SECONDS = 20
+TELEGRAM_UPDATE_LEASE_SECONDS = 120
+TELEGRAM_UPDATE_MAX_ATTEMPTS = 3
+TELEGRAM_UPDATE_RETENTION_DAYS = 7
+# Telegram повторяет доставку не дольше суток, ключи дедупликации храним с запасом
+TELEGRAM_DEDUP_RETENTION_DAYS = 3
+TELEGRAM_AI_TIMEOUT_SECONDS = 30
+# Если до конца бюджета вызова осталось меньше, запрос к модели не начинаем — обновления вернутся в очередь
+TELEGRAM_AI_MIN_TIMEOUT_SECONDS = 5
+# Гость часто пишет несколькими сообщениями подряд: ждём паузу и отвечаем на всю серию сразу
+TELEGRAM_DEBOUNCE_SECONDS = 2
+TELEGRAM_DEBOUNCE_MAX_WAIT_SECONDS = 6
+
+# Окно истории в промпте и накопительная сводка более ранней переписки чата
+TELEGRAM_HISTORY_MESSAGES = 10
+TELEGRAM_SUMMARY_FOLD_MIN_MESSAGES = 10
+TELEGRAM_SUMMARY_FOLD_MAX_MESSAGES = 40
+TELEGRAM_SUMMARY_MODEL = 'openai/gpt-4o-mini'
+TELEGRAM_SUMMARY_BATCH_CHATS = 20
+
+# База знаний бота на тёплом инстансе: schema -> {version, knowledge, cached_at}
+BOT_KNOWLEDGE_CACHE = {}
+BOT_KNOWLEDGE_TTL_SECONDS = 600
+
+# Ответ бота — JSON по схеме: текст для клиента и намерения отдельными полями (structured outputs)
+BOT_INTENTS = ['confirm_booking', 'show_unit', 'show_map', 'modify_booking']
+BOT_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {
+        'name': 'bot_response',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'reply': {'type': 'string'},
+                'intents': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {
+                            'intent': {'type': 'string', 'enum': BOT_INTENTS},
+                            'unit_name': {'type': ['string', 'null']},
+                            'guest_name': {'type': ['string', 'null']},
+                            'guest_phone': {'type': ['string', 'null']},
+                            'check_in': {'type': ['string', 'null'], 'description': 'YYYY-MM-DD'},
+                            'check_out': {'type': ['string', 'null'], 'description': 'YYYY-MM-DD'},
+                            'guests_count': {'type': ['integer', 'null']},
+                            'additional_services_amount': {'type': ['number', 'null']},
+                            'booking_id': {'type': ['integer', 'null']},
+                            'requested_changes': {'type': ['string', 'null']}
+                        },
+                        'required': [
+                            'intent', 'unit_name', 'guest_name', 'guest_phone', 'check_in', 'check_out',
+                            'guests_count', 'additional_services_amount', 'booking_id', 'requested_changes'
+                        ],
+                        'additionalProperties': False
+                    }
+                }
+            },
+            'required': ['reply', 'intents'],
+            'additionalProperties': False
+        }
+    }
+}
+
 
 def handler(event: dict, context) -> dict:
-    '''Обрабатывает новые сообщения из БД и отправляет уведомления владельцам'''
+    '''
+    Обрабатывает очередь обновлений Telegram (telegram_updates), сохранённых webhook'ом telegram-receive.
+    Вызывается telegram-receive сразу после сохранения обновления и планировщиком для повторов.
+    Чаты обрабатываются параллельно (не больше TELEGRAM_PROCESS_CONCURRENCY), серия сообщений одного чата — одним ответом.
+    action=summarize-chats (только планировщик) сворачивает историю отмеченных чатов в сводки вне очереди чатов.
+    '''
     
     method = event.get('httpMethod', 'GET')
     
@@ -20,43 +103,76 @@ def handler(event: dict, context) -> dict:
     
     try:
         dsn = os.environ.get('DATABASE_URL')
-        schema = os.environ.get('MAIN_DB_SCHEMA')
-        if not schema:
-            temp_conn = psycopg2.connect(dsn)
-            temp_cur = temp_conn.cursor()
-            temp_cur.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE 't_%' ORDER BY nspname LIMIT 1")
-            schema_row = temp_cur.fetchone()
-            schema = schema_row[0] if schema_row else 'public'
-            temp_cur.close()
-            temp_conn.close()
-        
         conn = psycopg2.connect(dsn)
         cur = conn.cursor()
+        schema = resolve_schema(cur, bot_token=os.environ.get('TELEGRAM_BOT_TOKEN'))
         
-        cur.execute(f'''
-            SELECT id, telegram_id, message_text, sender
-            FROM {schema}.telegram_messages 
-            WHERE sender = 'user'
-            ORDER BY created_at DESC 
-            LIMIT 10
-        ''')
-        
-        messages = cur.fetchall()
-        processed_ids = []
+        if (event.get('queryStringParameters') or {}).get('action') == 'summarize-chats':
+            try:
+                if not is_scheduler_request(event):
+                    return {
+                        'statusCode': 403,
+                        'headers': {'Content-Type': 'application/json'},
+                        'body': json.dumps({'error': 'Scheduler secret required in X-Scheduler-Secret header'})
+                    }
+                deadline = datetime.now() + timedelta(seconds=TELEGRAM_PROCESS_TIME_BUDGET_SECONDS)
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json'},
+                    'body': json.dumps({'folded': summarize_pending_chats(cur, conn, schema, deadline)})
+                }
+            finally:
+                cur.close()
+                conn.close()
         
-        for msg_id, telegram_id, text, sender in messages:
-            processed_ids.append(msg_id)
+        processed_ids = []
+        failed_ids = []
+        deadline = datetime.now() + timedelta(seconds=TELEGRAM_PROCESS_TIME_BUDGET_SECONDS)
         
-        conn.commit()
-        cur.close()
-        conn.close()
+        try:
+            with ThreadPoolExecutor(max_workers=TELEGRAM_PROCESS_CONCURRENCY) as pool:
+                while datetime.now() < deadline:
+                    claimed = claim_updates(cur, conn, schema)
+                    if not claimed:
+                        break
+                    
+                    # Обновления одного чата идут одному потоку по порядку
+                    chats = {}
+                    for update_row_id, chat_id, payload in claimed:
+                        chats.setdefault(chat_id, []).append((update_row_id, payload))
+                    
+                    results = []
+                    for chat_results in pool.map(
+                        lambda chat: run_chat_updates(chat[0], chat[1], schema, dsn, deadline),
+                        chats.items()
+                    ):
+                        results.extend(chat_results)
+                    
+                    finish_updates(cur, conn, schema, results)
+                    processed_ids.extend(update_row_id for update_row_id, error in results if not error)
+                    failed_ids.extend(update_row_id for update_row_id, error in results if error)
+            
+            cur.execute(f'''
+                DELETE FROM {schema}.telegram_updates
+                WHERE status IN ('done', 'error')
+                AND created_at < NOW() - make_interval(days => %s)
+            ''', (TELEGRAM_UPDATE_RETENTION_DAYS,))
+            cur.execute(f'''
+                DELETE FROM {schema}.telegram_processed_updates
+                WHERE received_at < NOW() - make_interval(days => %s)
+            ''', (TELEGRAM_DEDUP_RETENTION_DAYS,))
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'processed': len(processed_ids),
-                'message_ids': processed_ids
+                'failed': len(failed_ids),
+                'update_ids': processed_ids
             })
         }
         
@@ -65,4 +181,1052 @@ def handler(event: dict, context) -> dict:
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json'},
             'body': json.dumps({'error': str(e)})
-        }
\ No newline at end of file
+        }
+
+
+def claim_updates(cur, conn, schema: str) -> list:
+    '''
+    Забирает пачку ожидающих обновлений под аренду: параллельные вызовы telegram-process
+    не получат те же строки, а зависшие после падения вернутся в работу по истечении аренды
+    (или уйдут в error, если это была последняя попытка). Чаты, которые уже обрабатывает другой вызов, пропускаются — их новые сообщения заберёт он сам.
+    '''
+    cur.execute(f'''
+        UPDATE {schema}.telegram_updates
+        SET status = 'processing',
+            attempts = attempts + 1,
+            locked_until = NOW() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM {schema}.telegram_updates u
+            WHERE (u.status = 'pending' OR (u.status = 'processing' AND u.locked_until < NOW()))
+            AND u.attempts < %s
+            AND NOT EXISTS (
+                SELECT 1 FROM {schema}.telegram_updates busy
+                WHERE busy.chat_id = u.chat_id
+                AND busy.status = 'processing'
+                AND busy.locked_until >= NOW()
+            )
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, chat_id, payload
+    ''', (TELEGRAM_UPDATE_LEASE_SECONDS, TELEGRAM_UPDATE_MAX_ATTEMPTS, TELEGRAM_PROCESS_BATCH_SIZE))
+    claimed = sorted(cur.fetchall())
+    
+    # Вызов оборвался на последней попытке: без этого строка осталась бы в processing навсегда
+    cur.execute(f'''
+        UPDATE {schema}.telegram_updates
+        SET status = 'error',
+            locked_until = NULL,
+            last_error = COALESCE(last_error, 'Lease expired on the last attempt')
+        WHERE status = 'processing' AND locked_until < NOW() AND attempts >= %s
+    ''', (TELEGRAM_UPDATE_MAX_ATTEMPTS,))
+    conn.commit()
+    return claimed
+
+
+def run_chat_updates(chat_id: int, updates: list, schema: str, dsn: str, deadline: datetime) -> list:
+    '''
+    Обрабатывает обновления одного чата, возвращает [(id, ошибка или None)].
+    Чат сериализован advisory-блокировкой по chat_id: параллельные вызовы telegram-process
+    не отвечают одному гостю одновременно и не пишут историю вперемешку. Если чат уже обрабатывает
+    другой вызов, обновления возвращаются в очередь без ожидания, чтобы не занимать поток пула. Перед ответом ждём,
+    пока гость допишет (TELEGRAM_DEBOUNCE_SECONDS тишины), и отвечаем на всю серию сообщений одним вызовом AI.
+    Блокировка, ожидание и вся обработка чата идут через одно соединение.
+    '''
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    
+    results = []
+    try:
+        cur.execute('SELECT pg_try_advisory_lock(%s)', (chat_id,))
+        locked = cur.fetchone()[0]
+        conn.commit()
+        if not locked:
+            # Чат занят другим вызовом: он же дочитает эти обновления через claim_chat_updates
+            release_updates(cur, conn, schema, [update_row_id for update_row_id, payload in updates])
+            print(f'Chat {chat_id} is busy, updates released')
+            return results
+        try:
+            while updates:
+                wait_for_chat_quiet(cur, conn, schema, chat_id, deadline)
+                updates = sorted(updates + claim_chat_updates(cur, conn, schema, chat_id))
+                
+                update_row_ids = [update_row_id for update_row_id, payload in updates]
+                try:
+                    parsed = [
+                        (update_row_id, payload if isinstance(payload, dict) else json.loads(payload))
+                        for update_row_id, payload in updates
+                    ]
+                    if not process_chat_updates(cur, conn, parsed, schema, deadline):
+                        # Время вызова вышло до запроса к модели: реплики уже в истории, ответит следующий вызов
+                        release_updates(cur, conn, schema, update_row_ids)
+                        print(f'Chat {chat_id} updates {update_row_ids} released: time budget exhausted')
+                        break
+                    results.extend((update_row_id, None) for update_row_id in update_row_ids)
+                    # Сводку сворачивает планировщик (summarize-chats), здесь чат только отмечается
+                    request_chat_summary(cur, conn, schema, chat_id)
+                except Exception as e:
+                    conn.rollback()
+                    print(f'Chat {chat_id} updates {update_row_ids} processing error: {e}')
+                    results.extend((update_row_id, str(e)) for update_row_id in update_row_ids)
+                
+                # Сообщения, пришедшие во время ответа, не ждут следующего вызова
+                updates = claim_chat_updates(cur, conn, schema, chat_id) if datetime.now() < deadline else []
+        finally:
+            conn.rollback()
+            cur.execute('SELECT pg_advisory_unlock(%s)', (chat_id,))
+            conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+    
+    return results
+
+
+def wait_for_chat_quiet(cur, conn, schema: str, chat_id: int, deadline: datetime):
+    '''Ждёт паузы в сообщениях чата, но не дольше TELEGRAM_DEBOUNCE_MAX_WAIT_SECONDS и не позже deadline'''
+    waited = 0.0
+    max_wait = min(TELEGRAM_DEBOUNCE_MAX_WAIT_SECONDS, max(0.0, (deadline - datetime.now()).total_seconds()))
+    while waited < max_wait:
+        cur.execute(f'''
+            SELECT EXTRACT(EPOCH FROM NOW() - MAX(created_at))
+            FROM {schema}.telegram_updates
+            WHERE chat_id = %s AND status IN ('pending', 'processing')
+        ''', (chat_id,))
+        quiet_for = cur.fetchone()[0]
+        # NOW() — время начала транзакции: закрываем её, чтобы следующая проверка видела текущее время
+        conn.commit()
+        if quiet_for is None or quiet_for >= TELEGRAM_DEBOUNCE_SECONDS:
+            return
+        pause = min(TELEGRAM_DEBOUNCE_SECONDS - float(quiet_for), max_wait - waited)
+        time.sleep(pause)
+        waited += pause
+
+
+def claim_chat_updates(cur, conn, schema: str, chat_id: int) -> list:
+    '''Забирает под аренду ожидающие обновления чата, пришедшие после основной пачки'''
+    cur.execute(f'''
+        UPDATE {schema}.telegram_updates
+        SET status = 'processing',
+            attempts = attempts + 1,
+            locked_until = NOW() + make_interval(secs => %s)
+        WHERE id IN (
+            SELECT id FROM {schema}.telegram_updates
+            WHERE chat_id = %s AND status = 'pending' AND attempts < %s
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, payload
+    ''', (TELEGRAM_UPDATE_LEASE_SECONDS, chat_id, TELEGRAM_UPDATE_MAX_ATTEMPTS))
+    claimed = sorted(cur.fetchall())
+    conn.commit()
+    return claimed
+
+
+def is_scheduler_request(event: dict) -> bool:
+    '''Проверяет секрет планировщика; без SCHEDULER_SECRET в окружении служебные действия закрыты'''
+    secret = os.environ.get('SCHEDULER_SECRET')
+    headers = event.get('headers') or {}
+    provided = headers.get('X-Scheduler-Secret') or headers.get('x-scheduler-secret') or ''
+    return bool(secret) and hmac.compare_digest(provided.encode('utf-8'), secret.encode('utf-8'))
+
+
+def request_chat_summary(cur, conn, schema: str, chat_id: int):
+    '''Отмечает чат для сворачивания, когда за окном истории набралось TELEGRAM_SUMMARY_FOLD_MIN_MESSAGES сообщений'''
+    cur.execute(f'''
+        SELECT COUNT(*) FROM (
+            SELECT id FROM {schema}.telegram_messages
+            WHERE telegram_id = %s
+            AND id > COALESCE((
+                SELECT summary_message_id FROM {schema}.telegram_chat_summaries WHERE telegram_id = %s
+            ), 0)
+            ORDER BY created_at DESC, id DESC
+            OFFSET %s
+            LIMIT %s
+        ) overflow
+    ''', (chat_id, chat_id, TELEGRAM_HISTORY_MESSAGES, TELEGRAM_SUMMARY_FOLD_MIN_MESSAGES))
+    
+    if cur.fetchone()[0] >= TELEGRAM_SUMMARY_FOLD_MIN_MESSAGES:
+        cur.execute(f'''
+            INSERT INTO {schema}.telegram_chat_summaries (telegram_id, summary_requested_at)
+            VALUES (%s, NOW())
+            ON CONFLICT (telegram_id) DO UPDATE SET
+                summary_requested_at = COALESCE({schema}.telegram_chat_summaries.summary_requested_at, NOW())
+        ''', (chat_id,))
+    conn.commit()
+
+
+def summarize_pending_chats(cur, conn, schema: str, deadline: datetime) -> int:
+    '''Сворачивает историю отмеченных чатов в сводки до deadline; возвращает число выполненных сворачиваний'''
+    cur.execute(f'''
+        SELECT telegram_id FROM {schema}.telegram_chat_summaries
+        WHERE summary_requested_at IS NOT NULL
+        ORDER BY summary_requested_at
+        LIMIT %s
+    ''', (TELEGRAM_SUMMARY_BATCH_CHATS,))
+    chat_ids = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    
+    folded = 0
+    for chat_id in chat_ids:
+        while datetime.now() < deadline and refresh_chat_summary(cur, conn, schema, chat_id, deadline):
+            folded += 1
+    return folded
+
+
+def refresh_chat_summary(cur, conn, schema: str, chat_id: int, deadline: datetime) -> bool:
+    '''
+    Сворачивает следующую пачку сообщений чата, вышедших за окно истории, в накопительную сводку (telegram_chat_summaries):
+    по порядку от уже свёрнутой части вверх, не больше TELEGRAM_SUMMARY_FOLD_MAX_MESSAGES за раз.
+    Когда сворачивать нечего (меньше TELEGRAM_SUMMARY_FOLD_MIN_MESSAGES), снимает отметку чата.
+    Возвращает True, если сводка обновлена; ошибка только логируется.
+    '''
+    chatgpt_api_key = os.environ.get('POLZA_AI_API_KEY')
+    if not chatgpt_api_key:
+        return False
+    
+    try:
+        cur.execute(f'''
+            SELECT summary, summary_message_id FROM {schema}.telegram_chat_summaries WHERE telegram_id = %s
+        ''', (chat_id,))
+        row = cur.fetchone()
+        summary, summary_message_id = row if row else (None, None)
+        
+        # Окно последних TELEGRAM_HISTORY_MESSAGES сообщений уходит модели целиком и в сводку не попадает
+        cur.execute(f'''
+            SELECT id, sender, message_text
+            FROM {schema}.telegram_messages
+            WHERE telegram_id = %s AND id > %s
+            AND id < (
+                SELECT MIN(id) FROM (
+                    SELECT id FROM {schema}.telegram_messages
+                    WHERE telegram_id = %s
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                ) recent
+            )
+            ORDER BY id
+            LIMIT %s
+        ''', (chat_id, summary_message_id or 0, chat_id, TELEGRAM_HISTORY_MESSAGES, TELEGRAM_SUMMARY_FOLD_MAX_MESSAGES))
+        overflow = cur.fetchall()
+        conn.commit()
+        
+        if len(overflow) < TELEGRAM_SUMMARY_FOLD_MIN_MESSAGES:
+            cur.execute(f'''
+                UPDATE {schema}.telegram_chat_summaries SET summary_requested_at = NULL WHERE telegram_id = %s
+            ''', (chat_id,))
+            conn.commit()
+            return False
+        
+        transcript = '\n'.join(
+            f"{'Бот' if sender == 'bot' else 'Гость'}: {message_text}"
+            for _, sender, message_text in overflow
+        )
+        summary_req = request.Request('https://api.polza.ai/api/v1/chat/completions', data=json.dumps({
+            'model': TELEGRAM_SUMMARY_MODEL,
+            'messages': [
+                {
+                    'role': 'system',
+                    'content': 'Ты ведёшь краткое содержание переписки гостя с ботом бронирования турбазы. '
+                               'Обнови сводку с учётом новых реплик. Сохрани имя и телефон гостя, объекты, даты, '
+                               'число гостей, суммы, договорённости и открытые вопросы. Не больше 8 предложений.'
+                },
+                {
+                    'role': 'user',
+                    'content': f"Текущая сводка:\n{summary or 'нет'}\n\nНовые реплики:\n{transcript}"
+                }
+            ],
+            'temperature': 0.2,
+            'max_tokens': 300
+        }).encode('utf-8'), headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {chatgpt_api_key}'
+        }, method='POST')
+        
+        remaining = (deadline - datetime.now()).total_seconds()
+        if remaining <= 1:
+            return False
+        with request.urlopen(summary_req, timeout=min(TELEGRAM_AI_TIMEOUT_SECONDS, remaining)) as response:
+            new_summary = json.loads(response.read().decode())['choices'][0]['message']['content']
+        
+        # Параллельный запуск мог уже сдвинуть указатель — тогда эта сводка устарела
+        cur.execute(f'''
+            UPDATE {schema}.telegram_chat_summaries
+            SET summary = %s, summary_message_id = %s, updated_at = NOW()
+            WHERE telegram_id = %s AND summary_message_id = %s
+        ''', (new_summary, overflow[-1][0], chat_id, summary_message_id or 0))
+        updated = cur.rowcount == 1
+        conn.commit()
+        return updated
+    except Exception as e:
+        conn.rollback()
+        print(f'Chat {chat_id} summary refresh error: {e}')
+        return False
+
+
+def release_updates(cur, conn, schema: str, update_row_ids: list):
+    '''Возвращает обновления в очередь без траты попытки'''
+    cur.execute(f'''
+        UPDATE {schema}.telegram_updates
+        SET status = 'pending', attempts = GREATEST(attempts - 1, 0), locked_until = NULL
+        WHERE id = ANY(%s)
+    ''', (update_row_ids,))
+    conn.commit()
+
+
+def mark_updates_replied(cur, schema: str, update_row_ids: list):
+    '''Отмечает обновления отвеченными в текущей транзакции; фиксируется до отправки ответа гостю'''
+    cur.execute(f'''
+        UPDATE {schema}.telegram_updates SET replied_at = NOW()
+        WHERE id = ANY(%s)
+    ''', (update_row_ids,))
+
+
+def finish_updates(cur, conn, schema: str, results: list):
+    for update_row_id, error in results:
+        if error:
+            cur.execute(f'''
+                UPDATE {schema}.telegram_updates
+                SET status = CASE WHEN attempts >= %s THEN 'error' ELSE 'pending' END,
+                    last_error = %s,
+                    locked_until = NULL
+                WHERE id = %s
+            ''', (TELEGRAM_UPDATE_MAX_ATTEMPTS, error[:1000], update_row_id))
+        else:
+            cur.execute(f'''
+                UPDATE {schema}.telegram_updates
+                SET status = 'done', processed_at = NOW(), locked_until = NULL, last_error = NULL
+                WHERE id = %s
+            ''', (update_row_id,))
+    conn.commit()
+
+
+def get_bot_knowledge(cur, schema: str) -> dict:
+    '''
+    Возвращает базу знаний бота схемы: собранный системный промпт, настройки и справочник объектов.
+    Кэшируется на тёплом инстансе и пересобирается только при смене версии bot_knowledge_versions
+    (объекты, допродажи, настройки бота) или по TTL.
+    '''
+    cur.execute(f'SELECT version FROM {schema}.bot_knowledge_versions WHERE id = 1')
+    row = cur.fetchone()
+    version = row[0] if row else 0
+    
+    cached = BOT_KNOWLEDGE_CACHE.get(schema)
+    if cached and cached['version'] == version and time.monotonic() - cached['cached_at'] < BOT_KNOWLEDGE_TTL_SECONDS:
+        return cached['knowledge']
+    
+    knowledge = build_bot_knowledge(cur, schema)
+    BOT_KNOWLEDGE_CACHE[schema] = {
+        'version': version,
+        'knowledge': knowledge,
+        'cached_at': time.monotonic()
+    }
+    return knowledge
+
+
+def build_bot_knowledge(cur, schema: str) -> dict:
+    cur.execute(f'''
+        SELECT telegram_owner_id, base_name, admin_phone, admin_name, work_hours, extra_notes 
+        FROM {schema}.bot_settings LIMIT 1
+    ''')
+    bot_settings = cur.fetchone()
+    owner_telegram_id = bot_settings[0] if bot_settings and bot_settings[0] else None
+    base_name = bot_settings[1] if bot_settings and bot_settings[1] else 'Турбаза'
+    admin_phone = bot_settings[2] if bot_settings and bot_settings[2] else 'не указан'
+    admin_name = bot_settings[3] if bot_settings and bot_settings[3] else 'Администратор'
+    work_hours = bot_settings[4] if bot_settings and bot_settings[4] else ''
+    extra_notes = bot_settings[5] if bot_settings and bot_settings[5] else ''
+    
+    cur.execute(f'''
+        SELECT id, name, type, base_price, max_guests, description, photo_urls, map_link
+        FROM {schema}.units
+        ORDER BY name
+    ''')
+    units = cur.fetchall()
+    
+    cur.execute(f'''
+        SELECT name, description, price, category
+        FROM {schema}.additional_services
+        WHERE enabled = true
+        ORDER BY category, name
+    ''')
+    services = cur.fetchall()
+    
+    units_text = '\n'.join([f"- {u[1]} ({u[2]}): {u[3]}₽/сутки, до {u[4]} гостей. {u[5] or ''}" for u in units])
+    services_text = '\n'.join([f"- {s[0]} ({s[3]}): {s[2]}₽. {s[1] or ''}" for s in services]) if services else 'Пока не добавлено'
+    bookings_text = 'Нет активных бронирований'
+    
+    system_prompt = f'''Ты - ассистент по бронированию турбазы "{base_name}". Сегодня: 2026-01-18.
+
+ИНФОРМАЦИЯ О БАЗЕ:
+- Название: {base_name}
+- Администратор: {admin_name}
+- Телефон администратора: {admin_phone}
+{("- Время работы: " + work_hours) if work_hours else ""}
+{extra_notes if extra_notes else ""}
+
+ДОСТУПНЫЕ ОБЪЕКТЫ:
+{units_text}
+
+ДОПРОДАЖИ (предлагай клиентам):
+{services_text}
+
+ТЕКУЩИЕ БРОНИРОВАНИЯ (проверяй занятость):
+{bookings_text}
+
+ФОРМАТ ОТВЕТА:
+Ответ — объект с полями reply (текст для клиента) и intents (действия для системы).
+Клиент видит только reply. Действия добавляй в intents, в тексте reply их не описывай.
+Если действий нет, intents — пустой список. Поля действия, которые не нужны, заполняй null.
+
+ПОКАЗ ИНФОРМАЦИИ ОБ ОБЪЕКТЕ:
+Когда клиент спрашивает про конкретный объект ("расскажи про...", "покажи...", "что такое..."), добавь действие
+{{"intent": "show_unit", "unit_name": "Домик Сосновый"}}, reply оставь пустым.
+Система сама отправит фото и описание объекта.
+
+ПОКАЗ КАРТЫ / АДРЕСА:
+Когда клиент спрашивает "как добраться", "где вы находитесь", "адрес", "навигация", добавь действие
+{{"intent": "show_map"}}, reply оставь пустым.
+Система сама отправит ссылку на карты.
+
+ИЗМЕНЕНИЕ УЖЕ ОПЛАЧЕННОЙ БРОНИ:
+Если клиент хочет внести изменения в УЖЕ ОПЛАЧЕННУЮ бронь (убрать доп. услуги, перенести даты, вернуть деньги):
+1. Добавь действие {{"intent": "modify_booking", "booking_id": ID_брони_если_известен, "requested_changes": "описание что хочет изменить"}}
+2. Система САМА создаст заявку администратору
+3. В reply ответь клиенту:
+
+"Понял вас, вы хотите внести изменения в оплаченную бронь.
+
+Такие изменения обрабатывает администратор базы.
+Я передал вашу просьбу администратору.
+
+Для ускорения можете связаться напрямую:
+📞 {admin_phone}
+🏕 {base_name}"
+
+⚠️ КРИТИЧНО:
+- НЕ обещай возврат денег
+- НЕ меняй бронь самостоятельно
+- НЕ говори "мы не можем"
+- ВСЕГДА передавай запрос администратору
+
+ДВУХЭТАПНЫЙ ПРОЦЕСС БРОНИРОВАНИЯ:
+
+ЭТАП 1: СБОР ДАННЫХ И ПОКАЗ ИТОГОВОЙ СУММЫ
+1. Вежливо общайся с клиентом
+2. Предлагай ТОЛЬКО реальные объекты из списка выше
+3. Проверяй занятость по календарю
+4. Предлагай допродажи (завтраки, экскурсии)
+5. Собирай данные: даты, кол-во гостей, имя, телефон
+6. Когда ВСЕ данные собраны - покажи клиенту ПРЕДПРОСМОТР бронирования:
+
+"Подтвердите бронирование:
+
+🏠 Объект: [название объекта]
+📅 Даты: [check_in] – [check_out]
+👥 Гостей: [количество]
+
+💰 Стоимость:
+- Проживание: [сумма за ночи] ₽
+- Доп. услуги: [сумма допродаж] ₽
+——————————
+ИТОГО: [общая сумма] ₽
+
+Напишите «подтверждаю», чтобы перейти к оплате."
+
+⚠️ НА ЭТОМ ЭТАПЕ НЕ ДОБАВЛЯЙ ДЕЙСТВИЙ! Бронь ещё НЕ создаётся!
+
+ЭТАП 2: ПОДТВЕРЖДЕНИЕ И СОЗДАНИЕ БРОНИ
+7. Когда клиент пишет "подтверждаю", "да", "бронирую", "оплачиваю" - добавь действие С ДАННЫМИ ИЗ ДИАЛОГА, reply оставь пустым:
+   {{"intent": "confirm_booking", "guest_name": "Иван", "guest_phone": "+79001234567", "check_in": "2026-02-05", "check_out": "2026-02-08", "guests_count": 2, "unit_name": "Домик \"Сосновый\"", "additional_services_amount": 1500}}
+
+⚠️ КРИТИЧНО:
+- intent СТРОГО "confirm_booking"
+- ОБЯЗАТЕЛЬНО укажи ВСЕ поля: guest_name, guest_phone, check_in, check_out, guests_count, unit_name
+- additional_services_amount: сумма допродаж в рублях (0 если нет допродаж)
+- Используй данные из предыдущих сообщений диалога (особенно ИТОГО из предпросмотра!)
+- Система САМА отправит инструкции по оплате!
+
+8. КРИТИЧНО: unit_name должен ТОЧНО совпадать с названием из списка!
+9. Для нескольких объектов - отдельное действие для каждого
+10. Действия клиент НЕ видит - система их обработает и отправит платёжные данные!'''
+    
+    unit_index = build_unit_index([
+        {
+            'id': unit_id,
+            'name': name,
+            'type': unit_type,
+            'base_price': base_price,
+            'max_guests': max_guests,
+            'description': description,
+            'photo_urls': photo_urls or []
+        }
+        for unit_id, name, unit_type, base_price, max_guests, description, photo_urls, map_link in units
+    ])
+    
+    return {
+        'owner_telegram_id': owner_telegram_id,
+        'system_prompt': system_prompt,
+        'unit_index': unit_index,
+        'map_link': next((u[7] for u in units if u[7]), None)
+    }
+
+
+def parse_bot_response(content: str) -> tuple:
+    '''
+    Разбирает структурированный ответ модели (BOT_RESPONSE_FORMAT) в (текст для клиента, список намерений).
+    Пустые (null) поля намерений отбрасываются. Если модель вернула не JSON, весь ответ считается текстом.
+    '''
+    try:
+        parsed = json.loads(content or '{}')
+    except json.JSONDecodeError:
+        print('AI reply is not structured JSON, sent as plain text')
+        return (content or '').strip(), []
+    
+    if not isinstance(parsed, dict):
+        return '', []
+    
+    intents = [
+        {key: value for key, value in item.items() if value is not None}
+        for item in parsed.get('intents') or []
+        if isinstance(item, dict) and item.get('intent') in BOT_INTENTS
+    ]
+    return (parsed.get('reply') or '').strip(), intents
+
+
+def validate_and_create_booking(cur, conn, intent: dict, schema: str, chat_id: int, owner_telegram_id: int, unit_index: dict) -> dict:
+    '''Проверяет даты и создаёт заявку на бронь в соединении обработки чата; заявка фиксируется отдельным коммитом'''
+    try:
+        unit_name = intent.get('unit_name', '').strip()
+        check_in = intent.get('check_in')
+        check_out = intent.get('check_out')
+        guest_name = intent.get('guest_name')
+        guest_phone = intent.get('guest_phone')
+        guests_count = intent.get('guests_count', 1)
+        additional_services_amount = float(intent.get('additional_services_amount', 0))
+        
+        if not all([unit_name, check_in, check_out, guest_name, guest_phone]):
+            return {'success': False, 'error': 'Недостаточно данных для бронирования', 'unit_name': unit_name or 'Неизвестно'}
+        
+        unit, ambiguous = resolve_unit(unit_index, unit_name)
+        if not unit and not ambiguous:
+            # Кандидатов в базе знаний нет (например, объект добавлен только что) — ищем по триграммному индексу
+            # с теми же порогами похожести и отрыва от второго кандидата
+            cur.execute(f"""
+                SELECT id, name, base_price, similarity(LOWER(name), LOWER(%s))
+                FROM {schema}.units
+                WHERE LOWER(name) %% LOWER(%s)
+                ORDER BY 4 DESC
+                LIMIT 2
+            """, (unit_name, unit_name))
+            
+            unit, ambiguous = pick_best_match([
+                (score, {'id': unit_id, 'name': name, 'base_price': base_price})
+                for unit_id, name, base_price, score in cur.fetchall()
+            ])
+        
+        if ambiguous:
+            return {'success': False, 'error': f'Под название "{unit_name}" подходит несколько объектов, уточните объект', 'unit_name': unit_name}
+        if not unit:
+            return {'success': False, 'error': f'Объект "{unit_name}" не найден', 'unit_name': unit_name}
+        
+        unit_id, unit_name_db, base_price = unit['id'], unit['name'], unit['base_price']
+        
+        cur.execute(f"""
+            SELECT COUNT(*) FROM {schema}.bookings
+            WHERE unit_id = %s 
+              AND status = 'confirmed'
+              AND check_out > %s 
+              AND check_in < %s
+        """, (unit_id, check_in, check_out))
+        
+        if cur.fetchone()[0] > 0:
+            return {'success': False, 'error': 'Даты уже заняты', 'unit_name': unit_name}
+        
+        cur.execute(f"""
+            SELECT COUNT(*) FROM {schema}.pending_bookings
+            WHERE unit_id = %s 
+              AND verification_status = 'pending'
+              AND check_out > %s 
+              AND check_in < %s
+              AND expires_at > NOW()
+        """, (unit_id, check_in, check_out))
+        
+        if cur.fetchone()[0] > 0:
+            return {'success': False, 'error': 'Даты временно заняты (есть ожидающая заявка)', 'unit_name': unit_name}
+        
+        # Проверка закончена: не держим транзакцию открытой на время запросов к pricing-engine
+        conn.commit()
+        
+        try:
+            pricing_url = 'https://functions.poehali.dev/a4b5c99d-6289-44f5-835f-c865029c71e4'
+            date_in = datetime.strptime(check_in, '%Y-%m-%d')
+            date_out = datetime.strptime(check_out, '%Y-%m-%d')
+            nights = (date_out - date_in).days
+            
+            if nights <= 0:
+                return {'success': False, 'error': 'Некорректные даты', 'unit_name': unit_name}
+            
+            total_price = 0.0
+            current_date = date_in
+            
+            while current_date < date_out:
+                date_str = current_date.strftime('%Y-%m-%d')
+                try:
+                    price_req = request.Request(
+                        f'{pricing_url}?action=calculate_price&unit_id={unit_id}&date={date_str}',
+                        method='GET'
+                    )
+                    with request.urlopen(price_req, timeout=5) as price_resp:
+                        price_data = json.loads(price_resp.read().decode())
+                        day_price = float(price_data.get('price', base_price))
+                        total_price += day_price
+                except Exception as price_err:
+                    print(f'Failed to get price for {date_str}: {price_err}')
+                    total_price += float(base_price)
+                
+                current_date = current_date + timedelta(days=1)
+            
+            amount = total_price + additional_services_amount
+        except Exception as e:
+            print(f'Pricing calculation error: {e}')
+            amount = float(base_price) * nights if nights > 0 else 0
+        
+        # Получаем настройки СБП из bot_settings
+        cur.execute(f"""
+            SELECT sbp_phone, sbp_recipient_name 
+            FROM {schema}.bot_settings 
+            WHERE owner_id = (SELECT id FROM {schema}.users WHERE is_admin = true LIMIT 1)
+            LIMIT 1
+        """)
+        payment_info = cur.fetchone()
+        sbp_link = payment_info[0] if payment_info and payment_info[0] else 'Не настроено'
+        recipient_name = payment_info[1] if payment_info and payment_info[1] else 'Владелец'
+        
+        cur.execute(f"""
+            INSERT INTO {schema}.pending_bookings 
+            (unit_id, check_in, check_out, guest_name, guest_contact, 
+             telegram_chat_id, amount, payment_link, verification_status, expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending', NOW() + INTERVAL '24 hours')
+            RETURNING id
+        """, (unit_id, check_in, check_out, guest_name, guest_phone, chat_id, amount, sbp_link))
+        
+        pending_id = cur.fetchone()[0]
+        conn.commit()
+        
+        # Уведомление владельцу уходит вместе с платёжным сообщением гостю (параллельно)
+        owner_notification = None
+        if owner_telegram_id:
+            owner_notification = {
+                'chat_id': owner_telegram_id,
+                'text': f'''🆕 Новая заявка #{pending_id}
+
+👤 {guest_name}
+📞 {guest_phone}
+🏡 {unit_name_db}
+📅 {check_in} — {check_out}
+💰 {amount}₽
+
+Ожидает оплаты от гостя.'''
+            }
+        
+        return {
+            'success': True,
+            'pending_id': pending_id,
+            'amount': amount,
+            'sbp_link': sbp_link,
+            'recipient_name': recipient_name,
+            'unit_name': unit_name_db,
+            'owner_notification': owner_notification
+        }
+        
+    except Exception as e:
+        conn.rollback()
+        print(f'Booking validation error: {e}')
+        import traceback
+        traceback.print_exc()
+        return {'success': False, 'error': f'Ошибка создания бронирования: {str(e)}', 'unit_name': intent.get('unit_name', 'Неизвестно')}
+
+
+def handle_payment_screenshot(cur, conn, schema: str, chat_id: int, photo: list, update_row_id: int) -> bool:
+    '''Фото при ожидающей заявке — скриншот оплаты: передаём владельцу. Возвращает True, если обработано'''
+    file_id = photo[-1]['file_id']
+    file_url = get_file_url(file_id)
+    
+    cur.execute(f'''
+        SELECT id FROM {schema}.pending_bookings
+        WHERE telegram_chat_id = %s AND verification_status = 'pending'
+        ORDER BY created_at DESC LIMIT 1
+    ''', (chat_id,))
+    
+    pending = cur.fetchone()
+    
+    if pending:
+        pending_id = pending[0]
+        
+        cur.execute(f'''
+            UPDATE {schema}.pending_bookings
+            SET payment_screenshot_url = %s,
+                verification_status = 'awaiting_verification'
+            WHERE id = %s
+        ''', (file_url, pending_id))
+        mark_updates_replied(cur, schema, [update_row_id])
+        conn.commit()
+        
+        owner_telegram_id = get_bot_knowledge(cur, schema)['owner_telegram_id']
+        
+        cur.execute(f'''
+            SELECT guest_name, check_in, check_out, guest_contact
+            FROM {schema}.pending_bookings
+            WHERE id = %s
+        ''', (pending_id,))
+        
+        booking_info = cur.fetchone()
+        guest_name, check_in, check_out, guest_contact = booking_info
+        
+        # Подтверждение гостю и скриншот владельцу независимы — отправляем параллельно
+        sends = [('sendMessage', {
+            'chat_id': chat_id,
+            'text': '✅ Скриншот получен! Владелец проверит оплату и подтвердит бронирование.'
+        })]
+        if owner_telegram_id:
+            sends.append(('sendPhoto', {
+                'chat_id': owner_telegram_id,
+                'photo': file_id,
+                'caption': f'''💳 Получен скриншот оплаты!
+
+Заявка #{pending_id}
+👤 {guest_name}
+📞 {guest_contact}
+📅 {check_in} — {check_out}
+
+Проверьте оплату на сайте и подтвердите бронирование.'''
+            }))
+        send_concurrently(sends)
+        
+        return True
+    
+    return False
+
+
+def process_chat_updates(cur, conn, updates: list, schema: str, deadline: datetime) -> bool:
+    '''
+    Обрабатывает сообщения одного чата [(id строки очереди, update)]: скриншоты оплаты — по одному, а несколько
+    сообщений подряд сохраняются в историю и получают один общий ответ AI (ответ, намерения, создание заявки на бронь).
+    Работает в соединении вызывающего: каждый шаг (история, ответ бота, заявка) фиксируется своим коммитом.
+    Повтор безопасен: реплики гостя вставляются по строке очереди, отвеченные обновления пропускаются.
+    Возвращает False, если к deadline модель ещё не вызывалась — тогда обновления нужно вернуть в очередь.
+    '''
+    chat_id = None
+    user_data = {}
+    texts = []
+    pending_row_ids = []
+    
+    cur.execute(f'''
+        SELECT id FROM {schema}.telegram_updates
+        WHERE id = ANY(%s) AND replied_at IS NOT NULL
+    ''', ([update_row_id for update_row_id, _ in updates],))
+    replied_row_ids = {row[0] for row in cur.fetchall()}
+    
+    for update_row_id, update in updates:
+        if update_row_id in replied_row_ids:
+            continue
+        
+        message = update['message']
+        chat_id = message['chat']['id']
+        user_data = message.get('from', {})
+        text = message.get('text', '')
+        photo = message.get('photo')
+        
+        if photo:
+            if handle_payment_screenshot(cur, conn, schema, chat_id, photo, update_row_id):
+                continue
+            text = '[Фото отправлено]'
+        
+        cur.execute(f'''
+            INSERT INTO {schema}.telegram_messages (telegram_id, message_text, sender, created_at, update_row_id)
+            VALUES (%s, %s, %s, NOW(), %s)
+            ON CONFLICT (update_row_id) WHERE update_row_id IS NOT NULL DO NOTHING
+        ''', (chat_id, text, 'user', update_row_id))
+        conn.commit()
+        texts.append(text)
+        pending_row_ids.append(update_row_id)
+    
+    if not texts:
+        return True
+    
+    # Реплики гостя уже в истории, модель отвечает на всю пачку сразу
+    text = '\n'.join(texts)
+    
+    # Окно последних сообщений читается по индексу (telegram_id, created_at DESC), более ранние — в сводке
+    cur.execute(f'''
+        SELECT tm.message_text, tm.sender, tm.created_at
+        FROM {schema}.telegram_messages tm
+        WHERE tm.telegram_id = %s
+        ORDER BY tm.created_at DESC
+        LIMIT %s
+    ''', (chat_id, TELEGRAM_HISTORY_MESSAGES))
+    
+    history = cur.fetchall()
+    
+    cur.execute(f'SELECT summary FROM {schema}.telegram_chat_summaries WHERE telegram_id = %s', (chat_id,))
+    summary_row = cur.fetchone()
+    chat_summary = summary_row[0] if summary_row else None
+    
+    knowledge = get_bot_knowledge(cur, schema)
+    owner_telegram_id = knowledge['owner_telegram_id']
+    # Чтение закончено: не держим транзакцию открытой на время ответа модели
+    conn.commit()
+    
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    chatgpt_api_key = os.environ.get('POLZA_AI_API_KEY')
+    
+    if bot_token and chatgpt_api_key:
+        # Таймаут модели не выходит за бюджет вызова: иначе платформа оборвёт обработку посреди ответа
+        ai_timeout = min(TELEGRAM_AI_TIMEOUT_SECONDS, (deadline - datetime.now()).total_seconds())
+        if ai_timeout < TELEGRAM_AI_MIN_TIMEOUT_SECONDS:
+            return False
+        
+        try:
+            system_prompt = knowledge['system_prompt']
+            
+            messages = [{'role': 'system', 'content': system_prompt}]
+            if chat_summary:
+                messages.append({'role': 'system', 'content': f'Краткое содержание предыдущего разговора с гостем:\n{chat_summary}'})
+            
+            for msg_text, sender, created in reversed(history):
+                role = 'assistant' if sender == 'bot' else 'user'
+                messages.append({'role': role, 'content': msg_text})
+            
+            chatgpt_url = 'https://api.polza.ai/api/v1/chat/completions'
+            chatgpt_data = json.dumps({
+                'model': 'openai/gpt-4o',
+                'messages': messages,
+                'temperature': 0.7,
+                'response_format': BOT_RESPONSE_FORMAT
+            }).encode('utf-8')
+            
+            chatgpt_req = request.Request(chatgpt_url, data=chatgpt_data, headers={
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {chatgpt_api_key}'
+            }, method='POST')
+            
+            with request.urlopen(chatgpt_req, timeout=ai_timeout) as response:
+                chatgpt_response = json.loads(response.read().decode())
+            
+            clean_reply, intents = parse_bot_response(chatgpt_response['choices'][0]['message']['content'])
+            print(f'AI reply: {len(clean_reply)} chars, intents: {[intent["intent"] for intent in intents]}')
+            
+            # Дальше только отправки и заявки: при повторе после сбоя гость не получит второй ответ и вторую бронь
+            mark_updates_replied(cur, schema, pending_row_ids)
+            conn.commit()
+            
+            # Проверяем, есть ли confirm_booking с ЗАПОЛНЕННЫМИ данными
+            valid_confirm_booking = False
+            for intent in intents:
+                if intent.get('intent') == 'confirm_booking':
+                    # Проверяем, что ВСЕ обязательные поля заполнены
+                    if all([
+                        str(intent.get('guest_name', '')).strip(),
+                        str(intent.get('guest_phone', '')).strip(),
+                        str(intent.get('check_in', '')).strip(),
+                        str(intent.get('check_out', '')).strip(),
+                        str(intent.get('unit_name', '')).strip()
+                    ]):
+                        valid_confirm_booking = True
+                        break
+            
+            # Уведомления владельцу копятся по ходу обработки намерений и уходят вместе с последней отправкой гостю
+            owner_notifications = []
+            
+            # Для ВАЛИДНОГО confirm_booking НЕ отправляем ai_reply (только payment_message)
+            if not valid_confirm_booking:
+                ai_reply = clean_reply
+                
+                # Если модель вернула только действия, отправляем дефолтное сообщение
+                if not ai_reply or ai_reply.strip() == '':
+                    ai_reply = '✅ Понял вас!'
+                
+                cur.execute(f'''
+                    INSERT INTO {schema}.telegram_messages (telegram_id, message_text, sender, created_at)
+                    VALUES (%s, %s, %s, NOW())
+                ''', (chat_id, ai_reply, 'bot'))
+                conn.commit()
+                
+                telegram_call('sendMessage', {'chat_id': chat_id, 'text': ai_reply})
+            
+            if intents:
+                all_bookings = []
+                for intent in intents:
+                    # Обработка modify_booking - изменение оплаченной брони
+                    if intent.get('intent') == 'modify_booking':
+                        requested_changes = intent.get('requested_changes', text)
+                        booking_id = intent.get('booking_id')
+                        
+                        # Получаем данные клиента из истории или текущего чата
+                        cur.execute(f'''
+                            SELECT guest_name, guest_contact FROM {schema}.pending_bookings
+                            WHERE telegram_chat_id = %s
+                            ORDER BY created_at DESC LIMIT 1
+                        ''', (chat_id,))
+                        client_data = cur.fetchone()
+                        client_name = client_data[0] if client_data else user_data.get('first_name', 'Неизвестно')
+                        client_phone = client_data[1] if client_data else 'Неизвестно'
+                        
+                        # Создаём заявку на изменение
+                        cur.execute(f'''
+                            INSERT INTO {schema}.modification_requests 
+                            (booking_id, client_name, client_phone, telegram_chat_id, 
+                             message_from_client, requested_changes, status, created_at)
+                            VALUES (%s, %s, %s, %s, %s, %s, 'new', NOW())
+                            RETURNING id
+                        ''', (booking_id, client_name, client_phone, chat_id, text, 
+                              json.dumps({'description': requested_changes}, ensure_ascii=False)))
+                        
+                        request_id = cur.fetchone()[0]
+                        conn.commit()
+                        
+                        # Уведомляем владельца
+                        if owner_telegram_id:
+                            owner_notifications.append(('sendMessage', {
+                                'chat_id': owner_telegram_id,
+                                'text': f'''🔄 Запрос на изменение брони #{request_id}
+
+👤 {client_name}
+📞 {client_phone}
+
+💬 Запрос клиента:
+{text}
+
+Проверьте заявку в системе.'''
+                            }))
+                        
+                        continue
+                    
+                    # Обработка show_unit - показ объекта с фото и описанием
+                    if intent.get('intent') == 'show_unit':
+                        unit_data, _ = resolve_unit(knowledge['unit_index'], intent.get('unit_name', ''))
+                        
+                        if unit_data:
+                            name, desc, photos, price, guests = (
+                                unit_data['name'], unit_data['description'], unit_data['photo_urls'],
+                                unit_data['base_price'], unit_data['max_guests']
+                            )
+                            
+                            # Отправляем фото через sendMediaGroup (если есть)
+                            if photos and len(photos) > 0:
+                                media_group = []
+                                for idx, photo_url in enumerate(photos[:3]):
+                                    media_item = {
+                                        'type': 'photo',
+                                        'media': photo_url
+                                    }
+                                    # Подпись только к первому фото
+                                    if idx == 0:
+                                        caption_text = f"🏡 {name}\n\n{desc or 'Описание отсутствует'}\n\n👥 До {guests} гостей\n💰 От {price}₽/сутки"
+                                        media_item['caption'] = caption_text
+                                    media_group.append(media_item)
+                                
+                                telegram_call('sendMediaGroup', {'chat_id': chat_id, 'media': media_group})
+                            else:
+                                # Если фото нет - отправляем только текст
+                                text_only = f"🏡 {name}\n\n{desc or 'Описание отсутствует'}\n\n👥 До {guests} гостей\n💰 От {price}₽/сутки"
+                                telegram_call('sendMessage', {'chat_id': chat_id, 'text': text_only})
+                        continue
+                    
+                    # Обработка show_map - показ карты
+                    if intent.get('intent') == 'show_map':
+                        # Берём первый объект с картой (можно улучшить логику)
+                        map_link = knowledge['map_link']
+                        
+                        if map_link:
+                            map_text = f"📍 Как добраться:\n{map_link}"
+                        else:
+                            map_text = "📍 Адрес будет отправлен владельцем после подтверждения бронирования"
+                        
+                        telegram_call('sendMessage', {'chat_id': chat_id, 'text': map_text})
+                        continue
+                    
+                    # Обработка бронирования
+                    if intent.get('intent') == 'confirm_booking':
+                        result = validate_and_create_booking(cur, conn, intent, schema, chat_id, owner_telegram_id, knowledge['unit_index'])
+                        if result.get('owner_notification'):
+                            owner_notifications.append(('sendMessage', result['owner_notification']))
+                        all_bookings.append({
+                            'intent': intent,
+                            'result': result
+                        })
+                
+                if all_bookings:
+                    payment_messages = []
+                    total_amount = 0
+                    sbp_link = ''
+                    recipient_name = ''
+                    
+                    for booking in all_bookings:
+                        intent = booking['intent']
+                        result = booking['result']
+                        
+                        if result['success']:
+                            payment_messages.append(f'''✅ {result['unit_name']}
+📅 {intent['check_in']} — {intent['check_out']}
+💰 {result['amount']}₽''')
+                            total_amount += result['amount']
+                            sbp_link = result['sbp_link']
+                            recipient_name = result['recipient_name']
+                        else:
+                            payment_messages.append(f'''❌ {result['unit_name']}: {result['error']}''')
+                    
+                    if total_amount > 0:
+                        payment_message = f'''🎉 Бронирование создано!
+
+{chr(10).join(payment_messages)}
+
+💰 Сумма к оплате: {total_amount} ₽
+💳 Оплата по СБП
+
+Телефон: {sbp_link}
+Получатель: {recipient_name}
+
+📸 После оплаты отправьте скриншот сюда'''
+                    else:
+                        payment_message = f'''❌ Не удалось создать бронирования:
+
+{chr(10).join(payment_messages)}
+
+Попробуйте выбрать другие даты или объекты.'''
+                    
+                    # Сохраняем payment_message в БД
+                    cur.execute(f'''
+                        INSERT INTO {schema}.telegram_messages (telegram_id, message_text, sender, created_at)
+                        VALUES (%s, %s, %s, NOW())
+                    ''', (chat_id, payment_message, 'bot'))
+                    conn.commit()
+                    
+                    send_concurrently([('sendMessage', {'chat_id': chat_id, 'text': payment_message})], owner_notifications)
+                    owner_notifications = []
+                    print(f'✅ Payment message sent to client')
+                    
+                    # TERMINAL EVENT: confirm_booking завершён, выходим
+                    if valid_confirm_booking:
+                        return True
+                
+                if owner_notifications:
+                    send_concurrently([], owner_notifications)
+
+        except Exception as telegram_error:
+            conn.rollback()
+            print(f'AI/Telegram error: {telegram_error}')
+            import traceback
+            traceback.print_exc()
+            try:
+                if os.environ.get('TELEGRAM_BOT_TOKEN'):
+                    telegram_call('sendMessage', {
+                        'chat_id': chat_id,
+                        'text': 'Спасибо за ваше сообщение! Мы получили ваш запрос и скоро свяжемся с вами.'
+                    })
+            except:
+                pass
+    
+    return True
@@ -0,0 +1,74 @@
+'''Клиент Telegram Bot API: один пул keep-alive соединений на тёплый инстанс, таймауты и параллельные отправки'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+TELEGRAM_API_URL = 'https://api.telegram.org'
+TELEGRAM_CONNECT_TIMEOUT_SECONDS = 3
+TELEGRAM_READ_TIMEOUT_SECONDS = 10
+TELEGRAM_MAX_CONNECTIONS = 16
+TELEGRAM_KEEPALIVE_SECONDS = 60
+TELEGRAM_SEND_CONCURRENCY = 8
+
+TELEGRAM_CLIENT = None
+TELEGRAM_CLIENT_LOCK = threading.Lock()
+TELEGRAM_SEND_POOL = ThreadPoolExecutor(max_workers=TELEGRAM_SEND_CONCURRENCY)
+
+
+def get_telegram_client() -> httpx.Client:
+    global TELEGRAM_CLIENT
+    with TELEGRAM_CLIENT_LOCK:
+        if TELEGRAM_CLIENT is None:
+            TELEGRAM_CLIENT = httpx.Client(
+                timeout=httpx.Timeout(TELEGRAM_READ_TIMEOUT_SECONDS, connect=TELEGRAM_CONNECT_TIMEOUT_SECONDS),
+                limits=httpx.Limits(
+                    max_connections=TELEGRAM_MAX_CONNECTIONS,
+                    max_keepalive_connections=TELEGRAM_MAX_CONNECTIONS,
+                    keepalive_expiry=TELEGRAM_KEEPALIVE_SECONDS
+                )
+            )
+    return TELEGRAM_CLIENT
+
+
+def telegram_call(method: str, payload: dict, bot_token: str = None) -> dict:
+    '''Вызывает метод Bot API и возвращает разобранный ответ; сетевая ошибка, таймаут и ошибка Telegram — httpx.HTTPError'''
+    token = bot_token or os.environ.get('TELEGRAM_BOT_TOKEN')
+    response = get_telegram_client().post(f'{TELEGRAM_API_URL}/bot{token}/{method}', json=payload)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_file_url(file_id: str, bot_token: str = None) -> str:
+    token = bot_token or os.environ.get('TELEGRAM_BOT_TOKEN')
+    file_info = telegram_call('getFile', {'file_id': file_id}, token)
+    return f"{TELEGRAM_API_URL}/file/bot{token}/{file_info['result']['file_path']}"
+
+
+def send_concurrently(required: list, optional: list = (), bot_token: str = None) -> list:
+    '''
+    Отправляет независимые вызовы [(метод, payload)] параллельно и возвращает ответы обязательных по порядку.
+    Ошибки необязательных (уведомления владельцу) только логируются, первая ошибка обязательного пробрасывается.
+    '''
+    required_futures = [TELEGRAM_SEND_POOL.submit(telegram_call, method, payload, bot_token) for method, payload in required]
+    optional_futures = [TELEGRAM_SEND_POOL.submit(telegram_call, method, payload, bot_token) for method, payload in optional]
+
+    for future, (method, payload) in zip(optional_futures, optional):
+        try:
+            future.result()
+        except Exception as e:
+            print(f'Telegram {method} to {payload.get("chat_id")} failed: {e}')
+
+    first_error = None
+    results = []
+    for future in required_futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            first_error = first_error or e
+            results.append(None)
+
+    if first_error:
+        raise first_error
+    return results
@@ -0,0 +1,83 @@
+'''Нечёткий поиск объекта по названию из ответа модели: нормализация, транслитерация и триграммы как в pg_trgm'''
+import re
+
+UNIT_MATCH_MIN_SIMILARITY = 0.4
+# Если второй кандидат почти так же похож, объект не выбирается — лучше переспросить, чем забронировать не тот
+UNIT_MATCH_MIN_MARGIN = 0.05
+
+CYRILLIC_TO_LATIN = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya'
+}
+
+NON_WORD_PATTERN = re.compile(r'[^\w]+')
+
+
+def unit_name_key(name: str) -> str:
+    '''Ключ названия: «Домик "Сосновый"», 'домик сосновый' и 'Domik Sosnovyi' дают один и тот же ключ'''
+    words = NON_WORD_PATTERN.sub(' ', (name or '').lower()).split()
+    text = ' '.join(words)
+    # Латинские варианты написания звуков сводим к одному, чтобы kh/h и y/i не мешали сравнению
+    text = ''.join(CYRILLIC_TO_LATIN.get(char, char) for char in text)
+    return text.replace('kh', 'h').replace('y', 'i')
+
+
+def trigrams(key: str) -> set:
+    '''Триграммы по словам с дополнением пробелами, как в pg_trgm'''
+    result = set()
+    for word in key.split():
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def build_unit_index(units: list) -> dict:
+    '''Индекс объектов схемы: точные ключи и триграммы для нечёткого поиска'''
+    by_key = {}
+    entries = []
+    for unit in units:
+        key = unit_name_key(unit['name'])
+        if key in by_key:
+            continue
+        by_key[key] = unit
+        entries.append((key, trigrams(key), unit))
+    return {'by_key': by_key, 'entries': entries}
+
+
+def resolve_unit(index: dict, name: str) -> tuple:
+    '''Возвращает (объект или None, неоднозначно ли совпадение) по названию из ответа модели'''
+    key = unit_name_key(name)
+    if not key:
+        return None, False
+
+    unit = index['by_key'].get(key)
+    if unit:
+        return unit, False
+
+    query = trigrams(key)
+    scored = []
+    for entry_key, entry_trigrams, entry_unit in index['entries']:
+        union = len(query | entry_trigrams)
+        score = len(query & entry_trigrams) / union if union else 0.0
+        # Модель часто сокращает название до отличительного слова: «Сосновый» вместо «Домик Сосновый»
+        if f' {key} ' in f' {entry_key} ':
+            score = max(score, UNIT_MATCH_MIN_SIMILARITY)
+        scored.append((score, entry_unit))
+
+    return pick_best_match(scored)
+
+
+def pick_best_match(scored: list) -> tuple:
+    '''Выбирает лучший из [(похожесть, объект)]: (объект или None, неоднозначно ли совпадение)'''
+    candidates = sorted(
+        [item for item in scored if item[0] >= UNIT_MATCH_MIN_SIMILARITY],
+        key=lambda item: item[0],
+        reverse=True
+    )
+    if not candidates:
+        return None, False
+    if len(candidates) > 1 and candidates[0][0] - candidates[1][0] < UNIT_MATCH_MIN_MARGIN:
+        return None, True
+    return candidates[0][1], False
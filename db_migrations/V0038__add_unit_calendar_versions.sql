@@ -0,0 +1,40 @@
+-- Версия календаря объекта: увеличивается при любом изменении броней объекта.
+-- Используется calendar-sync для кэширования iCal-экспорта и ответов ETag/Last-Modified.
+CREATE TABLE IF NOT EXISTS unit_calendar_versions (
+    unit_id INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1,
+    changed_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION bump_unit_calendar_version() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.unit_id IS NOT NULL THEN
+        INSERT INTO unit_calendar_versions (unit_id, version, changed_at)
+        VALUES (NEW.unit_id, 1, NOW())
+        ON CONFLICT (unit_id) DO UPDATE
+        SET version = unit_calendar_versions.version + 1, changed_at = NOW();
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.unit_id IS NOT NULL
+       AND (TG_OP = 'DELETE' OR OLD.unit_id IS DISTINCT FROM NEW.unit_id) THEN
+        INSERT INTO unit_calendar_versions (unit_id, version, changed_at)
+        VALUES (OLD.unit_id, 1, NOW())
+        ON CONFLICT (unit_id) DO UPDATE
+        SET version = unit_calendar_versions.version + 1, changed_at = NOW();
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bookings_calendar_version ON bookings;
+CREATE TRIGGER trg_bookings_calendar_version
+AFTER INSERT OR UPDATE OR DELETE ON bookings
+FOR EACH ROW EXECUTE FUNCTION bump_unit_calendar_version();
+
+-- Начальные версии для уже существующих объектов
+INSERT INTO unit_calendar_versions (unit_id, version, changed_at)
+SELECT id, 1, NOW() FROM units
+ON CONFLICT (unit_id) DO NOTHING;
+
+COMMENT ON TABLE unit_calendar_versions IS 'Версия календаря броней объекта для инвалидации кэша iCal-экспорта';
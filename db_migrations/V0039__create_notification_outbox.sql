@@ -0,0 +1,19 @@
+-- Outbox уведомлений владельцам: запись создаётся в одной транзакции с данными,
+-- отправка в Telegram выполняется после коммита
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id SERIAL PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    chat_id VARCHAR(100) NOT NULL,
+    message TEXT NOT NULL,
+    dedup_key VARCHAR(255) NOT NULL UNIQUE,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending
+ON notification_outbox(id) WHERE status = 'pending';
+
+COMMENT ON TABLE notification_outbox IS 'Очередь уведомлений владельцам (сводки импорта броней и др.)';
+COMMENT ON COLUMN notification_outbox.dedup_key IS 'Ключ дедупликации: повторная постановка той же сводки игнорируется';
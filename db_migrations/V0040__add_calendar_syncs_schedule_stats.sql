@@ -0,0 +1,22 @@
+-- Статистика фидов для адаптивного расписания синхронизации календарей
+ALTER TABLE calendar_syncs
+ADD COLUMN IF NOT EXISTS last_change_at TIMESTAMP,
+ADD COLUMN IF NOT EXISTS error_streak INTEGER NOT NULL DEFAULT 0,
+ADD COLUMN IF NOT EXISTS last_error TEXT,
+ADD COLUMN IF NOT EXISTS last_fetch_ms INTEGER,
+ADD COLUMN IF NOT EXISTS sync_interval_minutes INTEGER NOT NULL DEFAULT 30,
+ADD COLUMN IF NOT EXISTS next_sync_at TIMESTAMP;
+
+-- Разносим первые запуски существующих фидов по 30-минутному окну
+UPDATE calendar_syncs
+SET next_sync_at = NOW() + random() * INTERVAL '30 minutes'
+WHERE next_sync_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_calendar_syncs_next_sync
+ON calendar_syncs(next_sync_at) WHERE is_active = true;
+
+COMMENT ON COLUMN calendar_syncs.last_change_at IS 'Когда синхронизация последний раз принесла изменения';
+COMMENT ON COLUMN calendar_syncs.error_streak IS 'Количество ошибок подряд';
+COMMENT ON COLUMN calendar_syncs.last_fetch_ms IS 'Длительность последней загрузки фида, мс';
+COMMENT ON COLUMN calendar_syncs.sync_interval_minutes IS 'Текущий адаптивный интервал опроса';
+COMMENT ON COLUMN calendar_syncs.next_sync_at IS 'Время следующего опроса планировщиком';
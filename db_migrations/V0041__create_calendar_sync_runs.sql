@@ -0,0 +1,27 @@
+-- История прогонов синхронизации календарей для метрик стоимости и регрессий фидов
+CREATE TABLE IF NOT EXISTS calendar_sync_runs (
+    id BIGSERIAL PRIMARY KEY,
+    sync_id INTEGER NOT NULL,
+    unit_id INTEGER NOT NULL,
+    platform VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL CHECK (status IN ('ok', 'error')),
+    started_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    fetch_ms INTEGER,
+    bytes_downloaded INTEGER NOT NULL DEFAULT 0,
+    http_status INTEGER,
+    events_parsed INTEGER NOT NULL DEFAULT 0,
+    inserts INTEGER NOT NULL DEFAULT 0,
+    updates INTEGER NOT NULL DEFAULT 0,
+    cancellations INTEGER NOT NULL DEFAULT 0,
+    parse_ms INTEGER,
+    db_ms INTEGER,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_calendar_sync_runs_started ON calendar_sync_runs(started_at);
+CREATE INDEX IF NOT EXISTS idx_calendar_sync_runs_sync ON calendar_sync_runs(sync_id, started_at);
+
+COMMENT ON TABLE calendar_sync_runs IS 'История синхронизаций календарей: задержка, объём, счётчики изменений';
+COMMENT ON COLUMN calendar_sync_runs.updates IS 'Импортированные брони, у которых изменилось описание';
+COMMENT ON COLUMN calendar_sync_runs.cancellations IS 'Будущие импортированные брони, пропавшие из фида (автоматически не снимаются)';
+COMMENT ON COLUMN calendar_sync_runs.db_ms IS 'Время работы с БД при применении фида, мс';
@@ -0,0 +1,90 @@
+-- Версия данных владельца: увеличивается при изменении броней, заявок, объектов,
+-- допродаж и настроек бота. По ней инвалидируются кэши AI-ассистента.
+CREATE TABLE IF NOT EXISTS owner_data_versions (
+    owner_id INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1,
+    changed_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION bump_owner_data_version_for(p_owner_id INTEGER) RETURNS VOID AS $$
+BEGIN
+    IF p_owner_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO owner_data_versions (owner_id, version, changed_at)
+    VALUES (p_owner_id, 1, NOW())
+    ON CONFLICT (owner_id) DO UPDATE
+    SET version = owner_data_versions.version + 1, changed_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Для таблиц с owner_id (units, additional_services, bot_settings)
+CREATE OR REPLACE FUNCTION bump_owner_data_version_by_owner() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM bump_owner_data_version_for(NEW.owner_id);
+    END IF;
+
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.owner_id IS DISTINCT FROM NEW.owner_id) THEN
+        PERFORM bump_owner_data_version_for(OLD.owner_id);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Для таблиц, привязанных к владельцу через объект (bookings, pending_bookings)
+CREATE OR REPLACE FUNCTION bump_owner_data_version_by_unit() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM bump_owner_data_version_for((SELECT owner_id FROM units WHERE id = NEW.unit_id));
+    END IF;
+
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.unit_id IS DISTINCT FROM NEW.unit_id) THEN
+        PERFORM bump_owner_data_version_for((SELECT owner_id FROM units WHERE id = OLD.unit_id));
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_units_owner_version ON units;
+CREATE TRIGGER trg_units_owner_version
+AFTER INSERT OR UPDATE OR DELETE ON units
+FOR EACH ROW EXECUTE FUNCTION bump_owner_data_version_by_owner();
+
+DROP TRIGGER IF EXISTS trg_additional_services_owner_version ON additional_services;
+CREATE TRIGGER trg_additional_services_owner_version
+AFTER INSERT OR UPDATE OR DELETE ON additional_services
+FOR EACH ROW EXECUTE FUNCTION bump_owner_data_version_by_owner();
+
+DROP TRIGGER IF EXISTS trg_bot_settings_owner_version ON bot_settings;
+CREATE TRIGGER trg_bot_settings_owner_version
+AFTER INSERT OR UPDATE OR DELETE ON bot_settings
+FOR EACH ROW EXECUTE FUNCTION bump_owner_data_version_by_owner();
+
+DROP TRIGGER IF EXISTS trg_bookings_owner_version ON bookings;
+CREATE TRIGGER trg_bookings_owner_version
+AFTER INSERT OR UPDATE OR DELETE ON bookings
+FOR EACH ROW EXECUTE FUNCTION bump_owner_data_version_by_unit();
+
+DROP TRIGGER IF EXISTS trg_pending_bookings_owner_version ON pending_bookings;
+CREATE TRIGGER trg_pending_bookings_owner_version
+AFTER INSERT OR UPDATE OR DELETE ON pending_bookings
+FOR EACH ROW EXECUTE FUNCTION bump_owner_data_version_by_unit();
+
+INSERT INTO owner_data_versions (owner_id, version, changed_at)
+SELECT DISTINCT owner_id, 1, NOW() FROM units WHERE owner_id IS NOT NULL
+ON CONFLICT (owner_id) DO NOTHING;
+
+-- Снимок контекста владельца для AI-ассистента (переживает холодный старт функции)
+CREATE TABLE IF NOT EXISTS owner_context_snapshots (
+    owner_id INTEGER PRIMARY KEY,
+    version BIGINT NOT NULL,
+    context JSONB NOT NULL,
+    built_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+COMMENT ON TABLE owner_data_versions IS 'Версия данных владельца для инвалидации кэшей (брони, объекты, допродажи, настройки)';
+COMMENT ON TABLE owner_context_snapshots IS 'Кэш собранного контекста владельца для AI-ассистента';
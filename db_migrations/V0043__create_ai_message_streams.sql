@@ -0,0 +1,14 @@
+-- Частичные ответы AI-ассистента во время потоковой генерации (клиент опрашивает chat-stream)
+CREATE TABLE IF NOT EXISTS ai_message_streams (
+    id VARCHAR(64) PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    conversation_id INTEGER,
+    content TEXT NOT NULL DEFAULT '',
+    status VARCHAR(20) NOT NULL DEFAULT 'streaming' CHECK (status IN ('streaming', 'done', 'error')),
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_message_streams_created ON ai_message_streams(created_at);
+
+COMMENT ON TABLE ai_message_streams IS 'Накопленный текст ответа AI во время генерации; хранится сутки';
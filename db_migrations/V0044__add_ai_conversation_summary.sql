@@ -0,0 +1,9 @@
+-- Накопительная сводка разговора AI-ассистента: старые реплики сворачиваются в неё,
+-- чтобы размер промпта не рос с длиной истории
+ALTER TABLE ai_conversations
+ADD COLUMN IF NOT EXISTS summary TEXT,
+ADD COLUMN IF NOT EXISTS summary_message_id INTEGER,
+ADD COLUMN IF NOT EXISTS summary_updated_at TIMESTAMP;
+
+COMMENT ON COLUMN ai_conversations.summary IS 'Краткое содержание свёрнутой части разговора';
+COMMENT ON COLUMN ai_conversations.summary_message_id IS 'Последнее сообщение (ai_messages.id), вошедшее в сводку';
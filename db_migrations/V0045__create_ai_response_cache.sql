@@ -0,0 +1,25 @@
+-- Кэш ответов AI-ассистента на повторяющиеся вопросы владельца.
+-- Ключ: владелец + нормализованный вопрос; ответ действителен для версии данных и даты.
+CREATE TABLE IF NOT EXISTS ai_response_cache (
+    owner_id INTEGER NOT NULL,
+    question_key VARCHAR(500) NOT NULL,
+    context_version BIGINT NOT NULL,
+    context_date DATE NOT NULL,
+    response TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_hit_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (owner_id, question_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_response_cache_owner_last_hit
+ON ai_response_cache(owner_id, last_hit_at DESC);
+
+-- Счётчики попаданий и промахов кэша для метрики hit rate
+CREATE TABLE IF NOT EXISTS ai_response_cache_stats (
+    owner_id INTEGER PRIMARY KEY,
+    hits BIGINT NOT NULL DEFAULT 0,
+    misses BIGINT NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE ai_response_cache IS 'Готовые ответы AI-ассистента, действительные до изменения данных владельца';
@@ -0,0 +1,239 @@
+-- Предрасчитанные показатели (KPI) по объектам и владельцам.
+-- Поддерживаются триггерами на bookings и units, читаются AI-ассистентом, дашбордами
+-- и ценообразованием без пересчёта по сырым броням.
+
+-- Занятые ночи объекта: строка есть только для ночи, занятой подтверждённой бронью
+CREATE TABLE IF NOT EXISTS unit_daily_stats (
+    unit_id INTEGER NOT NULL REFERENCES units(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    owner_id INTEGER,
+    check_ins INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (unit_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_unit_daily_stats_owner_day ON unit_daily_stats(owner_id, day);
+
+CREATE TABLE IF NOT EXISTS owner_daily_stats (
+    owner_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    booked_units INTEGER NOT NULL DEFAULT 0,
+    check_ins INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner_id, day)
+);
+
+-- Загрузка = занятые ночи / доступные ночи объекта (дни месяца)
+CREATE TABLE IF NOT EXISTS unit_monthly_stats (
+    unit_id INTEGER NOT NULL REFERENCES units(id) ON DELETE CASCADE,
+    month DATE NOT NULL,
+    owner_id INTEGER,
+    bookings INTEGER NOT NULL DEFAULT 0,
+    booked_nights INTEGER NOT NULL DEFAULT 0,
+    available_nights INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    occupancy_rate NUMERIC(5, 1) GENERATED ALWAYS AS (
+        CASE WHEN available_nights > 0 THEN ROUND(booked_nights * 100.0 / available_nights, 1) ELSE 0 END
+    ) STORED,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (unit_id, month)
+);
+
+CREATE INDEX IF NOT EXISTS idx_unit_monthly_stats_owner_month ON unit_monthly_stats(owner_id, month);
+
+-- Загрузка владельца = занятые ночи всех объектов / (число объектов * дни месяца)
+CREATE TABLE IF NOT EXISTS owner_monthly_stats (
+    owner_id INTEGER NOT NULL,
+    month DATE NOT NULL,
+    bookings INTEGER NOT NULL DEFAULT 0,
+    booked_nights INTEGER NOT NULL DEFAULT 0,
+    available_nights INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    occupancy_rate NUMERIC(5, 1) GENERATED ALWAYS AS (
+        CASE WHEN available_nights > 0 THEN ROUND(booked_nights * 100.0 / available_nights, 1) ELSE 0 END
+    ) STORED,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (owner_id, month)
+);
+
+CREATE OR REPLACE FUNCTION refresh_owner_monthly_kpi(p_owner_id INTEGER, p_month DATE) RETURNS VOID AS $$
+BEGIN
+    IF p_owner_id IS NULL THEN
+        RETURN;
+    END IF;
+
+    INSERT INTO owner_monthly_stats (owner_id, month, bookings, booked_nights, available_nights, revenue, updated_at)
+    SELECT
+        p_owner_id,
+        p_month,
+        COALESCE((SELECT SUM(check_ins) FROM owner_daily_stats
+                  WHERE owner_id = p_owner_id AND day >= p_month AND day < p_month + INTERVAL '1 month'), 0),
+        COALESCE((SELECT SUM(booked_units) FROM owner_daily_stats
+                  WHERE owner_id = p_owner_id AND day >= p_month AND day < p_month + INTERVAL '1 month'), 0),
+        (SELECT COUNT(*) FROM units WHERE owner_id = p_owner_id) * ((p_month + INTERVAL '1 month')::date - p_month),
+        COALESCE((SELECT SUM(revenue) FROM owner_daily_stats
+                  WHERE owner_id = p_owner_id AND day >= p_month AND day < p_month + INTERVAL '1 month'), 0),
+        NOW()
+    ON CONFLICT (owner_id, month) DO UPDATE
+    SET bookings = EXCLUDED.bookings,
+        booked_nights = EXCLUDED.booked_nights,
+        available_nights = EXCLUDED.available_nights,
+        revenue = EXCLUDED.revenue,
+        updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересчёт показателей объекта за период [p_from, p_to): дневные строки, месяцы периода и итоги владельца
+CREATE OR REPLACE FUNCTION refresh_unit_kpi(p_unit_id INTEGER, p_from DATE, p_to DATE) RETURNS VOID AS $$
+DECLARE
+    v_owner_id INTEGER;
+    v_month DATE;
+BEGIN
+    IF p_unit_id IS NULL OR p_to <= p_from THEN
+        RETURN;
+    END IF;
+
+    SELECT owner_id INTO v_owner_id FROM units WHERE id = p_unit_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    -- Параллельные изменения броней одного владельца пересчитывают одни и те же строки
+    PERFORM pg_advisory_xact_lock(hashtext('kpi_rollup'), COALESCE(v_owner_id, -p_unit_id));
+
+    DELETE FROM unit_daily_stats WHERE unit_id = p_unit_id AND day >= p_from AND day < p_to;
+
+    -- Пересекающиеся брони занимают ночь один раз, выручка относится к дню заезда
+    INSERT INTO unit_daily_stats (unit_id, day, owner_id, check_ins, revenue)
+    SELECT
+        p_unit_id,
+        d.day,
+        v_owner_id,
+        COUNT(*) FILTER (WHERE b.check_in = d.day),
+        COALESCE(SUM(b.total_price) FILTER (WHERE b.check_in = d.day), 0)
+    FROM (SELECT generate_series(p_from, p_to - 1, INTERVAL '1 day')::date AS day) d
+    JOIN bookings b ON b.unit_id = p_unit_id
+        AND b.status = 'confirmed'
+        AND b.check_in <= d.day
+        AND b.check_out > d.day
+    GROUP BY d.day;
+
+    IF v_owner_id IS NOT NULL THEN
+        DELETE FROM owner_daily_stats WHERE owner_id = v_owner_id AND day >= p_from AND day < p_to;
+
+        INSERT INTO owner_daily_stats (owner_id, day, booked_units, check_ins, revenue)
+        SELECT v_owner_id, day, COUNT(*), SUM(check_ins), SUM(revenue)
+        FROM unit_daily_stats
+        WHERE owner_id = v_owner_id AND day >= p_from AND day < p_to
+        GROUP BY day;
+    END IF;
+
+    FOR v_month IN
+        SELECT generate_series(DATE_TRUNC('month', p_from), DATE_TRUNC('month', p_to - 1), INTERVAL '1 month')::date
+    LOOP
+        INSERT INTO unit_monthly_stats (unit_id, month, owner_id, bookings, booked_nights, available_nights, revenue, updated_at)
+        SELECT
+            p_unit_id,
+            v_month,
+            v_owner_id,
+            COALESCE(SUM(check_ins), 0),
+            COUNT(*),
+            (v_month + INTERVAL '1 month')::date - v_month,
+            COALESCE(SUM(revenue), 0),
+            NOW()
+        FROM unit_daily_stats
+        WHERE unit_id = p_unit_id AND day >= v_month AND day < v_month + INTERVAL '1 month'
+        ON CONFLICT (unit_id, month) DO UPDATE
+        SET owner_id = EXCLUDED.owner_id,
+            bookings = EXCLUDED.bookings,
+            booked_nights = EXCLUDED.booked_nights,
+            available_nights = EXCLUDED.available_nights,
+            revenue = EXCLUDED.revenue,
+            updated_at = NOW();
+
+        PERFORM refresh_owner_monthly_kpi(v_owner_id, v_month);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_kpi_on_booking_change() RETURNS TRIGGER AS $$
+BEGIN
+    -- Показатели зависят только от подтверждённых броней, их дат, объекта и суммы
+    IF TG_OP = 'UPDATE'
+       AND OLD.status IS NOT DISTINCT FROM NEW.status
+       AND OLD.unit_id IS NOT DISTINCT FROM NEW.unit_id
+       AND OLD.check_in IS NOT DISTINCT FROM NEW.check_in
+       AND OLD.check_out IS NOT DISTINCT FROM NEW.check_out
+       AND OLD.total_price IS NOT DISTINCT FROM NEW.total_price THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'confirmed' THEN
+        PERFORM refresh_unit_kpi(OLD.unit_id, OLD.check_in, OLD.check_out);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'confirmed' THEN
+        PERFORM refresh_unit_kpi(NEW.unit_id, NEW.check_in, NEW.check_out);
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_bookings_kpi ON bookings;
+CREATE TRIGGER trg_bookings_kpi
+AFTER INSERT OR UPDATE OR DELETE ON bookings
+FOR EACH ROW EXECUTE FUNCTION refresh_kpi_on_booking_change();
+
+-- Число объектов меняет доступные ночи владельца: пересчитываем текущий и будущие месяцы,
+-- прошлые месяцы остаются с тем числом объектов, которое было тогда
+CREATE OR REPLACE FUNCTION refresh_kpi_on_unit_change() RETURNS TRIGGER AS $$
+DECLARE
+    v_month DATE;
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.owner_id IS NOT DISTINCT FROM NEW.owner_id THEN
+        RETURN NULL;
+    END IF;
+
+    FOR v_month IN
+        SELECT generate_series(DATE_TRUNC('month', CURRENT_DATE), DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '12 months', INTERVAL '1 month')::date
+    LOOP
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM refresh_owner_monthly_kpi(NEW.owner_id, v_month);
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM refresh_owner_monthly_kpi(OLD.owner_id, v_month);
+        END IF;
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_units_kpi ON units;
+CREATE TRIGGER trg_units_kpi
+AFTER INSERT OR UPDATE OF owner_id OR DELETE ON units
+FOR EACH ROW EXECUTE FUNCTION refresh_kpi_on_unit_change();
+
+-- Полный пересчёт за период: начальное заполнение и ручное восстановление
+CREATE OR REPLACE FUNCTION rebuild_kpi_rollups(p_from DATE, p_to DATE) RETURNS VOID AS $$
+DECLARE
+    v_unit_id INTEGER;
+BEGIN
+    FOR v_unit_id IN SELECT id FROM units ORDER BY id LOOP
+        PERFORM refresh_unit_kpi(v_unit_id, p_from, p_to);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_kpi_rollups(
+    LEAST(COALESCE(MIN(check_in), CURRENT_DATE), DATE_TRUNC('month', CURRENT_DATE)::date),
+    GREATEST(COALESCE(MAX(check_out), CURRENT_DATE), (DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '13 months')::date)
+)
+FROM bookings
+WHERE status = 'confirmed';
+
+COMMENT ON TABLE unit_daily_stats IS 'Занятые ночи объекта с заездами и выручкой по дню заезда';
+COMMENT ON TABLE owner_daily_stats IS 'Дневные показатели владельца: занятые объекты, заезды, выручка';
+COMMENT ON TABLE unit_monthly_stats IS 'Месячные показатели объекта: брони, занятые/доступные ночи, выручка, загрузка';
+COMMENT ON TABLE owner_monthly_stats IS 'Месячные показатели владельца: брони, занятые/доступные ночи, выручка, загрузка';
@@ -0,0 +1,27 @@
+-- Индекс для постраничной истории чата: сообщения разговора по времени (курсор created_at, id).
+-- idx_messages_conversation из V0018 не создан — это имя уже занято индексом таблицы messages (V0006).
+CREATE INDEX IF NOT EXISTS idx_ai_messages_conversation_created
+ON ai_messages(conversation_id, created_at, id);
+
+CREATE INDEX IF NOT EXISTS idx_ai_conversations_owner_type
+ON ai_conversations(owner_id, context_type, id);
+
+-- Архив неактивных разговоров: переписка хранится одним JSONB-значением на разговор
+-- и сжимается TOAST, горячие ai_conversations/ai_messages не растут вместе с историей.
+CREATE TABLE IF NOT EXISTS ai_conversations_archive (
+    id INTEGER PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    context_type VARCHAR(50),
+    summary TEXT,
+    messages JSONB NOT NULL DEFAULT '[]'::jsonb,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP,
+    last_message_at TIMESTAMP,
+    archived_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE ai_conversations_archive ALTER COLUMN messages SET STORAGE EXTENDED;
+
+CREATE INDEX IF NOT EXISTS idx_ai_conversations_archive_owner ON ai_conversations_archive(owner_id);
+
+COMMENT ON TABLE ai_conversations_archive IS 'Архив разговоров AI-ассистента без активности дольше 90 дней';
@@ -0,0 +1,17 @@
+-- Метрики обращений AI-ассистента к модели: задержка, время до первого токена, токены, исход
+CREATE TABLE IF NOT EXISTS ai_llm_calls (
+    id BIGSERIAL PRIMARY KEY,
+    owner_id INTEGER NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    purpose VARCHAR(20) NOT NULL DEFAULT 'chat',
+    status VARCHAR(20) NOT NULL DEFAULT 'ok' CHECK (status IN ('ok', 'timeout', 'error')),
+    latency_ms INTEGER,
+    first_token_ms INTEGER,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_ai_llm_calls_owner_created ON ai_llm_calls(owner_id, created_at);
+
+COMMENT ON TABLE ai_llm_calls IS 'Задержка и расход токенов по каждому обращению AI-ассистента к модели';
@@ -0,0 +1,19 @@
+-- Очередь обновлений Telegram: telegram-receive сохраняет webhook и сразу отвечает,
+-- telegram-process забирает строки под аренду и обрабатывает с ограниченным параллелизмом
+CREATE TABLE IF NOT EXISTS telegram_updates (
+    id BIGSERIAL PRIMARY KEY,
+    update_id BIGINT,
+    chat_id BIGINT NOT NULL,
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'processing', 'done', 'error')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    locked_until TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    processed_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_telegram_updates_status ON telegram_updates(status, id);
+CREATE INDEX IF NOT EXISTS idx_telegram_updates_created ON telegram_updates(created_at);
+
+COMMENT ON TABLE telegram_updates IS 'Входящие обновления Telegram в ожидании обработки telegram-process';
@@ -0,0 +1,16 @@
+-- Принятые обновления Telegram для дедупликации повторной доставки webhook'а.
+-- Вставка с ON CONFLICT DO NOTHING атомарно пропускает уже принятое обновление.
+CREATE TABLE IF NOT EXISTS telegram_processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    message_id BIGINT,
+    received_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_telegram_processed_updates_message
+ON telegram_processed_updates(chat_id, message_id);
+
+CREATE INDEX IF NOT EXISTS idx_telegram_processed_updates_received
+ON telegram_processed_updates(received_at);
+
+COMMENT ON TABLE telegram_processed_updates IS 'Ключи принятых обновлений Telegram (update_id, chat_id/message_id); хранятся 3 дня';
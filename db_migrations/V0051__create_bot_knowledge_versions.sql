@@ -0,0 +1,37 @@
+-- Версия базы знаний Telegram-бота схемы: увеличивается при любом изменении объектов,
+-- допродаж и настроек бота. По ней telegram-process пересобирает закэшированный системный промпт.
+-- Брони сюда не входят — промпт от них не зависит, и кэш не сбрасывается на каждую заявку.
+CREATE TABLE IF NOT EXISTS bot_knowledge_versions (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 1,
+    changed_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO bot_knowledge_versions (id, version, changed_at)
+VALUES (1, 1, NOW())
+ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_bot_knowledge_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE bot_knowledge_versions SET version = version + 1, changed_at = NOW() WHERE id = 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггеры уровня оператора: массовое изменение увеличивает версию один раз
+DROP TRIGGER IF EXISTS trg_units_bot_knowledge_version ON units;
+CREATE TRIGGER trg_units_bot_knowledge_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON units
+FOR EACH STATEMENT EXECUTE FUNCTION bump_bot_knowledge_version();
+
+DROP TRIGGER IF EXISTS trg_additional_services_bot_knowledge_version ON additional_services;
+CREATE TRIGGER trg_additional_services_bot_knowledge_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON additional_services
+FOR EACH STATEMENT EXECUTE FUNCTION bump_bot_knowledge_version();
+
+DROP TRIGGER IF EXISTS trg_bot_settings_bot_knowledge_version ON bot_settings;
+CREATE TRIGGER trg_bot_settings_bot_knowledge_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON bot_settings
+FOR EACH STATEMENT EXECUTE FUNCTION bump_bot_knowledge_version();
+
+COMMENT ON TABLE bot_knowledge_versions IS 'Версия базы знаний Telegram-бота (объекты, допродажи, настройки) для инвалидации кэша промпта';
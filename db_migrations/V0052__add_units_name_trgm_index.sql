@@ -0,0 +1,5 @@
+-- Нечёткий поиск объекта по названию из ответа модели (опечатки, другое написание):
+-- telegram-process ищет LOWER(name) % LOWER(:name), когда объекта нет в закэшированной базе знаний бота.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_units_name_trgm ON units USING gin (LOWER(name) gin_trgm_ops);
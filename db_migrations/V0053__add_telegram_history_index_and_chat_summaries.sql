@@ -0,0 +1,18 @@
+-- Окно истории чата бота: последние сообщения по telegram_id без сортировки всей переписки.
+-- Одноколоночный idx_telegram_messages_telegram_id (V0014) покрывается новым индексом.
+CREATE INDEX IF NOT EXISTS idx_telegram_messages_chat_created
+ON telegram_messages(telegram_id, created_at DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_telegram_messages_telegram_id;
+
+-- Накопительная сводка переписки гостя: сообщения за пределами окна истории сворачиваются в неё,
+-- чтобы промпт не рос с длиной разговора
+CREATE TABLE IF NOT EXISTS telegram_chat_summaries (
+    telegram_id BIGINT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    summary_message_id INTEGER NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+COMMENT ON TABLE telegram_chat_summaries IS 'Краткое содержание ранней переписки гостя с Telegram-ботом';
+COMMENT ON COLUMN telegram_chat_summaries.summary_message_id IS 'Последнее сообщение (telegram_messages.id), вошедшее в сводку';
@@ -0,0 +1,13 @@
+-- Идемпотентная обработка очереди Telegram: повтор обновления после сбоя или истечения аренды
+-- не дублирует реплики гостя в истории, ответы бота и заявки на бронь.
+-- Реплика гостя привязана к строке очереди и вставляется с ON CONFLICT DO NOTHING
+ALTER TABLE telegram_messages ADD COLUMN IF NOT EXISTS update_row_id BIGINT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_telegram_messages_update_row
+ON telegram_messages(update_row_id) WHERE update_row_id IS NOT NULL;
+
+-- Отметка фиксируется до первой отправки гостю: отвеченное обновление при повторе не обрабатывается заново
+ALTER TABLE telegram_updates ADD COLUMN IF NOT EXISTS replied_at TIMESTAMP;
+
+COMMENT ON COLUMN telegram_messages.update_row_id IS 'Строка telegram_updates, из которой сохранена реплика гостя';
+COMMENT ON COLUMN telegram_updates.replied_at IS 'Когда по обновлению начали отправлять ответ; такие обновления не обрабатываются повторно';
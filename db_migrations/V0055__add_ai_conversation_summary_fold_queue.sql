@@ -0,0 +1,9 @@
+-- Сворачивание истории разговора в сводку вынесено из ответа владельцу в планировщик:
+-- ответ только отмечает разговор, вызов модели для сводки делает action=summarize-conversations
+ALTER TABLE ai_conversations
+ADD COLUMN IF NOT EXISTS summary_fold_requested_at TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_ai_conversations_summary_fold
+ON ai_conversations(summary_fold_requested_at) WHERE summary_fold_requested_at IS NOT NULL;
+
+COMMENT ON COLUMN ai_conversations.summary_fold_requested_at IS 'Когда за окном истории накопились несвёрнутые сообщения; NULL — сворачивать нечего';
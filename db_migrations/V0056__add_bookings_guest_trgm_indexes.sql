@@ -0,0 +1,6 @@
+-- Поиск гостя AI-ассистентом (инструмент find_guest): подстрока имени или телефона.
+-- ILIKE/LIKE '%...%' без триграммного индекса читает все брони.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_bookings_guest_name_trgm ON bookings USING gin (guest_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_bookings_guest_phone_trgm ON bookings USING gin (guest_phone gin_trgm_ops);
@@ -0,0 +1,177 @@
+-- Исправления KPI-роллапов (V0046):
+-- 1) смена владельца и удаление объекта пересчитывают дневные показатели старого и нового владельца,
+--    а не только месячные; unit_daily_stats.owner_id переписывается на нового владельца;
+-- 2) брони с заездом и выездом в один день (check_in = check_out) учитываются в заездах и выручке
+--    дня заезда, но ночь не занимают.
+
+-- Строка дня может появиться и без занятой ночи — только с заездом однодневной брони
+ALTER TABLE unit_daily_stats ADD COLUMN IF NOT EXISTS occupied BOOLEAN NOT NULL DEFAULT true;
+
+-- Пересчёт дневных и месячных итогов владельца за период [p_from, p_to) по unit_daily_stats
+CREATE OR REPLACE FUNCTION refresh_owner_kpi(p_owner_id INTEGER, p_from DATE, p_to DATE) RETURNS VOID AS $$
+DECLARE
+    v_month DATE;
+BEGIN
+    IF p_owner_id IS NULL OR p_to <= p_from THEN
+        RETURN;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext('kpi_rollup'), p_owner_id);
+
+    DELETE FROM owner_daily_stats WHERE owner_id = p_owner_id AND day >= p_from AND day < p_to;
+
+    INSERT INTO owner_daily_stats (owner_id, day, booked_units, check_ins, revenue)
+    SELECT p_owner_id, day, COUNT(*) FILTER (WHERE occupied), SUM(check_ins), SUM(revenue)
+    FROM unit_daily_stats
+    WHERE owner_id = p_owner_id AND day >= p_from AND day < p_to
+    GROUP BY day;
+
+    FOR v_month IN
+        SELECT generate_series(DATE_TRUNC('month', p_from), DATE_TRUNC('month', p_to - 1), INTERVAL '1 month')::date
+    LOOP
+        PERFORM refresh_owner_monthly_kpi(p_owner_id, v_month);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_unit_kpi(p_unit_id INTEGER, p_from DATE, p_to DATE) RETURNS VOID AS $$
+DECLARE
+    v_owner_id INTEGER;
+    v_month DATE;
+BEGIN
+    IF p_unit_id IS NULL OR p_to <= p_from THEN
+        RETURN;
+    END IF;
+
+    SELECT owner_id INTO v_owner_id FROM units WHERE id = p_unit_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    -- Параллельные изменения броней одного владельца пересчитывают одни и те же строки
+    PERFORM pg_advisory_xact_lock(hashtext('kpi_rollup'), COALESCE(v_owner_id, -p_unit_id));
+
+    DELETE FROM unit_daily_stats WHERE unit_id = p_unit_id AND day >= p_from AND day < p_to;
+
+    -- Пересекающиеся брони занимают ночь один раз, выручка относится к дню заезда;
+    -- однодневная бронь даёт заезд без занятой ночи
+    INSERT INTO unit_daily_stats (unit_id, day, owner_id, check_ins, revenue, occupied)
+    SELECT
+        p_unit_id,
+        d.day,
+        v_owner_id,
+        COUNT(*) FILTER (WHERE b.check_in = d.day),
+        COALESCE(SUM(b.total_price) FILTER (WHERE b.check_in = d.day), 0),
+        BOOL_OR(b.check_out > d.day)
+    FROM (SELECT generate_series(p_from, p_to - 1, INTERVAL '1 day')::date AS day) d
+    JOIN bookings b ON b.unit_id = p_unit_id
+        AND b.status = 'confirmed'
+        AND b.check_in <= d.day
+        AND (b.check_out > d.day OR b.check_in = d.day)
+    GROUP BY d.day;
+
+    FOR v_month IN
+        SELECT generate_series(DATE_TRUNC('month', p_from), DATE_TRUNC('month', p_to - 1), INTERVAL '1 month')::date
+    LOOP
+        INSERT INTO unit_monthly_stats (unit_id, month, owner_id, bookings, booked_nights, available_nights, revenue, updated_at)
+        SELECT
+            p_unit_id,
+            v_month,
+            v_owner_id,
+            COALESCE(SUM(check_ins), 0),
+            COUNT(*) FILTER (WHERE occupied),
+            (v_month + INTERVAL '1 month')::date - v_month,
+            COALESCE(SUM(revenue), 0),
+            NOW()
+        FROM unit_daily_stats
+        WHERE unit_id = p_unit_id AND day >= v_month AND day < v_month + INTERVAL '1 month'
+        ON CONFLICT (unit_id, month) DO UPDATE
+        SET owner_id = EXCLUDED.owner_id,
+            bookings = EXCLUDED.bookings,
+            booked_nights = EXCLUDED.booked_nights,
+            available_nights = EXCLUDED.available_nights,
+            revenue = EXCLUDED.revenue,
+            updated_at = NOW();
+    END LOOP;
+
+    PERFORM refresh_owner_kpi(v_owner_id, p_from, p_to);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_kpi_on_booking_change() RETURNS TRIGGER AS $$
+BEGIN
+    -- Показатели зависят только от подтверждённых броней, их дат, объекта и суммы
+    IF TG_OP = 'UPDATE'
+       AND OLD.status IS NOT DISTINCT FROM NEW.status
+       AND OLD.unit_id IS NOT DISTINCT FROM NEW.unit_id
+       AND OLD.check_in IS NOT DISTINCT FROM NEW.check_in
+       AND OLD.check_out IS NOT DISTINCT FROM NEW.check_out
+       AND OLD.total_price IS NOT DISTINCT FROM NEW.total_price THEN
+        RETURN NULL;
+    END IF;
+
+    -- Однодневная бронь пересчитывает хотя бы день заезда
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'confirmed' THEN
+        PERFORM refresh_unit_kpi(OLD.unit_id, OLD.check_in, GREATEST(OLD.check_out, OLD.check_in + 1));
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'confirmed' THEN
+        PERFORM refresh_unit_kpi(NEW.unit_id, NEW.check_in, GREATEST(NEW.check_out, NEW.check_in + 1));
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Число объектов меняет доступные ночи владельца: пересчитываем текущий и будущие месяцы.
+-- Дни объекта при смене владельца переходят к новому владельцу, при удалении — уходят из итогов старого
+-- (строки unit_daily_stats удалённого объекта к этому моменту уже удалены каскадом)
+CREATE OR REPLACE FUNCTION refresh_kpi_on_unit_change() RETURNS TRIGGER AS $$
+DECLARE
+    v_month DATE;
+    v_from DATE;
+    v_to DATE;
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.owner_id IS NOT DISTINCT FROM NEW.owner_id THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'UPDATE' THEN
+        SELECT MIN(day), MAX(day) + 1 INTO v_from, v_to FROM unit_daily_stats WHERE unit_id = NEW.id;
+        IF v_from IS NOT NULL THEN
+            PERFORM refresh_unit_kpi(NEW.id, v_from, v_to);
+            PERFORM refresh_owner_kpi(OLD.owner_id, v_from, v_to);
+        END IF;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        SELECT MIN(day), MAX(day) + 1 INTO v_from, v_to FROM owner_daily_stats WHERE owner_id = OLD.owner_id;
+        IF v_from IS NOT NULL THEN
+            PERFORM refresh_owner_kpi(OLD.owner_id, v_from, v_to);
+        END IF;
+    END IF;
+
+    FOR v_month IN
+        SELECT generate_series(DATE_TRUNC('month', CURRENT_DATE), DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '12 months', INTERVAL '1 month')::date
+    LOOP
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM refresh_owner_monthly_kpi(NEW.owner_id, v_month);
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM refresh_owner_monthly_kpi(OLD.owner_id, v_month);
+        END IF;
+    END LOOP;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Однодневные брони и итоги владельцев после прошлых смен владельца: полный пересчёт
+SELECT rebuild_kpi_rollups(
+    LEAST(COALESCE(MIN(check_in), CURRENT_DATE), DATE_TRUNC('month', CURRENT_DATE)::date),
+    GREATEST(COALESCE(MAX(check_out), CURRENT_DATE) + 1, (DATE_TRUNC('month', CURRENT_DATE) + INTERVAL '13 months')::date)
+)
+FROM bookings
+WHERE status = 'confirmed';
+
+COMMENT ON COLUMN unit_daily_stats.occupied IS 'Ночь занята; false — в этот день только заезд однодневной брони';
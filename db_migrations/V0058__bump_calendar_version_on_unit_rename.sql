@@ -0,0 +1,19 @@
+-- Название объекта входит в SUMMARY событий общего iCal-календаря владельца:
+-- переименование увеличивает версию календаря объекта, чтобы сменился ETag экспорта
+CREATE OR REPLACE FUNCTION bump_unit_calendar_version_on_rename() RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.name IS DISTINCT FROM NEW.name THEN
+        INSERT INTO unit_calendar_versions (unit_id, version, changed_at)
+        VALUES (NEW.id, 1, NOW())
+        ON CONFLICT (unit_id) DO UPDATE
+        SET version = unit_calendar_versions.version + 1, changed_at = NOW();
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_units_calendar_version ON units;
+CREATE TRIGGER trg_units_calendar_version
+AFTER UPDATE OF name ON units
+FOR EACH ROW EXECUTE FUNCTION bump_unit_calendar_version_on_rename();
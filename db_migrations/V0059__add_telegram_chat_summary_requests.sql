@@ -0,0 +1,12 @@
+-- Сводка переписки гостя обновляется планировщиком (telegram-process, action=summarize-chats),
+-- а не в очереди чата: обработка сообщений только отмечает чат, вызов модели идёт отдельно
+ALTER TABLE telegram_chat_summaries ADD COLUMN IF NOT EXISTS summary_requested_at TIMESTAMP;
+
+-- Отметка может появиться раньше первой сводки: строка создаётся с пустой сводкой
+ALTER TABLE telegram_chat_summaries ALTER COLUMN summary SET DEFAULT '';
+ALTER TABLE telegram_chat_summaries ALTER COLUMN summary_message_id SET DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_telegram_chat_summaries_requested
+ON telegram_chat_summaries(summary_requested_at) WHERE summary_requested_at IS NOT NULL;
+
+COMMENT ON COLUMN telegram_chat_summaries.summary_requested_at IS 'Когда за окном истории накопились несвёрнутые сообщения; NULL — сворачивать нечего';
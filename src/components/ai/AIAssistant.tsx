@@ -53,6 +53,10 @@ export default function AIAssistant() {
       const settingsData = await settingsRes.json();
       const chatData = await chatRes.json();
       
+      if (chatData.conversation_id) {
+        setConversationId(chatData.conversation_id);
+      }
+
       if (chatData.messages && chatData.messages.length > 0) {
         setMessages(chatData.messages);
       } else {
@@ -83,6 +87,31 @@ export default function AIAssistant() {
     setInput('');
     setLoading(true);
 
+    // Пока идёт генерация, забираем частичный ответ по stream_id и показываем его по мере появления
+    const streamId = crypto.randomUUID();
+    let streamFinished = false;
+    let streamShown = false;
+    const showAssistantText = (content: string) => {
+      const replaceLast = streamShown;
+      streamShown = true;
+      setMessages(prev => replaceLast
+        ? [...prev.slice(0, -1), { ...prev[prev.length - 1], content }]
+        : [...prev, { role: 'assistant', content, created_at: new Date().toISOString() }]
+      );
+    };
+    const streamPoll = setInterval(async () => {
+      try {
+        const res = await fetchWithAuth(`${AI_URL}?action=chat-stream&stream_id=${streamId}`);
+        if (!res.ok || streamFinished) return;
+        const partial = await res.json();
+        if (partial.content && !streamFinished) {
+          showAssistantText(partial.content);
+        }
+      } catch (error) {
+        // Partial result is optional, final response comes from POST
+      }
+    }, 500);
+
     try {
       const userStr = localStorage.getItem('user');
       const user = userStr ? JSON.parse(userStr) : null;
@@ -93,9 +122,12 @@ export default function AIAssistant() {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           message: messageText,
-          conversation_id: conversationId
+          conversation_id: conversationId,
+          stream_id: streamId
         })
       });
+      streamFinished = true;
+      clearInterval(streamPoll);
 
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
@@ -108,19 +140,15 @@ export default function AIAssistant() {
         setConversationId(data.conversation_id);
       }
 
-      const assistantMessage: Message = {
-        role: 'assistant',
-        content: data.message,
-        created_at: new Date().toISOString()
-      };
-
-      setMessages(prev => [...prev, assistantMessage]);
+      showAssistantText(data.message);
       
       // Если AI распознал intent на рассылку
       if (data.intent) {
         setBroadcastIntent(data.intent);
       }
     } catch (error) {
+      streamFinished = true;
+      clearInterval(streamPoll);
       const errorMessage = error instanceof Error ? error.message : 'Неизвестная ошибка';
       setMessages(prev => [...prev, {
         role: 'assistant',
@@ -39,13 +39,9 @@ export default function CalendarSyncCard({ units }: { units: Unit[] }) {
   const [editingUrl, setEditingUrl] = useState<number | null>(null);
   const [tempUrl, setTempUrl] = useState('');
 
+  // Фоновое обновление фидов делает планировщик calendar-sync-due по next_sync_at
   useEffect(() => {
     loadSyncs();
-    const interval = setInterval(() => {
-      autoSync();
-    }, 30 * 60 * 1000);
-
-    return () => clearInterval(interval);
   }, []);
 
   const loadSyncs = async () => {
@@ -60,22 +56,6 @@ export default function CalendarSyncCard({ units }: { units: Unit[] }) {
     }
   };
 
-  const autoSync = async () => {
-    const activeSyncs = syncs.filter(s => s.is_active && s.calendar_url);
-    for (const sync of activeSyncs) {
-      try {
-        await fetchWithAuth(`${API_URL}?action=calendar-sync-now`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ id: sync.id })
-        });
-      } catch (error) {
-        // Auto-sync error
-      }
-    }
-    await loadSyncs();
-  };
-
   const addSync = async () => {
     if (!newSync.unit_id || !newSync.platform || !newSync.calendar_url) {
       toast({ title: 'Заполните все поля', variant: 'destructive' });